@@ -16,6 +16,11 @@ import prettytable
 import re
 from time import time
 
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
 from __main__ import send_cmd_help
 from __main__ import settings
 
@@ -29,6 +34,11 @@ from .utils.settings import Settings
 
 LOGS_PER_CHANNEL_USER = 5
 
+# How long a member's moderator status in a channel is trusted without checking again
+MOD_STATUS_TTL_SECS = 60
+# Expired statuses for a server are dropped once it has this many
+MOD_STATUS_PRUNE_SIZE = 2000
+
 AUTOMOD_HELP = """
 Automod works by creating named global patterns, and then applying them in
 specific channels as either whitelist or blacklist rules. This allows you
@@ -110,6 +120,9 @@ class AutoMod2:
         self.server_user_last = defaultdict(dict)
         self.server_phrase_last = defaultdict(dict)
 
+        # (expires_at, is_mod) by server id, then (channel id, member id)
+        self.mod_status = defaultdict(dict)
+
     @commands.command()
     @checks.mod_or_permissions(manage_server=True)
     async def automodhelp(self):
@@ -246,7 +259,7 @@ class AutoMod2:
         if image_limit == 0:
             return
         elif image_limit > 0:
-            if mod_or_perms(ctx, manage_messages=True):
+            if self.is_mod(ctx):
                 return
 
             key = (message.channel.id, message.author.id)
@@ -275,7 +288,7 @@ class AutoMod2:
             await asyncio.sleep(10)
             await self.bot.delete_message(alert_msg)
         else:
-            if mod_or_perms(ctx, manage_messages=True):
+            if self.is_mod(ctx):
                 return
             if len(message.embeds) or len(message.attachments):
                 return
@@ -290,42 +303,62 @@ class AutoMod2:
         if message.author.id == self.bot.user.id or message.channel.is_private:
             return
 
-        ctx = CtxWrapper(message, self.bot)
-        if mod_or_perms(ctx, manage_messages=True):
+        whitelists, blacklists = self.settings.getChannelRules(message.server.id, message.channel.id)
+        if not whitelists.rules and not blacklists.rules:
             return
 
-        whitelists, blacklists = self.settings.getRulesForChannel(ctx)
+        ctx = CtxWrapper(message, self.bot)
+        if self.is_mod(ctx):
+            return
 
         msg_template = box('Your message in {} was deleted for violating the following policy: {}\n'
                            'Message content: {}')
 
         msg_content = message.clean_content
-        for value in blacklists:
-            name = value['name']
-            include_pattern = value['include_pattern']
-            exclude_pattern = value['exclude_pattern']
-
-            if not matchesIncludeExclude(include_pattern, exclude_pattern, msg_content):
-                continue
-
-            msg = msg_template.format(message.channel.name, name, msg_content)
+        for rule in blacklists.matching(msg_content):
+            msg = msg_template.format(message.channel.name, rule.name, msg_content)
             await self.deleteAndReport(message, msg)
 
-        if len(whitelists):
-            failed_whitelists = list()
-            for value in whitelists:
-                name = value['name']
-                include_pattern = value['include_pattern']
-                exclude_pattern = value['exclude_pattern']
-
-                if matchesIncludeExclude(include_pattern, exclude_pattern, msg_content):
-                    return
-                failed_whitelists.append(name)
+        if len(whitelists.rules):
+            if whitelists.matchesAny(msg_content):
+                return
 
+            failed_whitelists = [rule.name for rule in whitelists.rules]
             msg = msg_template.format(message.channel.name,
                                       ','.join(failed_whitelists), msg_content)
             await self.deleteAndReport(message, msg)
 
+    def is_mod(self, ctx):
+        """Whether the author counts as a moderator in the channel, cached for a short time."""
+        message = ctx.message
+        server_status = self.mod_status[message.server.id]
+        key = (message.channel.id, message.author.id)
+        now = time()
+        status = server_status.get(key)
+        if status and status[0] > now:
+            return status[1]
+
+        is_mod = mod_or_perms(ctx, manage_messages=True)
+        if len(server_status) >= MOD_STATUS_PRUNE_SIZE:
+            for k in [k for k, v in server_status.items() if v[0] <= now]:
+                server_status.pop(k)
+        server_status[key] = (now + MOD_STATUS_TTL_SECS, is_mod)
+        return is_mod
+
+    async def clear_member_mod_status(self, before, after):
+        if before.roles == after.roles:
+            return
+        server_status = self.mod_status[after.server.id]
+        for k in [k for k in server_status if k[1] == after.id]:
+            server_status.pop(k)
+
+    async def clear_role_mod_status(self, before, after=None):
+        self.mod_status.pop(before.server.id, None)
+
+    async def clear_channel_mod_status(self, before, after):
+        if not before.is_private:
+            self.mod_status.pop(before.server.id, None)
+
     @automod2.command(pass_context=True, no_pm=True)
     @checks.mod_or_permissions(manage_server=True)
     async def autoemojis(self, ctx, key: str = None):
@@ -535,7 +568,7 @@ class AutoMod2:
             if not report:
                 continue
 
-            p = re.compile(phrase, re.IGNORECASE | re.MULTILINE | re.DOTALL)
+            p = self.settings.getCompiledWatchdogPhrase(server_id, name)
             if p.match(message.clean_content):
                 self.server_phrase_last[server_id][name] = now
                 output_msg = '**Watchdog:** {} spoke in {} `(rule [{}] matched phrase [{}])`\n{}'.format(
@@ -572,20 +605,119 @@ class AutoMod2:
         return rpadutils.strip_right_multiline(tbl.get_string())
 
 
-def matchesPattern(pattern, txt):
+PATTERN_FLAGS = re.IGNORECASE | re.MULTILINE | re.DOTALL
+
+
+def compilePattern(pattern):
+    """Returns a function that tests txt against the pattern.
+
+    Patterns like :starts_with_code: call the named check method instead of
+    matching a regex.
+    """
     if not len(pattern):
-        return False
+        return lambda txt: False
 
-    try:
-        if pattern[0] == pattern[-1] == ':':
-            check_method = globals().get(pattern[1:-1])
-            if check_method:
+    check_method = getCheckMethod(pattern)
+    if check_method:
+        def check(txt):
+            try:
                 return check_method(txt)
-    except:
+            except:
+                return False
+        return check
+
+    return re.compile(pattern, PATTERN_FLAGS).match
+
+
+def getCheckMethod(pattern):
+    if len(pattern) and pattern[0] == pattern[-1] == ':':
+        return globals().get(pattern[1:-1])
+    return None
+
+
+# Non-ASCII characters that IGNORECASE matching treats as equal to ASCII letters
+ASCII_CASE_FOLDS = str.maketrans({'\u0130': 'i', '\u0131': 'i', '\u017f': 's', '\u212a': 'k'})
+
+
+def foldCase(txt):
+    return txt.translate(ASCII_CASE_FOLDS).lower()
+
+
+def requiredLiteral(pattern):
+    """The longest ASCII text every match of the regex must contain, case folded.
+
+    Returns None for check methods, and for patterns with no such text (e.g. a
+    top level alternation).
+    """
+    if not len(pattern) or getCheckMethod(pattern):
+        return None
+    try:
+        parsed = sre_parse.parse(pattern, PATTERN_FLAGS)
+    except Exception:
+        return None
+
+    literals = []
+    collectLiterals(parsed, literals)
+    return foldCase(max(literals, key=len)) or None
+
+
+def collectLiterals(items, literals):
+    run = ''
+    for op, av in items:
+        if op == sre_parse.LITERAL and av < 128:
+            run += chr(av)
+            continue
+
+        literals.append(run)
+        run = ''
+        if op == sre_parse.SUBPATTERN:
+            collectLiterals(av[-1], literals)
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] > 0:
+            collectLiterals(av[2], literals)
+    literals.append(run)
+
+
+class CompiledRule(object):
+    """A pattern from settings with its include and exclude components compiled."""
+
+    def __init__(self, pattern):
+        self.name = pattern['name']
+        self.include_pattern = pattern['include_pattern']
+        self.include = compilePattern(self.include_pattern)
+        self.exclude = compilePattern(pattern['exclude_pattern'])
+
+    def matches(self, txt):
+        if self.include(txt):
+            return not self.exclude(txt)
         return False
 
-    p = re.compile(pattern, re.IGNORECASE | re.MULTILINE | re.DOTALL)
-    return p.match(txt)
+
+class RuleSet(object):
+    """A channel's whitelist or blacklist rules, tested together.
+
+    Most patterns contain some literal text that any match must include, like a
+    word or domain name. Checking for those with a substring search is much cheaper
+    than running the regex, so each message is only matched against the rules
+    whose literal text it contains.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.literals = [requiredLiteral(rule.include_pattern) for rule in rules]
+
+    def matching(self, txt):
+        """Yields the rules that match txt, in order."""
+        folded_txt = foldCase(txt)
+        for rule, literal in zip(self.rules, self.literals):
+            if literal is not None and literal not in folded_txt:
+                continue
+            if rule.matches(txt):
+                yield rule
+
+    def matchesAny(self, txt):
+        for _ in self.matching(txt):
+            return True
+        return False
 
 
 def starts_with_code(txt):
@@ -608,12 +740,6 @@ def pad_checkdigit(n):
     return checkdigit == calcdigit
 
 
-def matchesIncludeExclude(include_pattern, exclude_pattern, txt):
-    if matchesPattern(include_pattern, txt):
-        return not matchesPattern(exclude_pattern, txt)
-    return False
-
-
 def setup(bot):
     n = AutoMod2(bot)
     bot.add_listener(n.mod_message_images, "on_message")
@@ -621,10 +747,28 @@ def setup(bot):
     bot.add_listener(n.mod_message, "on_message")
     bot.add_listener(n.mod_message_edit, "on_message_edit")
     bot.add_listener(n.mod_message_watchdog, "on_message")
+    bot.add_listener(n.clear_member_mod_status, "on_member_update")
+    bot.add_listener(n.clear_role_mod_status, "on_server_role_update")
+    bot.add_listener(n.clear_role_mod_status, "on_server_role_delete")
+    bot.add_listener(n.clear_channel_mod_status, "on_channel_update")
     bot.add_cog(n)
 
 
 class AutoMod2Settings(CogSettings):
+    def __init__(self, *args, **kwargs):
+        # Compiled patterns and watchdog phrases, by server id then name
+        self.compiled_rules = defaultdict(dict)
+        self.compiled_phrases = defaultdict(dict)
+        # (whitelist, blacklist) RuleSets by server id then channel id
+        self.channel_rules = defaultdict(dict)
+        super(AutoMod2Settings, self).__init__(*args, **kwargs)
+
+    def save_settings(self):
+        self.compiled_rules.clear()
+        self.compiled_phrases.clear()
+        self.channel_rules.clear()
+        super(AutoMod2Settings, self).save_settings()
+
     def make_default_settings(self):
         config = {
             'configs': {}
@@ -673,16 +817,26 @@ class AutoMod2Settings(CogSettings):
 
         return channels[channel_id]
 
-    def getRulesForChannel(self, ctx):
-        patterns = self.getPatterns(ctx)
-        channel = self.getChannel(ctx)
-
-        whitelist = [patterns[name] for name in channel['whitelist']]
-        blacklist = [patterns[name] for name in channel['blacklist']]
-        return whitelist, blacklist
-
-    def getPatterns(self, ctx):
-        server = self.getServer(ctx)
+    def getChannelRules(self, server_id, channel_id):
+        server_channels = self.channel_rules[server_id]
+        rules = server_channels.get(channel_id)
+        if rules is None:
+            channel = self.getServer(None, server_id).get('channels', {}).get(channel_id, {})
+            rules = (RuleSet([self.getCompiledRule(server_id, name) for name in channel.get('whitelist', [])]),
+                     RuleSet([self.getCompiledRule(server_id, name) for name in channel.get('blacklist', [])]))
+            server_channels[channel_id] = rules
+        return rules
+
+    def getCompiledRule(self, server_id, name):
+        server_rules = self.compiled_rules[server_id]
+        rule = server_rules.get(name)
+        if rule is None:
+            rule = CompiledRule(self.getPatterns(None, server_id)[name])
+            server_rules[name] = rule
+        return rule
+
+    def getPatterns(self, ctx, server_id=None):
+        server = self.getServer(ctx, server_id)
         if 'patterns' not in server:
             server['patterns'] = {}
         return server['patterns']
@@ -794,6 +948,15 @@ class AutoMod2Settings(CogSettings):
             watchdog[key] = {}
         return watchdog[key]
 
+    def getCompiledWatchdogPhrase(self, server_id, name):
+        server_phrases = self.compiled_phrases[server_id]
+        p = server_phrases.get(name)
+        if p is None:
+            phrase = self.getWatchdogPhrases(server_id)[name]['phrase']
+            p = re.compile(phrase, PATTERN_FLAGS)
+            server_phrases[name] = p
+        return p
+
     def setWatchdogPhrase(self, server_id, name, request_user_id, cooldown_secs, phrase):
         watchdog_phrases = self.getWatchdogPhrases(server_id)
         if cooldown_secs:
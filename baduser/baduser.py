@@ -19,7 +19,7 @@ from __main__ import settings
 
 from . import rpadutils
 from .rpadutils import *
-from .rpadutils import CogSettings
+from .rpadutils import SqliteCogSettings
 from .utils import checks
 from .utils.chat_formatting import *
 from .utils.dataIO import fileIO
@@ -501,7 +501,9 @@ def setup(bot):
     print('done adding baduser bot')
 
 
-class BadUserSettings(CogSettings):
+class BadUserSettings(SqliteCogSettings):
+    SPLIT_SECTIONS = ('servers', 'banned_users')
+
     def make_default_settings(self):
         config = {
             'servers': {},
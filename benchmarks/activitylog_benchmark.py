@@ -0,0 +1,259 @@
+"""
+Offline benchmark for the activity log database under mixed read/write load.
+
+Seeds a scratch database with synthetic messages, then for a fixed duration
+runs one writer thread inserting batches at a target message rate while reader
+threads run exlog queries against it. Reports insert batch latency, achieved
+write rate, and per-query read latency. No Discord connection is needed.
+
+--legacy opens the database with default journaling and pragmas, for
+comparison against the WAL configuration the cog uses.
+
+Usage:
+  python benchmarks/activitylog_benchmark.py --red-dir ~/Red-DiscordBot \\
+      --seed-rows 200000 --duration 30 --output results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import timeit
+from datetime import datetime, timedelta
+
+from cog_loader import git_commit, load_cogs, timings_summary
+
+SERVER_IDS = ['1000', '2000', '3000']
+CHANNEL_IDS = [str(4000 + i) for i in range(20)]
+USER_IDS = [str(10000 + i) for i in range(500)]
+BOT_ID = '999'
+WORDS = ['whale', 'ra', 'sonia', 'dkali', 'stamina', 'godfest', 'pull', 'rainbow',
+         'team', 'leader', 'sub', 'dungeon', 'clear', 'farm', 'rem', 'lol', ':thinking:',
+         'anyone', 'help', 'with', 'this', 'the', 'a', 'is', 'for', 'my', 'need']
+
+
+def random_row(rng, timestamp):
+    text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 20)))
+    # Shaped like SqlActivityLogger.log's rows; content matches clean_content, so it's stored as ''
+    return (timestamp, rng.choice(SERVER_IDS), rng.choice(CHANNEL_IDS), rng.choice(USER_IDS),
+            'NEW', '', text, None, None)
+
+
+def connect_legacy(sqlactivitylog, db_path, read_only):
+    con = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+    con.create_function('decompress', 1, sqlactivitylog.decompress)
+    con.create_function('compress', 1, sqlactivitylog.compress)
+    if read_only:
+        con.row_factory = sqlite3.Row
+        return con
+    sqlactivitylog.create_schema(con)
+    return con
+
+
+def make_writer(sqlactivitylog, con, fts):
+    """Returns a function writing a batch the same way SqlActivityLogger.write_rows does."""
+    known_partitions = set(sqlactivitylog.list_partitions(con))
+
+    def write_batch(batch):
+        sqlactivitylog.write_messages(con, batch, known_partitions, fts)
+
+    return write_batch
+
+
+def seed(write_batch, row_count, batch_rows):
+    rng = random.Random(0)
+    start = datetime.utcnow() - timedelta(days=90)
+    step = timedelta(days=90) / max(row_count, 1)
+    inserted = 0
+    while inserted < row_count:
+        batch = [random_row(rng, start + step * (inserted + i))
+                 for i in range(min(batch_rows, row_count - inserted))]
+        write_batch(batch)
+        inserted += len(batch)
+
+
+def read_queries(sqlactivitylog, use_fts):
+    """(name, query, params factory) for the exlog queries exercised by readers."""
+    def base(rng):
+        return {
+            'server_id': rng.choice(SERVER_IDS),
+            'bot_id': BOT_ID,
+            'row_count': 100,
+        }
+
+    def user(rng):
+        return dict(base(rng), user_id=rng.choice(USER_IDS))
+
+    def channel(rng):
+        return dict(base(rng), channel_id=rng.choice(CHANNEL_IDS))
+
+    def content(rng):
+        return dict(base(rng), content_query='%{}%'.format(rng.choice(WORDS)))
+
+    def daily(rng):
+        start_date = datetime.utcnow() - timedelta(days=31)
+        return dict(base(rng), row_count=30, start_date=start_date.date().isoformat())
+
+    content_sql = sqlactivitylog.CONTENT_QUERY_FTS if use_fts else sqlactivitylog.CONTENT_QUERY
+    whosays_sql = sqlactivitylog.WHOSAYS_PARTITION_FTS if use_fts else sqlactivitylog.WHOSAYS_PARTITION
+    return [
+        ('user', sqlactivitylog.LatestQuery(sqlactivitylog.USER_QUERY), user),
+        ('channel', sqlactivitylog.LatestQuery(sqlactivitylog.CHANNEL_QUERY), channel),
+        ('query', sqlactivitylog.LatestQuery(content_sql, sqlactivitylog.CONTENT_QUERY), content),
+        ('whosays', sqlactivitylog.UnionQuery(sqlactivitylog.WHOSAYS_QUERY, whosays_sql,
+                                              sqlactivitylog.WHOSAYS_PARTITION), content),
+        ('dailyreport', sqlactivitylog.DAILY_REPORT_QUERY, daily),
+    ]
+
+
+def run_writer(write_batch, rate, batch_rows, stop, results):
+    rng = random.Random(1)
+    interval = batch_rows / rate
+    next_batch = timeit.default_timer()
+    while not stop.is_set():
+        batch = [random_row(rng, datetime.utcnow()) for _ in range(batch_rows)]
+        before_time = timeit.default_timer()
+        try:
+            write_batch(batch)
+            results['timings'].append(timeit.default_timer() - before_time)
+            results['rows'] += len(batch)
+        except sqlite3.OperationalError as ex:
+            results['errors'].append(str(ex))
+
+        next_batch += interval
+        delay = next_batch - timeit.default_timer()
+        if delay > 0:
+            stop.wait(delay)
+
+
+def run_reader(con, queries, max_rows, seed_value, stop, results):
+    rng = random.Random(seed_value)
+    while not stop.is_set():
+        name, query, make_params = rng.choice(queries)
+        before_time = timeit.default_timer()
+        try:
+            if isinstance(query, str):
+                con.execute(query, make_params(rng)).fetchall()
+            else:
+                query.run(con, make_params(rng), max_rows)
+            results[name].append(timeit.default_timer() - before_time)
+        except sqlite3.OperationalError as ex:
+            results['errors'].append(str(ex))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--red-dir', required=True, help='Red-DiscordBot checkout (for cogs.utils)')
+    parser.add_argument('--seed-rows', type=int, default=200000)
+    parser.add_argument('--duration', type=float, default=30, help='Seconds of mixed load')
+    parser.add_argument('--write-rate', type=float, default=2000, help='Messages per second')
+    parser.add_argument('--readers', type=int, default=2)
+    parser.add_argument('--legacy', action='store_true', help='Use default journaling')
+    parser.add_argument('--output', help='Write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    sqlactivitylog, = load_cogs(os.path.abspath(args.red_dir), 'sqlactivitylog')
+    batch_rows = sqlactivitylog.WRITE_BATCH_ROWS
+
+    work_dir = tempfile.mkdtemp(prefix='rpad_activitylog_')
+    db_path = os.path.join(work_dir, 'log.db')
+    try:
+        if args.legacy:
+            write_con = connect_legacy(sqlactivitylog, db_path, read_only=False)
+        else:
+            write_con = sqlactivitylog.connect_writer(db_path)
+        sqlactivitylog.create_daily_activity_table(write_con)
+
+        use_fts = False
+        if not args.legacy:
+            use_fts, _ = sqlactivitylog.create_fts_index(write_con)
+            # The scratch database has no unindexed legacy rows
+            sqlactivitylog.rebuild_fts_index(write_con)
+        write_batch = make_writer(sqlactivitylog, write_con, use_fts)
+
+        before_time = timeit.default_timer()
+        seed(write_batch, args.seed_rows, batch_rows)
+        seed_time = timeit.default_timer() - before_time
+
+        queries = read_queries(sqlactivitylog, use_fts)
+        stop = threading.Event()
+        write_results = {'timings': [], 'rows': 0, 'errors': []}
+        read_results = []
+        threads = [threading.Thread(target=run_writer,
+                                    args=(write_batch, args.write_rate, batch_rows,
+                                          stop, write_results))]
+        read_cons = []
+        for i in range(args.readers):
+            if args.legacy:
+                read_con = connect_legacy(sqlactivitylog, db_path, read_only=True)
+            else:
+                read_con = sqlactivitylog.connect_reader(db_path)
+            read_cons.append(read_con)
+            results = {name: [] for name, _, _ in queries}
+            results['errors'] = []
+            read_results.append(results)
+            threads.append(threading.Thread(target=run_reader,
+                                            args=(read_con, queries, sqlactivitylog.MAX_LOGS * 2,
+                                                  i, stop, results)))
+
+        for t in threads:
+            t.start()
+        stop.wait(args.duration)
+        stop.set()
+        for t in threads:
+            t.join()
+
+        for con in read_cons:
+            con.close()
+        write_con.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    reads = {}
+    read_errors = []
+    for name, _, _ in queries:
+        reads[name] = timings_summary([t for r in read_results for t in r[name]])
+    for r in read_results:
+        read_errors.extend(r['errors'])
+
+    report = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat(),
+            'commit': git_commit(),
+            'python': sys.version,
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'legacy': args.legacy,
+            'seed_rows': args.seed_rows,
+            'duration': args.duration,
+            'write_rate': args.write_rate,
+            'readers': args.readers,
+        },
+        'results': {
+            'seed_time': seed_time,
+            'fts': use_fts,
+            'write_batches': timings_summary(write_results['timings']),
+            'rows_written': write_results['rows'],
+            'achieved_write_rate': write_results['rows'] / args.duration,
+            'write_errors': len(write_results['errors']),
+            'reads': reads,
+            'read_errors': len(read_errors),
+        },
+    }
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
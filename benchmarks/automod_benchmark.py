@@ -0,0 +1,140 @@
+"""
+Offline benchmark for AutoMod2 channel rule matching.
+
+For each rule count, builds a channel's blacklist from synthetic patterns (word
+filters, room code checks, link filters) and times testing a corpus of synthetic
+messages against it, both one rule at a time and through the RuleSet prefilter the
+cog uses. Reports per-message latency for each, and checks they agree. No Discord
+connection is needed.
+
+Usage:
+  python benchmarks/automod_benchmark.py --red-dir ~/Red-DiscordBot \\
+      --rule-counts 1,10,50,200 --output results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+from datetime import datetime
+
+from cog_loader import git_commit, load_cogs, timings_summary
+
+WORDS = ['whale', 'ra', 'sonia', 'dkali', 'stamina', 'godfest', 'pull', 'rainbow',
+         'team', 'leader', 'sub', 'dungeon', 'clear', 'farm', 'rem', 'lol', ':thinking:',
+         'anyone', 'help', 'with', 'this', 'the', 'a', 'is', 'for', 'my', 'need']
+
+
+def make_patterns(rng, count):
+    """(include, exclude) pairs shaped like the rules servers configure."""
+    patterns = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            patterns.append(('.*\\bbadword{}\\b.*'.format(i), ''))
+        elif kind == 1:
+            patterns.append(('.*(https?://)?(www\\.)?spam{}\\.(com|net).*'.format(i), ''))
+        elif kind == 2:
+            patterns.append(('^\\d{{4}}\\s?\\d{{4}}.*{}'.format(rng.choice(WORDS)), '.*test.*'))
+        else:
+            patterns.append(('.*(buy|sell) account {}.*'.format(i), '.*not.*'))
+    # A check method, which has no literal text to filter on
+    patterns.append((':starts_with_code:', ''))
+    return patterns
+
+
+def make_messages(rng, count, rule_count):
+    messages = []
+    for _ in range(count):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(3, 30))]
+        roll = rng.random()
+        if roll < 0.05:
+            words.append('badword{}'.format(4 * rng.randrange(max(rule_count // 4, 1))))
+        elif roll < 0.15:
+            words.insert(0, '{:04d} {:04d}'.format(rng.randrange(10000), rng.randrange(10000)))
+        messages.append(' '.join(words))
+    return messages
+
+
+def time_matches(match_fn, messages, repeat):
+    timings = []
+    results = []
+    for _ in range(repeat):
+        results = []
+        for txt in messages:
+            before_time = timeit.default_timer()
+            results.append(match_fn(txt))
+            timings.append(timeit.default_timer() - before_time)
+    return timings, results
+
+
+def bench_rule_count(automod2, rng, rule_count, messages, repeat):
+    rules = [automod2.CompiledRule({'name': 'rule{}'.format(i),
+                                    'include_pattern': include,
+                                    'exclude_pattern': exclude})
+             for i, (include, exclude) in enumerate(make_patterns(rng, rule_count))]
+
+    before_time = timeit.default_timer()
+    rule_set = automod2.RuleSet(rules)
+    build_time = timeit.default_timer() - before_time
+
+    per_rule_timings, per_rule_results = time_matches(
+        lambda txt: [r.name for r in rules if r.matches(txt)], messages, repeat)
+    prefiltered_timings, prefiltered_results = time_matches(
+        lambda txt: [r.name for r in rule_set.matching(txt)], messages, repeat)
+
+    return {
+        'rules': len(rules),
+        'filtered_rules': sum(1 for x in rule_set.literals if x),
+        'build_time': build_time,
+        'matched_messages': sum(1 for r in prefiltered_results if r),
+        'results_agree': per_rule_results == prefiltered_results,
+        'per_rule': timings_summary(per_rule_timings),
+        'prefiltered': timings_summary(prefiltered_timings),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--red-dir', required=True, help='Red-DiscordBot checkout (for cogs.utils)')
+    parser.add_argument('--rule-counts', default='1,5,10,25,50,100,200',
+                        help='Comma separated blacklist sizes to test')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='Write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    automod2, = load_cogs(os.path.abspath(args.red_dir), 'automod2')
+    rule_counts = [int(x) for x in args.rule_counts.split(',')]
+
+    results = {}
+    for rule_count in rule_counts:
+        rng = random.Random(rule_count)
+        messages = make_messages(rng, args.messages, rule_count)
+        results[str(rule_count)] = bench_rule_count(automod2, rng, rule_count, messages, args.repeat)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat(),
+            'commit': git_commit(),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'messages': args.messages,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Imports cogs from this checkout as a `cogs` package, the way Red does, without
+starting a bot or connecting to Discord.
+
+The cogs still need their normal dependencies installed (discord.py, pytz, etc),
+and a Red-DiscordBot checkout to supply the cogs.utils package.
+"""
+import importlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import __main__
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _unavailable(*args, **kwargs):
+    raise RuntimeError('Not available outside of a running bot')
+
+
+def load_cogs(red_dir, *cog_names):
+    """Imports the named cogs from this checkout and returns their modules in order.
+
+    red_dir is a Red-DiscordBot checkout; only its cogs/utils package is used.
+    """
+    package_dir = tempfile.mkdtemp(prefix='rpad_bench_')
+    cogs_dir = os.path.join(package_dir, 'cogs')
+    os.mkdir(cogs_dir)
+    open(os.path.join(cogs_dir, '__init__.py'), 'w').close()
+    shutil.copytree(os.path.join(red_dir, 'cogs', 'utils'), os.path.join(cogs_dir, 'utils'))
+
+    # Red requires every cog to sit directly in the cogs folder
+    for name in set(cog_names) | {'rpadutils'}:
+        shutil.copy(os.path.join(REPO_DIR, name, name + '.py'), cogs_dir)
+
+    # Red's launcher provides these, and the cogs import them from __main__
+    for attr in ('send_cmd_help', 'user_allowed'):
+        if not hasattr(__main__, attr):
+            setattr(__main__, attr, _unavailable)
+    if not hasattr(__main__, 'settings'):
+        __main__.settings = None
+
+    sys.path.insert(0, package_dir)
+    return [importlib.import_module('cogs.' + name) for name in cog_names]
+
+
+def git_commit():
+    """The commit of this checkout, for tagging results."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR).decode().strip()
+    except Exception:
+        return None
+
+
+def timings_summary(timings):
+    """Summarizes a list of durations in seconds."""
+    ordered = sorted(timings)
+    if not ordered:
+        return {'count': 0}
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    return {
+        'count': len(ordered),
+        'total': sum(ordered),
+        'min': ordered[0],
+        'mean': sum(ordered) / len(ordered),
+        'p50': percentile(.5),
+        'p95': percentile(.95),
+        'max': ordered[-1],
+    }
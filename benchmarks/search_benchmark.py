@@ -0,0 +1,315 @@
+"""
+Offline benchmark for monster lookup and search.
+
+Times MonsterIndex construction, find_monster/find_monster2 (^id, ^id2) over a
+query corpus, and SearchConfig evaluation (^search) over a set of specs, against a
+pinned copy of the DadGuide database. No Discord connection or network access is
+needed.
+
+evolution_tables_build, monster_list_build and the cold MonsterIndex builds use a
+freshly opened database each time, like the bot right after Dadguide reloads; the
+warm index builds, lookups and searches run against a database whose monster caches
+are already filled.
+
+The fixture directory must contain dadguide.sqlite, nicknames.csv, basenames.csv
+and panthnames.csv, e.g. copied out of a bot's data/dadguide folder.
+
+Usage:
+  python benchmarks/search_benchmark.py --red-dir ~/Red-DiscordBot \\
+      --fixture-dir ~/dadguide_fixture --output results.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sys
+import timeit
+from datetime import datetime
+
+from cog_loader import git_commit, load_cogs, timings_summary
+
+# A sample of real ^id queries
+DEFAULT_QUERIES = [
+    'ra',
+    'dkali',
+    'blue sonia',
+    'zeus',
+    'uvo ra',
+    'revo ra',
+    'a sakuya',
+    'asakuya',
+    'rgl',
+    'bastet',
+    'awoken bastet',
+    'dqxq',
+    'tamadra',
+    'pixel ra',
+    'np ra',
+    'chibi ra',
+    'hw myr',
+    'xmas myr',
+    'summer kaede',
+    'valentines sonia',
+    '4170',
+    'satan',
+    'ragnarok dragon',
+    'norse',
+    'greco roman',
+    'dark meimei',
+    'mega awoken ra',
+    'equip amaterasu',
+    'ミネルヴァ',
+    'ルシファー',
+    'yamato takeru',
+    'tsubaki',
+    'sarasvati',
+    'zhuge liang',
+    'freyja',
+    'odin dragon',
+    'green odin',
+    'lakshmi',
+    'batman',
+    'yugi',
+    'kenshin',
+    'raphael',
+    'uriel',
+    'gabriel',
+    'metatron',
+    'zerasu',
+    'xqxq',
+    'jeanne',
+    'elsa',
+    'orochi',
+]
+
+# Representative ^search specs
+DEFAULT_SPECS = [
+    'haste(2) inheritable',
+    'haste(1)',
+    'board(fire,water,wood)',
+    'board(fire,water,wood,light,dark,heal)',
+    'color(fire) type(dragon)',
+    'hascolor(dark) type(devil) type(god)',
+    'delay(1) inheritable',
+    'shuffle',
+    'unlock inheritable',
+    'resolve',
+    'absorbnull',
+    'attabsorb farmable',
+    'combo(1)',
+    'shield(50)',
+    'row(fire)',
+    'column(light)',
+    'convert(any,heal)',
+    'convert(jammer,any)',
+    'active(poison)',
+    'leader(bind)',
+    'name(ra)',
+    'cd(4) inheritable',
+    'atk(4000) hp(5000)',
+    'weighted(1500)',
+    'farmable type(machine)',
+    'all color(water)',
+    'all inheritable',
+]
+
+
+def read_lines(path):
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def time_call(fn, *args):
+    before_time = timeit.default_timer()
+    result = fn(*args)
+    return timeit.default_timer() - before_time, result
+
+
+def open_database(dadguide, db_file):
+    """Opens db_file the way dadguide.load_database does, evolution tables included."""
+    database = dadguide.DadguideDatabase(data_file=db_file)
+    database.load_evolution_tables()
+    return database
+
+
+def bench_monster_list(dadguide, db_file, repeat):
+    """Times the per-load work on a fresh database: the evolution tables load_database
+    computes, and the first get_all_monsters_by_no_na, which builds every monster.
+    """
+    evolution_timings = []
+    list_timings = []
+    for _ in range(repeat):
+        database = dadguide.DadguideDatabase(data_file=db_file)
+        try:
+            execution_time, _ = time_call(database.load_evolution_tables)
+            evolution_timings.append(execution_time)
+            execution_time, _ = time_call(database.get_all_monsters_by_no_na)
+            list_timings.append(execution_time)
+        finally:
+            database.close()
+    return timings_summary(evolution_timings), timings_summary(list_timings)
+
+
+def bench_index(dadguide, db_file, overrides, repeat):
+    """Times MonsterIndex builds, cold and warm.
+
+    Cold builds each get a freshly opened database, like the bot after Dadguide reloads.
+    Warm builds reuse one whose monster caches are already filled. Returns that database
+    (open) and its index, for the other benchmarks.
+    """
+    nickname_overrides, basename_overrides, panthname_overrides = overrides
+
+    def build_index(database):
+        return dadguide.MonsterIndex(database, nickname_overrides, basename_overrides,
+                                     dict(panthname_overrides))
+
+    cold_timings = []
+    for _ in range(repeat):
+        database = open_database(dadguide, db_file)
+        try:
+            execution_time, _ = time_call(build_index, database)
+        finally:
+            database.close()
+        cold_timings.append(execution_time)
+
+    database = open_database(dadguide, db_file)
+    index = build_index(database)
+    warm_timings = []
+    for _ in range(repeat):
+        execution_time, index = time_call(build_index, database)
+        warm_timings.append(execution_time)
+
+    return database, index, {
+        'cold': timings_summary(cold_timings),
+        'warm': timings_summary(warm_timings),
+    }
+
+
+def bench_queries(find_fn, queries, repeat):
+    timings = []
+    misses = set()
+    for _ in range(repeat):
+        for query in queries:
+            execution_time, result = time_call(find_fn, query)
+            timings.append(execution_time)
+            if result[0] is None:
+                misses.add(query)
+    summary = timings_summary(timings)
+    summary['misses'] = sorted(misses)
+    return summary
+
+
+def bench_specs(padsearch, database, specs, repeat):
+    """Times searches against a database whose monster list is already built (warm).
+
+    The bot builds the list once per load, so only the first search after a reload pays
+    for it; that cost is monster_list_build.
+    """
+    lexer = padsearch.PadSearchLexer().build()
+
+    def make_config(spec):
+        spec_lexer = lexer.clone()
+        spec_lexer.input(spec)
+        return padsearch.SearchConfig(spec_lexer)
+
+    rm_gem_config = make_config('remove( gem)')
+    monsters = database.get_all_monsters_by_no_na()
+
+    per_spec = {}
+    all_timings = []
+    for spec in specs:
+        config = make_config(spec)
+        config.filters.extend(rm_gem_config.filters)
+        limit = padsearch.SEARCH_ALL_LIMIT if config.all else padsearch.SEARCH_LIMIT
+
+        timings = []
+        count_timings = []
+        match_count = None
+        for _ in range(repeat):
+            execution_time, (_, match_count) = time_call(
+                padsearch.search_database, database, config, limit)
+            timings.append(execution_time)
+            # The counting pass on its own, over the whole list
+            execution_time, _ = time_call(padsearch.count_matches, config, monsters)
+            count_timings.append(execution_time)
+        all_timings.extend(timings)
+
+        per_spec[spec] = timings_summary(timings)
+        per_spec[spec]['matches'] = match_count
+        per_spec[spec]['count_only'] = timings_summary(count_timings)
+
+    return {
+        'overall': timings_summary(all_timings),
+        'specs': per_spec,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--red-dir', required=True, help='Red-DiscordBot checkout (for cogs.utils)')
+    parser.add_argument('--fixture-dir', required=True,
+                        help='Folder with dadguide.sqlite and the override CSVs')
+    parser.add_argument('--queries', help='File of ^id queries, one per line')
+    parser.add_argument('--specs', help='File of ^search specs, one per line')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='Write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    dadguide, padsearch = load_cogs(os.path.abspath(args.red_dir), 'dadguide', 'padsearch')
+
+    db_file = os.path.join(args.fixture_dir, 'dadguide.sqlite')
+    overrides = dadguide.load_overrides(
+        os.path.join(args.fixture_dir, 'nicknames.csv'),
+        os.path.join(args.fixture_dir, 'basenames.csv'),
+        os.path.join(args.fixture_dir, 'panthnames.csv'))
+
+    queries = read_lines(args.queries) if args.queries else DEFAULT_QUERIES
+    specs = read_lines(args.specs) if args.specs else DEFAULT_SPECS
+
+    # Cold, so it runs before anything else has loaded the monsters
+    evolution_summary, monster_list_summary = bench_monster_list(dadguide, db_file, args.repeat)
+    database, index, index_summary = bench_index(dadguide, db_file, overrides, args.repeat)
+    try:
+        results = {
+            'evolution_tables_build': evolution_summary,
+            'monster_list_build': monster_list_summary,
+            'monster_index': index_summary,
+            'find_monster': bench_queries(index.find_monster, queries, args.repeat),
+            'find_monster2': bench_queries(index.find_monster2, queries, args.repeat),
+            'search': bench_specs(padsearch, database, specs, args.repeat),
+        }
+    finally:
+        database.close()
+
+    report = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat(),
+            'commit': git_commit(),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'fixture_sha256': file_sha256(db_file),
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
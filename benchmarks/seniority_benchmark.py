@@ -0,0 +1,317 @@
+"""
+Offline benchmark for the seniority points database.
+
+Runs the same operations against several backends, each with its own scratch
+database seeded with synthetic history:
+
+  sqlite3         SeniorityStorage, as the cog uses it
+  sqlite3_legacy  sqlite3 on a dedicated thread, with the version 0 schema (text
+                  dates, REPLACE, four secondary indexes)
+  aioodbc         the aioodbc pool Seniority used originally, with the version 0 schema
+
+Each run times batched point flushes, single-row writes, loading a day's points and
+the grant lookback query. The legacy database is then copied and opened with
+SeniorityStorage, to time the schema migration. No Discord connection is needed.
+
+The ODBC baseline needs aioodbc and the SQLite ODBC driver installed; pass
+--skip-odbc to leave it out.
+
+Usage:
+  python benchmarks/seniority_benchmark.py --red-dir ~/Red-DiscordBot \\
+      --days 90 --users 2000 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import timeit
+from datetime import date, datetime, timedelta
+
+from cog_loader import git_commit, load_cogs, timings_summary
+
+SERVER_IDS = ['1000', '2000']
+CHANNEL_IDS = [str(4000 + i) for i in range(10)]
+
+# The version 0 schema and queries, from before the seniority table was consolidated
+LEGACY_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS seniority(
+      record_date STRING NOT NULL,
+      server_id STRING NOT NULL,
+      channel_id STRING NOT NULL,
+      user_id STRING NOT NULL,
+      points REAL DEFAULT 0,
+      PRIMARY KEY (record_date, server_id, channel_id, user_id))
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_server_id_record_date_user_id ON seniority(server_id, record_date, user_id)',
+    'CREATE INDEX IF NOT EXISTS idx_record_date_server_id_user_id ON seniority(record_date, server_id, user_id)',
+    'CREATE INDEX IF NOT EXISTS idx_record_date_server_id_channel_id_user_id '
+    'ON seniority(record_date, server_id, channel_id, user_id)',
+    'CREATE INDEX IF NOT EXISTS idx_server_id_user_id_record_date ON seniority(server_id, user_id, record_date)',
+]
+
+LEGACY_DAY_POINTS_QUERY = '''
+SELECT server_id, channel_id, user_id, points
+FROM seniority INDEXED BY idx_record_date_server_id_channel_id_user_id
+WHERE record_date = ?
+'''
+
+LEGACY_LOOKBACK_POINTS_QUERY = '''
+SELECT user_id, sum(points) as points
+FROM seniority INDEXED BY idx_server_id_user_id_record_date
+WHERE server_id = ?
+  AND record_date >= ?
+GROUP BY 1
+'''
+
+LEGACY_REPLACE_POINTS_QUERY = '''
+REPLACE INTO seniority(record_date, server_id, channel_id, user_id, points)
+VALUES(?, ?, ?, ?, ?)
+'''
+
+
+class LegacySqliteStorage(object):
+    """sqlite3 on a dedicated thread like SeniorityStorage, but with the version 0 schema."""
+
+    def __init__(self, seniority, db_path, loop):
+        self.storage = seniority.SeniorityStorage(db_path, loop)
+
+    async def open(self):
+        await self.storage.run(self._open)
+
+    def _open(self):
+        con = sqlite3.connect(self.storage.db_path, check_same_thread=False)
+        con.execute('PRAGMA journal_mode = WAL')
+        con.execute('PRAGMA synchronous = NORMAL')
+        with con:
+            for stmt in LEGACY_SCHEMA:
+                con.execute(stmt)
+        self.storage.con = con
+
+    async def close(self):
+        await self.storage.close()
+
+    async def day_points(self, now_date_str):
+        return await self.storage.run(self._fetchall, LEGACY_DAY_POINTS_QUERY, (now_date_str,))
+
+    async def lookback_points(self, server_id, lookback_date_str):
+        return await self.storage.run(self._fetchall, LEGACY_LOOKBACK_POINTS_QUERY,
+                                      (server_id, lookback_date_str))
+
+    async def replace_points(self, rows):
+        await self.storage.run(self._replace_points, rows)
+
+    def _fetchall(self, query, values):
+        return self.storage.con.execute(query, values).fetchall()
+
+    def _replace_points(self, rows):
+        with self.storage.con:
+            self.storage.con.executemany(LEGACY_REPLACE_POINTS_QUERY, rows)
+
+
+class OdbcStorage(object):
+    """The aioodbc pool access Seniority used originally, with the version 0 schema."""
+
+    def __init__(self, db_path, loop):
+        import aioodbc
+        self.aioodbc = aioodbc
+        self.db_path = db_path
+        self.loop = loop
+        self.pool = None
+
+    async def open(self):
+        if os.name != 'nt' and sys.platform != 'win32':
+            dsn = 'Driver=SQLite3;Database=' + self.db_path
+        else:
+            dsn = 'Driver=SQLite3 ODBC Driver;Database=' + self.db_path
+        self.pool = await self.aioodbc.create_pool(dsn=dsn, autocommit=True, loop=self.loop)
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                for stmt in LEGACY_SCHEMA:
+                    await cur.execute(stmt)
+
+    async def close(self):
+        self.pool.close()
+        await self.pool.wait_closed()
+
+    async def fetchall(self, query, *values):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, *values)
+                return await cur.fetchall()
+
+    async def day_points(self, now_date_str):
+        return await self.fetchall(LEGACY_DAY_POINTS_QUERY, now_date_str)
+
+    async def lookback_points(self, server_id, lookback_date_str):
+        return await self.fetchall(LEGACY_LOOKBACK_POINTS_QUERY, server_id, lookback_date_str)
+
+    async def replace_points(self, rows):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('BEGIN')
+                try:
+                    await cur.executemany(LEGACY_REPLACE_POINTS_QUERY, rows)
+                    await cur.execute('COMMIT')
+                except:
+                    await cur.execute('ROLLBACK')
+                    raise
+
+
+def day_rows(rng, day, user_ids, active_fraction):
+    """Synthetic (record_date, server_id, channel_id, user_id, points) rows for one day."""
+    date_str = day.isoformat()
+    rows = []
+    for user_id in user_ids:
+        if rng.random() > active_fraction:
+            continue
+        server_id = rng.choice(SERVER_IDS)
+        for channel_id in rng.sample(CHANNEL_IDS, rng.randint(1, 3)):
+            rows.append((date_str, server_id, channel_id, user_id, round(rng.uniform(0.1, 10), 2)))
+    return rows
+
+
+async def bench_backend(storage, args):
+    rng = random.Random(0)
+    user_ids = [str(10000 + i) for i in range(args.users)]
+    today = date.today()
+
+    await storage.open()
+    try:
+        seed_timings = []
+        seed_rows = 0
+        for offset in range(args.days, 0, -1):
+            rows = day_rows(rng, today - timedelta(days=offset), user_ids, args.active_fraction)
+            for i in range(0, len(rows), args.batch_rows):
+                batch = rows[i:i + args.batch_rows]
+                before_time = timeit.default_timer()
+                await storage.replace_points(batch)
+                seed_timings.append(timeit.default_timer() - before_time)
+                seed_rows += len(batch)
+
+        # Today's points, rewritten the way the flush loop does
+        today_rows = day_rows(rng, today, user_ids, args.active_fraction)
+        flush_timings = []
+        for _ in range(args.repeat):
+            for i in range(0, len(today_rows), args.batch_rows):
+                batch = [r[:4] + (r[4] + rng.random(),) for r in today_rows[i:i + args.batch_rows]]
+                before_time = timeit.default_timer()
+                await storage.replace_points(batch)
+                flush_timings.append(timeit.default_timer() - before_time)
+
+        # One REPLACE per message, as process_message did before batching
+        single_timings = []
+        for row in today_rows[:args.single_rows]:
+            before_time = timeit.default_timer()
+            await storage.replace_points([row])
+            single_timings.append(timeit.default_timer() - before_time)
+
+        day_timings = []
+        for _ in range(args.repeat):
+            before_time = timeit.default_timer()
+            await storage.day_points(today.isoformat())
+            day_timings.append(timeit.default_timer() - before_time)
+
+        lookback_timings = []
+        lookback_date_str = (today - timedelta(days=args.lookback_days)).isoformat()
+        for _ in range(args.repeat):
+            for server_id in SERVER_IDS:
+                before_time = timeit.default_timer()
+                await storage.lookback_points(server_id, lookback_date_str)
+                lookback_timings.append(timeit.default_timer() - before_time)
+    finally:
+        await storage.close()
+
+    seed_summary = timings_summary(seed_timings)
+    return {
+        'seed_batches': seed_summary,
+        'seed_rows': seed_rows,
+        'seed_rows_per_sec': seed_rows / seed_summary['total'] if seed_timings else None,
+        'flush_batches': timings_summary(flush_timings),
+        'single_row_writes': timings_summary(single_timings),
+        'day_points': timings_summary(day_timings),
+        'lookback_points': timings_summary(lookback_timings),
+    }
+
+
+async def bench_migration(seniority, legacy_path, work_dir, loop):
+    """Times opening a copy of a version 0 database with SeniorityStorage."""
+    db_path = os.path.join(work_dir, 'migrated.db')
+    shutil.copy(legacy_path, db_path)
+    storage = seniority.SeniorityStorage(db_path, loop)
+    before_time = timeit.default_timer()
+    await storage.open()
+    execution_time = timeit.default_timer() - before_time
+    await storage.close()
+    return execution_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--red-dir', required=True, help='Red-DiscordBot checkout (for cogs.utils)')
+    parser.add_argument('--days', type=int, default=90, help='Days of seeded history')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--active-fraction', type=float, default=0.3,
+                        help='Share of users earning points on a given day')
+    parser.add_argument('--batch-rows', type=int, default=500)
+    parser.add_argument('--single-rows', type=int, default=500)
+    parser.add_argument('--lookback-days', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--skip-odbc', action='store_true', help='Skip the aioodbc baseline')
+    parser.add_argument('--output', help='Write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    seniority, = load_cogs(os.path.abspath(args.red_dir), 'seniority')
+    loop = asyncio.get_event_loop()
+
+    backends = [
+        ('sqlite3', lambda path: seniority.SeniorityStorage(path, loop)),
+        ('sqlite3_legacy', lambda path: LegacySqliteStorage(seniority, path, loop)),
+    ]
+    if not args.skip_odbc:
+        backends.append(('aioodbc', lambda path: OdbcStorage(path, loop)))
+
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix='rpad_seniority_')
+    try:
+        for name, make_storage in backends:
+            db_path = os.path.join(work_dir, name + '.db')
+            results[name] = loop.run_until_complete(bench_backend(make_storage(db_path), args))
+        results['migration_time'] = loop.run_until_complete(bench_migration(
+            seniority, os.path.join(work_dir, 'sqlite3_legacy.db'), work_dir, loop))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat(),
+            'commit': git_commit(),
+            'python': sys.version,
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'days': args.days,
+            'users': args.users,
+            'active_fraction': args.active_fraction,
+            'batch_rows': args.batch_rows,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
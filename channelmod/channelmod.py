@@ -13,7 +13,7 @@ from discord.ext import commands
 from cogs.utils import checks
 from cogs.utils.chat_formatting import inline, box
 
-from .rpadutils import CogSettings, ReportableError
+from .rpadutils import SqliteCogSettings, ReportableError
 
 
 log = logging.getLogger("red.admin")
@@ -282,7 +282,9 @@ def setup(bot):
     bot.add_listener(n.mirror_reaction_remove, "on_reaction_remove")
 
 
-class ChannelModSettings(CogSettings):
+class ChannelModSettings(SqliteCogSettings):
+    SPLIT_SECTIONS = ('servers', 'mirrored_channels')
+
     def make_default_settings(self):
         config = {
             'servers': {},
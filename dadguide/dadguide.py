@@ -14,6 +14,7 @@ import os
 import re
 import shutil
 import sqlite3 as lite
+import threading
 import traceback
 from _collections import defaultdict, deque, OrderedDict
 from datetime import datetime
@@ -68,6 +69,8 @@ class Dadguide(object):
         self.translated_names = {}
 
         self.database = load_database(None)
+        # Incremented every time a new database is loaded; lets clients invalidate caches
+        self.database_generation = 0
         self.index = None
 
     @asyncio.coroutine
@@ -141,23 +144,11 @@ class Dadguide(object):
             await self._download_files()
         await self._download_override_files()
 
-        nickname_overrides = self._csv_to_tuples(NICKNAME_FILE_PATTERN)
-        basename_overrides = self._csv_to_tuples(BASENAME_FILE_PATTERN)
-        panthname_overrides = self._csv_to_tuples(PANTHNAME_FILE_PATTERN)
-
-        self.nickname_overrides = {x[0].lower(): int(x[1])
-                                   for x in nickname_overrides if x[1].isdigit()}
-
-        self.basename_overrides = defaultdict(set)
-        for x in basename_overrides:
-            k, v = x
-            if k.isdigit():
-                self.basename_overrides[int(k)].add(v.lower())
-
-        self.panthname_overrides = {x[0].lower(): x[1].lower() for x in panthname_overrides}
-        self.panthname_overrides.update({v: v for _, v in self.panthname_overrides.items()})
+        self.nickname_overrides, self.basename_overrides, self.panthname_overrides = load_overrides(
+            NICKNAME_FILE_PATTERN, BASENAME_FILE_PATTERN, PANTHNAME_FILE_PATTERN)
 
         self.database = load_database(self.database)
+        self.database_generation += 1
         self.index = MonsterIndex(self.database, self.nickname_overrides, self.basename_overrides,
                                   self.panthname_overrides)
 
@@ -181,25 +172,6 @@ class Dadguide(object):
         with open(BASENAMES_EXPORT_PATH, 'w', encoding='utf-8') as f:
             json.dump(results, f, sort_keys=True)
 
-    def _csv_to_tuples(self, file_path: str, cols: int = 2):
-        # Loads a two-column CSV into an array of tuples.
-        results = []
-        with open(file_path, encoding='utf-8') as f:
-            file_reader = csv.reader(f, delimiter=',')
-            for row in file_reader:
-                if len(row) < 2:
-                    continue
-
-                data = [None] * cols
-                for i in range(0, min(cols, len(row))):
-                    data[i] = row[i].strip()
-
-                if not len(data[0]):
-                    continue
-
-                results.append(data)
-        return results
-
     async def _download_files(self):
         one_hour_secs = 1 * 60 * 60
         await rpadutils.async_cached_dadguide_request(DB_DUMP_FILE, DB_DUMP_URL, one_hour_secs)
@@ -300,6 +272,49 @@ class DadguideTableNotFound(Exception):
         self.message = '{} not found'.format(table_name)
 
 
+def csv_to_tuples(file_path: str, cols: int = 2):
+    # Loads a two-column CSV into an array of tuples.
+    results = []
+    with open(file_path, encoding='utf-8') as f:
+        file_reader = csv.reader(f, delimiter=',')
+        for row in file_reader:
+            if len(row) < 2:
+                continue
+
+            data = [None] * cols
+            for i in range(0, min(cols, len(row))):
+                data[i] = row[i].strip()
+
+            if not len(data[0]):
+                continue
+
+            results.append(data)
+    return results
+
+
+def load_overrides(nickname_file, basename_file, panthname_file):
+    """Parses the override sheet CSVs into the maps MonsterIndex expects.
+
+    Returns (nickname_overrides, basename_overrides, panthname_overrides).
+    """
+    nickname_tuples = csv_to_tuples(nickname_file)
+    basename_tuples = csv_to_tuples(basename_file)
+    panthname_tuples = csv_to_tuples(panthname_file)
+
+    nickname_overrides = {x[0].lower(): int(x[1]) for x in nickname_tuples if x[1].isdigit()}
+
+    basename_overrides = defaultdict(set)
+    for x in basename_tuples:
+        k, v = x
+        if k.isdigit():
+            basename_overrides[int(k)].add(v.lower())
+
+    panthname_overrides = {x[0].lower(): x[1].lower() for x in panthname_tuples}
+    panthname_overrides.update({v: v for _, v in panthname_overrides.items()})
+
+    return nickname_overrides, basename_overrides, panthname_overrides
+
+
 def load_database(existing_db):
     # Release the handle to the database file if it has one
     if existing_db:
@@ -308,21 +323,37 @@ def load_database(existing_db):
     if os.path.exists(DB_DUMP_FILE):
         shutil.copy2(DB_DUMP_FILE, DB_DUMP_WORKING_FILE)
     # Open the new working copy.
-    return DadguideDatabase(data_file=DB_DUMP_WORKING_FILE)
+    database = DadguideDatabase(data_file=DB_DUMP_WORKING_FILE)
+    # Searches may still be running against the old database after it's closed, so
+    # everything they use is computed here, before the new one is handed out
+    if os.path.exists(DB_DUMP_FILE):
+        try:
+            database.load_evolution_tables()
+        except lite.DatabaseError as ex:
+            print('dadguide failed to load evolution tables', ex)
+    return database
 
 
 class DadguideDatabase(object):
     def __init__(self, data_file=None):
         self._con = None
+        self._monsters_by_no_na = None
+        self._monsters_by_id = None
+        self._cache_lock = threading.Lock()
+        self._evolution_tables = None
 
         if data_file is not None:
-            self._con = lite.connect(data_file, detect_types=lite.PARSE_DECLTYPES)
+            # The connection is only read from, and PadSearch reads it from its worker threads
+            self._con = lite.connect(data_file, detect_types=lite.PARSE_DECLTYPES,
+                                     check_same_thread=False)
             self._con.row_factory = lite.Row
 
     def has_database(self):
         return self._con is not None
 
     def close(self):
+        # The cached monsters and evolution tables are kept, since searches running on
+        # worker threads can still be filtering this database's monsters
         self._con.close()
         self._con = None
 
@@ -473,40 +504,16 @@ class DadguideDatabase(object):
             DgDungeon)
 
     def monster_is_farmable(self, monster_id):
-        return self._query_one(
-            self._select_builder(
-                tables={DgDrop.TABLE: DgDrop.FIELDS},
-                where='{0}.monster_id=?'.format(DgDrop.TABLE)
-            ),
-            (monster_id,),
-            DgDrop) is not None
+        return monster_id in self._get_evolution_tables().farmable_ids
 
     def monster_in_rem(self, monster_id):
-        return self._query_one(
-            self._select_builder(
-                tables={DgMonster.TABLE: ('rem_egg',)},
-                where='{0}.monster_id=? AND rem_egg=1'.format(DgMonster.TABLE)
-            ),
-            (monster_id,),
-            DgDrop) is not None
+        return monster_id in self._get_evolution_tables().rem_ids
 
     def monster_in_pem(self, monster_id):
-        return self._query_one(
-            self._select_builder(
-                tables={DgMonster.TABLE: ('pal_egg',)},
-                where='{0}.monster_id=? AND pal_egg=1'.format(DgMonster.TABLE)
-            ),
-            (monster_id,),
-            DgDrop) is not None
+        return monster_id in self._get_evolution_tables().pem_ids
 
     def monster_in_mp_shop(self, monster_id):
-        return self._query_one(
-            self._select_builder(
-                tables={DgMonster.TABLE: ('buy_mp',)},
-                where='{0}.monster_id=? AND buy_mp IS NOT NULL'.format(DgMonster.TABLE)
-            ),
-            (monster_id,),
-            DgDrop) is not None
+        return monster_id in self._get_evolution_tables().mp_shop_ids
 
     def get_prev_evolution_by_monster(self, monster_id):
         return self._query_one(
@@ -537,28 +544,27 @@ class DadguideDatabase(object):
             DgEvolution)
 
     def get_base_monster_ids(self):
-        SELECT_BASE_MONSTER_ID = '''
-            SELECT evolutions.from_id as monster_id FROM evolutions WHERE evolutions.from_id NOT IN (SELECT DISTINCT evolutions.to_id FROM evolutions)
-            UNION
-            SELECT monsters.monster_id FROM monsters WHERE monsters.monster_id NOT IN (SELECT evolutions.from_id FROM evolutions UNION SELECT evolutions.to_id FROM evolutions)'''
-        return self._query_many(
-            SELECT_BASE_MONSTER_ID,
-            (),
-            DictWithAttrAccess,
-            as_generator=True)
+        """Ids of every monster that is the root of an evolution tree, ascending."""
+        return self._get_evolution_tables().base_ids
+
+    def get_base_monster_id(self, monster_id):
+        return self._get_evolution_tables().base_id.get(monster_id, monster_id)
 
     def get_evolution_tree_ids(self, base_monster_id):
-        # is not a tree i lied
-        base_id = base_monster_id
-        evolution_tree = [base_id]
-        n_evos = deque()
-        n_evos.append(base_id)
-        while len(n_evos) > 0:
-            n_evo_id = n_evos.popleft()
-            for e in self.get_next_evolutions_by_monster(n_evo_id):
-                n_evos.append(e.to_id)
-                evolution_tree.append(e.to_id)
-        return evolution_tree
+        tables = self._get_evolution_tables()
+        tree = tables.tree.get(base_monster_id)
+        if tree is None:
+            tree = tables.compute_tree(base_monster_id)
+        return tree
+
+    def load_evolution_tables(self):
+        """Computes the evolution tables; load_database does this once per database load."""
+        self._evolution_tables = EvolutionTables(self._con)
+
+    def _get_evolution_tables(self):
+        if self._evolution_tables is None:
+            raise rpadutils.ReportableError('Dadguide data is still loading, try again later')
+        return self._evolution_tables
 
     def monster_id_to_no(self, monster_id, region=Server.JP):
         res = self._query_one(
@@ -624,6 +630,94 @@ class DadguideDatabase(object):
         return self._query_many(self._select_builder(tables={DgMonster.TABLE: DgMonster.FIELDS}), (), DgMonster,
                                 as_generator=as_generator)
 
+    def get_all_monsters_by_no_na(self):
+        """All monsters, highest monster_no_na first.
+
+        Built once per database load; building a DgMonster is expensive, so searches should
+        iterate this instead of calling get_all_monsters each time.
+        """
+        self._load_monster_caches()
+        return self._monsters_by_no_na
+
+    def get_monsters_by_id(self, monster_ids):
+        """Looks up monsters in the cached monster list, in the order given."""
+        self._load_monster_caches()
+        return [self._monsters_by_id[x] for x in monster_ids]
+
+    def _load_monster_caches(self):
+        with self._cache_lock:
+            if self._monsters_by_no_na is None:
+                monsters = list(self.get_all_monsters())
+                monsters.sort(key=lambda m: m.monster_no_na, reverse=True)
+                self._monsters_by_id = {m.monster_id: m for m in monsters}
+                self._monsters_by_no_na = monsters
+
+
+class EvolutionTables(object):
+    """Evolution relationships for every monster, computed in one pass per database load.
+
+    base_id maps each monster_id to the root of its evolution tree, and tree maps each root
+    to every monster_id in the tree (root first, breadth first). The *_ids sets hold the
+    monsters that are obtainable in each way.
+    """
+
+    def __init__(self, con):
+        self.prev_id = {}
+        self.next_ids = defaultdict(list)
+        for row in con.execute('SELECT from_id, to_id FROM evolutions'):
+            # Match the first-row-wins behavior of get_prev_evolution_by_monster
+            self.prev_id.setdefault(row['to_id'], row['from_id'])
+            self.next_ids[row['from_id']].append(row['to_id'])
+
+        monster_ids = set(self.next_ids.keys())
+        self.rem_ids = set()
+        self.pem_ids = set()
+        self.mp_shop_ids = set()
+        for row in con.execute('SELECT monster_id, rem_egg, pal_egg, buy_mp FROM monsters'):
+            monster_id = row['monster_id']
+            monster_ids.add(monster_id)
+            if row['rem_egg'] == 1:
+                self.rem_ids.add(monster_id)
+            if row['pal_egg'] == 1:
+                self.pem_ids.add(monster_id)
+            if row['buy_mp'] is not None:
+                self.mp_shop_ids.add(monster_id)
+
+        self.farmable_ids = set(row['monster_id'] for row in
+                                con.execute('SELECT DISTINCT monster_id FROM drops'))
+
+        self.base_id = {}
+        for monster_id in monster_ids:
+            self.base_id[monster_id] = self._find_base(monster_id)
+
+        self.base_ids = sorted(x for x in monster_ids if x not in self.prev_id)
+        self.tree = {x: self.compute_tree(x) for x in self.base_ids}
+
+    def _find_base(self, monster_id):
+        seen = {monster_id}
+        base_id = monster_id
+        while base_id in self.prev_id:
+            if base_id in self.base_id:
+                return self.base_id[base_id]
+            base_id = self.prev_id[base_id]
+            if base_id in seen:
+                # Bad data; don't loop forever
+                break
+            seen.add(base_id)
+        return base_id
+
+    def compute_tree(self, base_monster_id):
+        # is not a tree i lied
+        evolution_tree = [base_monster_id]
+        n_evos = deque()
+        n_evos.append(base_monster_id)
+        while len(n_evos) > 0:
+            n_evo_id = n_evos.popleft()
+            for to_id in self.next_ids.get(n_evo_id, []):
+                n_evos.append(to_id)
+                evolution_tree.append(to_id)
+        return evolution_tree
+
 
 def enum_or_none(enum, value, default=None):
     if value is not None:
@@ -809,12 +903,7 @@ class DgMonster(DadguideItem):
 
         self.is_equip = any([x.awoken_skill_id == 49 for x in self.awakenings])
 
-        base_id = self.monster_id
-        next_base = self._database.get_prev_evolution_by_monster(base_id)
-        while next_base is not None:
-            base_id = next_base.from_id
-            next_base = self._database.get_prev_evolution_by_monster(base_id)
-        self._base_monster_id = base_id
+        self._base_monster_id = self._database.get_base_monster_id(self.monster_id)
         self._alt_evo_id_list = self._database.get_evolution_tree_ids(self._base_monster_id)
 
         self.search = MonsterSearchHelper(self)
@@ -919,24 +1008,15 @@ class DgMonster(DadguideItem):
 
     @property
     def farmable_evo(self):
-        for e_id in self._alt_evo_id_list:
-            if self._database.monster_is_farmable(e_id):
-                return True
-        return False
+        return any(self._database.monster_is_farmable(e_id) for e_id in self._alt_evo_id_list)
 
     @property
     def rem_evo(self):
-        for e_id in self._alt_evo_id_list:
-            if self._database.monster_in_rem(e_id):
-                return True
-        return False
+        return any(self._database.monster_in_rem(e_id) for e_id in self._alt_evo_id_list)
 
     @property
     def pem_evo(self):
-        for e_id in self._alt_evo_id_list:
-            if self._database.monster_in_pem(e_id):
-                return True
-        return False
+        return any(self._database.monster_in_pem(e_id) for e_id in self._alt_evo_id_list)
 
     @property
     def killers(self):
@@ -962,10 +1042,7 @@ class DgMonster(DadguideItem):
 
     @property
     def mp_evo(self):
-        for e_id in self._alt_evo_id_list:
-            if self._database.monster_in_mp_shop(e_id):
-                return True
-        return False
+        return any(self._database.monster_in_mp_shop(e_id) for e_id in self._alt_evo_id_list)
 
     @property
     def history_us(self):
@@ -1139,11 +1216,10 @@ class MonsterIndex(object):
             monster_id_to_nicknames[monster_id].add(nickname)
 
         named_monsters = []
-        for base_mon in base_monster_ids:
-            base_id = base_mon.monster_id
+        for base_id in base_monster_ids:
             group_basename_overrides = basename_overrides.get(base_id, [])
-            evolution_tree = [monster_database.get_monster(m) for m in
-                              monster_database.get_evolution_tree_ids(base_id)]
+            evolution_tree = monster_database.get_monsters_by_id(
+                monster_database.get_evolution_tree_ids(base_id))
             named_mg = NamedMonsterGroup(evolution_tree, group_basename_overrides)
             for monster in evolution_tree:
                 if accept_filter and not accept_filter(monster):
@@ -9,7 +9,7 @@ from __main__ import send_cmd_help
 from __main__ import settings
 
 from . import rpadutils
-from .rpadutils import CogSettings
+from .rpadutils import SqliteCogSettings
 from .utils import checks
 from .utils.chat_formatting import *
 
@@ -87,7 +87,7 @@ def setup(bot):
     bot.add_cog(n)
 
 
-class ModNotesSettings(CogSettings):
+class ModNotesSettings(SqliteCogSettings):
     def make_default_settings(self):
         config = {
             'servers': {}
@@ -1,10 +1,15 @@
+import asyncio
+from collections import defaultdict, deque, OrderedDict
+import concurrent.futures
+import itertools
 import json
 import math
+import time
+import timeit
 
 import discord
 from discord.ext import commands
 from ply import lex, yacc
-from png import itertools
 
 from __main__ import user_allowed, send_cmd_help
 
@@ -56,6 +61,18 @@ Multiple instance filters
 * convert(c1, c2) : Convert from color 1 to color 2, accepts any as entry as well
 """
 
+# Result caps for a normal search and for an 'all' search
+SEARCH_LIMIT = 10
+SEARCH_ALL_LIMIT = 200
+
+# Searches run on a small worker pool so a slow spec can't stall the event loop
+SEARCH_WORKERS = 2
+SEARCH_TIMEOUT_SECS = 10
+MAX_SEARCHES_PER_USER = 2
+
+# Number of search results to remember per Dadguide database generation
+SEARCH_CACHE_SIZE = 500
+
 COLORS = [
     'fire',
     'water',
@@ -606,6 +623,49 @@ class SearchConfig(object):
         if not self.filters:
             raise rpadutils.ReportableError('You need to specify at least one filter')
 
+    def cache_key(self):
+        """A canonical form of this config, equal for specs that match the same monsters.
+
+        Multiple instance filters are OR'd together, so their order doesn't matter.
+        """
+        def flag(value):
+            return bool(value)
+
+        def values(items):
+            return tuple(sorted(set(x.lower() for x in items)))
+
+        return (
+            self.all,
+            self.cd,
+            flag(self.farmable),
+            self.haste,
+            flag(self.inheritable),
+            flag(self.shuffle),
+            flag(self.unlock),
+            flag(self.resolve),
+            self.delay,
+            self.combo,
+            flag(self.absorbnull),
+            flag(self.attabsorb),
+            self.shield,
+            self.hp,
+            self.atk,
+            self.rcv,
+            self.weighted,
+            values(self.active),
+            tuple(sorted(set(tuple(sorted(colors)) for colors in self.board))),
+            values(self.column),
+            values(self.color),
+            values(self.hascolor),
+            values(self.leader),
+            values(self.name),
+            values(self.row),
+            values(self.types),
+            values(self.remove),
+            # Only the first convert is used
+            tuple(self.convert[0]) if self.convert else (),
+        )
+
     def check_filters(self, m):
         for f in self.filters:
             if not f(m):
@@ -629,11 +689,71 @@ class SearchConfig(object):
         return new_value
 
 
+def find_matches(config, monsters, limit, deadline=None):
+    """Returns up to limit monsters that pass config, and the total number of matches.
+
+    monsters must already be in display order. Matches are only collected until there are
+    limit of them; the rest of the list is just counted, without building any results.
+
+    If deadline (a time.monotonic() value) is set, the search gives up once it passes.
+    """
+    if deadline is not None:
+        monsters = _until_deadline(monsters, deadline)
+    # filter only pulls monsters as islice asks for them, so the count picks up right
+    # after the last collected match
+    remaining = iter(monsters)
+    top_matches = list(itertools.islice(filter(config.check_filters, remaining), limit))
+    return top_matches, len(top_matches) + count_matches(config, remaining)
+
+
+def count_matches(config, monsters):
+    """Counts the monsters that pass config, without collecting them."""
+    return sum(map(config.check_filters, monsters))
+
+
+class SearchTimeout(rpadutils.ReportableError):
+    def __init__(self):
+        super(SearchTimeout, self).__init__('Search took too long, try a more specific search')
+
+
+def _until_deadline(monsters, deadline):
+    for idx, m in enumerate(monsters):
+        if idx % 100 == 0 and time.monotonic() > deadline:
+            raise SearchTimeout()
+        yield m
+
+
+def search_database(database, config, limit, deadline=None):
+    """Runs a search against the full monster list. Called from the search worker pool."""
+    monsters = database.get_all_monsters_by_no_na()
+    return find_matches(config, monsters, limit, deadline=deadline)
+
+
 class PadSearch:
     """PAD data searching."""
 
     def __init__(self, bot):
         self.bot = bot
+        # Building the lexer is expensive, so build it once and clone it per search
+        self.lexer = PadSearchLexer().build()
+        # Removes entries with names that have gems in them
+        self.rm_gem_config = self._make_search_config('remove( gem)')
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
+        # Search key -> future, so identical searches running at the same time share a result
+        self.running_searches = {}
+        self.user_search_counts = defaultdict(int)
+        self.queue_size = 0
+        self.timeout_count = 0
+        self.search_timing = deque(maxlen=1000)
+
+        # LRU of search key -> (monster ids, match count), cleared when Dadguide reloads
+        self.search_cache = OrderedDict()
+        self.search_cache_generation = None
+        self.cache_hits = 0
+
+    def __unload(self):
+        self.executor.shutdown(wait=False)
 
     @commands.command(pass_context=True)
     async def helpsearch(self, ctx):
@@ -654,29 +774,23 @@ class PadSearch:
             except:
                 # If it still failed, raise the original exception
                 raise ex
-        dg_cog = self.bot.get_cog('Dadguide')
-        monsters = dg_cog.database.get_all_monsters()
-        matched_monsters = list(filter(config.check_filters, monsters))
-
-        # Removing entry with names that have gems in it
-        rmvGemFilter = self._make_search_config('remove( gem)')
-        matched_monsters = list(filter(rmvGemFilter.check_filters, matched_monsters))
+        config.filters.extend(self.rm_gem_config.filters)
 
-        matched_monsters.sort(key=lambda m: m.monster_no_na, reverse=True)
+        limit = SEARCH_ALL_LIMIT if config.all else SEARCH_LIMIT
+        search_key = config.cache_key()
+        matched_monsters, match_count = await self._cached_search(ctx, search_key, config, limit)
 
-        msg = 'Matched {} monsters'.format(len(matched_monsters))
+        msg = 'Matched {} monsters'.format(match_count)
         dm_required = False
-        if len(matched_monsters) > 10:
+        if match_count > SEARCH_LIMIT:
             if not config.all:
-                msg += " (limited to 10, use 'all' to get more)"
-                matched_monsters = matched_monsters[0:10]
+                msg += " (limited to {}, use 'all' to get more)".format(SEARCH_LIMIT)
             else:
                 dm_required = True
                 header = msg
 
-            if len(matched_monsters) > 200:
-                msg += " (limited to 200)"
-                matched_monsters = matched_monsters[0:200]
+                if match_count > SEARCH_ALL_LIMIT:
+                    msg += " (limited to {})".format(SEARCH_ALL_LIMIT)
 
         for m in matched_monsters:
             msg += '\n\tNo. {} {}'.format(m.monster_no_na, m.name_na)
@@ -689,8 +803,86 @@ class PadSearch:
         else:
             await self.bot.say(box(msg))
 
+    async def _cached_search(self, ctx, search_key, config, limit):
+        dg_cog = self.bot.get_cog('Dadguide')
+        generation = dg_cog.database_generation
+        if generation != self.search_cache_generation:
+            self.search_cache.clear()
+            self.search_cache_generation = generation
+
+        cached = self.search_cache.get(search_key)
+        if cached is not None:
+            self.search_cache.move_to_end(search_key)
+            self.cache_hits += 1
+            monster_ids, match_count = cached
+            return dg_cog.database.get_monsters_by_id(monster_ids), match_count
+
+        matched_monsters, match_count = await self._run_search(ctx, search_key, config, limit)
+
+        # Don't cache results computed against a database that was swapped out mid-search
+        if generation == dg_cog.database_generation:
+            self.search_cache[search_key] = ([m.monster_id for m in matched_monsters], match_count)
+            if len(self.search_cache) > SEARCH_CACHE_SIZE:
+                self.search_cache.popitem(last=False)
+
+        return matched_monsters, match_count
+
+    async def _run_search(self, ctx, search_key, config, limit):
+        user_id = ctx.message.author.id
+        if self.user_search_counts[user_id] >= MAX_SEARCHES_PER_USER:
+            raise rpadutils.ReportableError('You already have searches running, wait for them to finish')
+
+        future = self.running_searches.get(search_key)
+        if future is None:
+            database = self.bot.get_cog('Dadguide').database
+            deadline = time.monotonic() + SEARCH_TIMEOUT_SECS
+            future = self.bot.loop.run_in_executor(
+                self.executor, search_database, database, config, limit, deadline)
+            self.running_searches[search_key] = future
+            self.queue_size += 1
+
+            def search_done(f, search_key=search_key):
+                self.queue_size -= 1
+                if self.running_searches.get(search_key) is f:
+                    self.running_searches.pop(search_key)
+
+            future.add_done_callback(search_done)
+
+        self.user_search_counts[user_id] += 1
+        before_time = timeit.default_timer()
+        try:
+            # Shielded because other users may be waiting on the same search
+            return await asyncio.wait_for(asyncio.shield(future), SEARCH_TIMEOUT_SECS + 1)
+        except SearchTimeout:
+            self.timeout_count += 1
+            raise
+        except asyncio.TimeoutError:
+            self.timeout_count += 1
+            raise SearchTimeout()
+        finally:
+            self.user_search_counts[user_id] -= 1
+            if not self.user_search_counts[user_id]:
+                self.user_search_counts.pop(user_id)
+            self.search_timing.append(timeit.default_timer() - before_time)
+
+    @commands.command(pass_context=True)
+    @checks.is_owner()
+    async def searchtiming(self, ctx):
+        """Latency and queue stats for recent searches."""
+        size = len(self.search_timing)
+        if size == 0:
+            await self.bot.say(inline('No searches yet, queue_size={}'.format(self.queue_size)))
+            return
+        avg_time = round(sum(self.search_timing) / size, 4)
+        max_time = round(max(self.search_timing), 4)
+        min_time = round(min(self.search_timing), 4)
+        await self.bot.say(inline(
+            '{} searches, min={} max={} avg={} queue_size={} timeouts={} cache_hits={} cache_size={}'.format(
+                size, min_time, max_time, avg_time, self.queue_size, self.timeout_count,
+                self.cache_hits, len(self.search_cache))))
+
     def _make_search_config(self, input):
-        lexer = PadSearchLexer().build()
+        lexer = self.lexer.clone()
         lexer.input(input)
         return SearchConfig(lexer)
 
@@ -1,10 +1,14 @@
 import asyncio
+import atexit
+import collections
 import concurrent.futures
 import inspect
 import json
 import os
 import re
+import sqlite3
 import time
+import timeit
 import unicodedata
 import urllib
 
@@ -530,22 +534,56 @@ def clean_global_mentions(content):
     return re.sub(r'(@)(\w)', '\\g<1>\u200b\\g<2>', content)
 
 
+# Changes to settings are written this long after the first unsaved one
+SETTINGS_FLUSH_DELAY_SECS = 5
+
+# CogSettings with changes that haven't been written yet, by file path
+_unsaved_settings = {}
+
+
+def flush_settings(file_path=None):
+    """Writes unsaved CogSettings changes now, for one file or all of them."""
+    if file_path is None:
+        pending = list(_unsaved_settings.values())
+    else:
+        pending = [_unsaved_settings[file_path]] if file_path in _unsaved_settings else []
+    for cog_settings in pending:
+        cog_settings.flush()
+
+
+atexit.register(flush_settings)
+
+
+def save_json_atomic(file_path, data):
+    """Writes json to a temp file and renames it over file_path, so a crash leaves the old or new file."""
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4, sort_keys=True, separators=(',', ' : '))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
 class CogSettings:
     BASE_DATA_PATH = "data"
     SETTINGS_FILE_NAME = "settings.json"
 
     def __init__(self, cog_name):
         self.folder = CogSettings.BASE_DATA_PATH + "/" + cog_name
-        self.file_path = self.folder + "/" + CogSettings.SETTINGS_FILE_NAME
+        self.file_path = self.folder + "/" + self.SETTINGS_FILE_NAME
+        self.dirty = False
+        self.flush_handle = None
 
         self.check_folder()
+        # The instance from before a cog reload may not have written its changes yet
+        flush_settings(self.file_path)
 
         self.default_settings = self.make_default_settings()
-        if not fileIO(self.file_path, "check"):
+        current = self.load_settings()
+        if current is None:
             self.bot_settings = self.default_settings
             self.save_settings()
         else:
-            current = fileIO(self.file_path, "load")
             updated = False
             for key in self.default_settings.keys():
                 if key not in current.keys():
@@ -561,8 +599,48 @@ class CogSettings:
             print("Creating " + self.folder)
             os.makedirs(self.folder)
 
+    def load_settings(self):
+        """Returns the saved settings, or None if nothing has been saved yet."""
+        if not fileIO(self.file_path, "check"):
+            return None
+        return fileIO(self.file_path, "load")
+
+    def write_settings(self):
+        save_json_atomic(self.file_path, self.bot_settings)
+
     def save_settings(self):
-        fileIO(self.file_path, "save", self.bot_settings)
+        """Marks the settings changed; they're written to disk shortly after.
+
+        Changes made in the meantime are written along with them, so hot paths can
+        call this freely. Use flush() when they need to be on disk immediately.
+        """
+        self.dirty = True
+        _unsaved_settings[self.file_path] = self
+        if self.flush_handle is None:
+            try:
+                self.flush_handle = asyncio.get_event_loop().call_later(
+                    SETTINGS_FLUSH_DELAY_SECS, self.flush)
+            except RuntimeError:
+                # No usable event loop, e.g. on a worker thread or during shutdown
+                self.flush()
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.dirty:
+            return
+
+        self.dirty = False
+        if _unsaved_settings.get(self.file_path) is self:
+            _unsaved_settings.pop(self.file_path)
+        try:
+            self.write_settings()
+        except Exception as ex:
+            # Try again on the next save or at exit
+            print('Failed to save settings to', self.file_path, ex)
+            self.dirty = True
+            _unsaved_settings[self.file_path] = self
 
     def make_default_settings(self):
         return {}
@@ -579,6 +657,265 @@ class CogSettings:
         return settings[server_id]
 
 
+SETTINGS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS settings(
+  section TEXT NOT NULL,
+  key TEXT NOT NULL,
+  value TEXT NOT NULL,
+  PRIMARY KEY (section, key))
+WITHOUT ROWID
+'''
+
+# Whole sections are stored under this key
+SECTION_KEY = ''
+
+
+class TrackingDict(dict):
+    """A dict that records which keys may have changed since the last write.
+
+    Any access that hands out a value counts, since the caller may modify it in place.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TrackingDict, self).__init__(*args, **kwargs)
+        self.touched = set()
+        self.deleted = set()
+
+    def clear_tracking(self):
+        self.touched.clear()
+        self.deleted.clear()
+
+    def __getitem__(self, key):
+        value = super(TrackingDict, self).__getitem__(key)
+        self.touched.add(key)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            self.touched.add(key)
+        return super(TrackingDict, self).get(key, default)
+
+    def setdefault(self, key, default=None):
+        self.touched.add(key)
+        self.deleted.discard(key)
+        return super(TrackingDict, self).setdefault(key, default)
+
+    def __setitem__(self, key, value):
+        self.touched.add(key)
+        self.deleted.discard(key)
+        super(TrackingDict, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super(TrackingDict, self).__delitem__(key)
+        self.touched.discard(key)
+        self.deleted.add(key)
+
+    def pop(self, key, *args):
+        if key in self:
+            self.touched.discard(key)
+            self.deleted.add(key)
+        return super(TrackingDict, self).pop(key, *args)
+
+    def popitem(self):
+        key, value = super(TrackingDict, self).popitem()
+        self.touched.discard(key)
+        self.deleted.add(key)
+        return key, value
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        self.touched.update(other)
+        self.deleted.difference_update(other)
+        super(TrackingDict, self).update(other)
+
+    def clear(self):
+        self.deleted.update(self)
+        self.touched.clear()
+        super(TrackingDict, self).clear()
+
+    def values(self):
+        self.touched.update(self)
+        return super(TrackingDict, self).values()
+
+    def items(self):
+        self.touched.update(self)
+        return super(TrackingDict, self).items()
+
+    def copy(self):
+        self.touched.update(self)
+        return super(TrackingDict, self).copy()
+
+
+class SettingsDocument(TrackingDict):
+    """Top level settings whose sections are read from the database on first use.
+
+    Split sections are kept as TrackingDicts, so their keys are tracked as well.
+    """
+
+    def __init__(self, load_section, section_names, split_sections):
+        super(SettingsDocument, self).__init__((name, None) for name in section_names)
+        self.load_section = load_section
+        self.unloaded = set(section_names)
+        self.split_sections = split_sections
+        # Split sections that were assigned as a whole, so all of their rows get rewritten
+        self.replaced = set()
+
+    def loaded_sections(self):
+        return [(k, dict.__getitem__(self, k)) for k in self if k not in self.unloaded]
+
+    def clear_tracking(self):
+        super(SettingsDocument, self).clear_tracking()
+        self.replaced.clear()
+        for key, value in self.loaded_sections():
+            if key in self.split_sections:
+                value.clear_tracking()
+
+    def _load(self, key):
+        if key in self.unloaded:
+            self.unloaded.discard(key)
+            dict.__setitem__(self, key, self.load_section(key))
+
+    def _load_all(self):
+        for key in list(self.unloaded):
+            self._load(key)
+
+    def __getitem__(self, key):
+        self._load(key)
+        return super(SettingsDocument, self).__getitem__(key)
+
+    def get(self, key, default=None):
+        self._load(key)
+        return super(SettingsDocument, self).get(key, default)
+
+    def setdefault(self, key, default=None):
+        self._load(key)
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def __setitem__(self, key, value):
+        self.unloaded.discard(key)
+        if key in self.split_sections:
+            value = TrackingDict(value)
+            self.replaced.add(key)
+        super(SettingsDocument, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.unloaded.discard(key)
+        super(SettingsDocument, self).__delitem__(key)
+
+    def pop(self, key, *args):
+        self._load(key)
+        self.unloaded.discard(key)
+        return super(SettingsDocument, self).pop(key, *args)
+
+    def popitem(self):
+        self._load_all()
+        return super(SettingsDocument, self).popitem()
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        self.unloaded.clear()
+        super(SettingsDocument, self).clear()
+
+    def values(self):
+        self._load_all()
+        return super(SettingsDocument, self).values()
+
+    def items(self):
+        self._load_all()
+        return super(SettingsDocument, self).items()
+
+    def copy(self):
+        self._load_all()
+        return super(SettingsDocument, self).copy()
+
+
+class SqliteCogSettings(CogSettings):
+    """CogSettings stored as rows in data/<cog>/settings.db rather than one json file.
+
+    Each top level section is a row, except those named in SPLIT_SECTIONS, which get
+    a row per key (e.g. per server id). Only rows that may have changed since the last
+    write are saved, and a section isn't read until it's first used. An existing
+    settings.json is imported the first time, and renamed to settings.json.migrated.
+
+    Changes are tracked through accesses to bot_settings, so don't hold on to a
+    section across saves; look it up again from bot_settings.
+    """
+    SETTINGS_FILE_NAME = "settings.db"
+    SPLIT_SECTIONS = ('servers',)
+
+    def load_settings(self):
+        self.con = sqlite3.connect(self.file_path)
+        self.con.execute('PRAGMA journal_mode = WAL')
+        with self.con:
+            self.con.execute(SETTINGS_SCHEMA)
+
+        if self.con.execute('PRAGMA user_version').fetchone()[0] == 0:
+            return self.migrate_json()
+
+        section_names = [row[0] for row in self.con.execute('SELECT DISTINCT section FROM settings')]
+        return SettingsDocument(self.load_section, section_names, self.SPLIT_SECTIONS)
+
+    def migrate_json(self):
+        json_path = self.folder + "/" + CogSettings.SETTINGS_FILE_NAME
+        flush_settings(json_path)
+
+        document = SettingsDocument(self.load_section, [], self.SPLIT_SECTIONS)
+        if fileIO(json_path, "check"):
+            print('Migrating {} to {}'.format(json_path, self.file_path))
+            document.update(fileIO(json_path, "load"))
+        self.write_document(document, 'PRAGMA user_version = 1')
+        if os.path.exists(json_path):
+            os.replace(json_path, json_path + '.migrated')
+        return document
+
+    def load_section(self, section):
+        rows = self.con.execute('SELECT key, value FROM settings WHERE section = ?', (section,))
+        if section in self.SPLIT_SECTIONS:
+            return TrackingDict((key, json.loads(value)) for key, value in rows)
+        for _, value in rows:
+            return json.loads(value)
+        return None
+
+    def write_settings(self):
+        self.write_document(self.bot_settings)
+
+    def write_document(self, document, *extra_statements):
+        delete_section = 'DELETE FROM settings WHERE section = ?'
+        delete_row = 'DELETE FROM settings WHERE section = ? AND key = ?'
+        upsert_row = 'REPLACE INTO settings(section, key, value) VALUES(?, ?, ?)'
+
+        with self.con:
+            for section in document.deleted:
+                self.con.execute(delete_section, (section,))
+
+            for section, value in document.loaded_sections():
+                if section in self.SPLIT_SECTIONS:
+                    if section in document.replaced:
+                        self.con.execute(delete_section, (section,))
+                        keys = list(value.keys())
+                    else:
+                        keys = value.touched
+                        self.con.executemany(delete_row, [(section, str(k)) for k in value.deleted])
+                    self.con.executemany(upsert_row, [
+                        (section, str(k), serialize_setting(dict.__getitem__(value, k))) for k in keys])
+                elif section in document.touched:
+                    self.con.execute(upsert_row, (section, SECTION_KEY, serialize_setting(value)))
+
+            for statement in extra_statements:
+                self.con.execute(statement)
+
+        document.clear_tracking()
+
+
+def serialize_setting(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
 def get_prefix(bot, server, text):
     for p in bot.settings.get_prefixes(server):
         if text.startswith(p):
@@ -653,3 +990,147 @@ async def translate_jp_en(bot, jp_text):
     if not translate_cog:
         return None
     return await run_in_loop(bot, translate_cog.translate_jp_en, jp_text)
+
+
+class BulkMemberUpdate(object):
+    """Applies an async update (e.g. adding a role) to many members, several at a time.
+
+    Up to `concurrency` updates are in flight at once. When Discord rate limits a
+    request the window is halved and every worker pauses for the Retry-After the
+    response asked for; the window then grows back by one for every `concurrency`
+    updates that succeed. Rate limited and 5xx responses are retried up to
+    max_retries times with exponential backoff; other failures count as errors.
+
+    progress_fn, if given, is awaited with this object every progress_secs while
+    running, and once at the end; status() describes it.
+    """
+
+    RETRY_BASE_SECS = 1
+    DEFAULT_RETRY_AFTER_SECS = 5
+
+    def __init__(self, members, update_fn, skip_fn=None, concurrency=5, max_retries=3,
+                 progress_fn=None, progress_secs=15):
+        self.update_fn = update_fn
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.progress_fn = progress_fn
+        self.progress_secs = progress_secs
+
+        self.pending = collections.deque()
+        self.skipped = 0
+        for m in members:
+            if skip_fn and skip_fn(m):
+                self.skipped += 1
+            else:
+                self.pending.append((m, 0))
+        self.total = len(self.pending)
+
+        self.window = concurrency
+        self.successes_since_limit = 0
+        self.resume_at = 0
+        self.in_flight = 0
+        self.changed = 0
+        self.errors = 0
+        self.retries = 0
+        self.rate_limits = 0
+        self.start_time = None
+        self.end_time = None
+
+    def elapsed(self):
+        end_time = self.end_time or timeit.default_timer()
+        return end_time - self.start_time if self.start_time else 0
+
+    def status(self):
+        elapsed = self.elapsed()
+        rate = self.changed / elapsed if elapsed else 0
+        return ('changed={}/{} skipped={} errors={} retries={} rate_limited={} window={} '
+                '({}/s, {}s elapsed)').format(
+            self.changed, self.total, self.skipped, self.errors, self.retries, self.rate_limits,
+            self.window, round(rate, 2), round(elapsed))
+
+    async def run(self):
+        self.start_time = timeit.default_timer()
+        loop = asyncio.get_event_loop()
+        workers = [loop.create_task(self._worker(i)) for i in range(self.concurrency)]
+        try:
+            pending_workers = workers
+            while pending_workers:
+                _, pending_workers = await asyncio.wait(pending_workers, timeout=self.progress_secs)
+                if pending_workers and self.progress_fn:
+                    await self.progress_fn(self)
+        finally:
+            for w in workers:
+                w.cancel()
+        self.end_time = timeit.default_timer()
+        if self.progress_fn:
+            await self.progress_fn(self)
+        return self
+
+    async def _worker(self, index: int):
+        while self.pending or self.in_flight:
+            delay = self.resume_at - timeit.default_timer()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            if index >= self.window or not self.pending:
+                # Outside the current window, or waiting on a retry another worker may queue
+                await asyncio.sleep(self.RETRY_BASE_SECS)
+                continue
+
+            member, attempt = self.pending.popleft()
+            self.in_flight += 1
+            try:
+                await self.update_fn(member)
+                self.changed += 1
+                self._on_success()
+            except discord.HTTPException as ex:
+                await self._on_failure(member, attempt, ex)
+            except Exception:
+                self.errors += 1
+            finally:
+                self.in_flight -= 1
+
+    def _on_success(self):
+        self.successes_since_limit += 1
+        if self.window < self.concurrency and self.successes_since_limit >= self.concurrency:
+            self.window += 1
+            self.successes_since_limit = 0
+
+    async def _on_failure(self, member, attempt: int, ex):
+        status = getattr(ex.response, 'status', None)
+        if status == 429:
+            self.rate_limits += 1
+            self.window = max(1, self.window // 2)
+            self.successes_since_limit = 0
+            retry_after = await retry_after_secs(ex)
+            self.resume_at = max(self.resume_at, timeit.default_timer() + retry_after)
+        elif status is None or status < 500:
+            self.errors += 1
+            return
+
+        if attempt >= self.max_retries:
+            self.errors += 1
+            return
+        self.retries += 1
+        if status != 429:
+            backoff_secs = self.RETRY_BASE_SECS * 2 ** attempt
+            self.resume_at = max(self.resume_at, timeit.default_timer() + backoff_secs)
+        self.pending.append((member, attempt + 1))
+
+
+async def retry_after_secs(ex):
+    """How long a 429 HTTPException asked us to wait, in seconds.
+
+    Like discord.py, this reads retry_after (in milliseconds) from the JSON body of the
+    response. The Retry-After header is only used if the body doesn't have it.
+    """
+    try:
+        # The body was already read by discord.py, so this doesn't hit the network
+        data = json.loads(await ex.response.text(encoding='utf-8'))
+        return float(data['retry_after']) / 1000
+    except (AttributeError, KeyError, TypeError, ValueError, aiohttp.ClientError):
+        pass
+    try:
+        return float(ex.response.headers['Retry-After']) / 1000
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return BulkMemberUpdate.DEFAULT_RETRY_AFTER_SECS
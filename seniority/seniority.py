@@ -1,72 +1,121 @@
 import asyncio
-from collections import deque
+from collections import defaultdict, deque
+import concurrent.futures
 from datetime import datetime, timedelta
 import discord
 from discord.ext import commands
-import os
 import prettytable
 import pytz
 import re
-import sys
 import textwrap
 import timeit
+import traceback
 
 from __main__ import send_cmd_help
-import aioodbc
 from cogs.utils import checks
 from cogs.utils.dataIO import dataIO
 import sqlite3 as lite
 
 from . import rpadutils
-from .rpadutils import CogSettings
+from .rpadutils import SqliteCogSettings
 from .utils.chat_formatting import *
 
 
+# Bumped whenever the tables need migrating; stored in PRAGMA user_version.
+SCHEMA_VERSION = 1
+
+# Dates are stored as YYYYMMDD integers. Every query either looks up a day, or a range
+# of days for one server and user, so the primary key and one index cover them all.
+# Ids are stored as integers too, and cast back to text (as discord.py has them) by
+# the queries whose results the cog looks ids up in.
 CREATE_TABLE = '''
 CREATE TABLE IF NOT EXISTS seniority(
-  record_date STRING NOT NULL,
-  server_id STRING NOT NULL,
-  channel_id STRING NOT NULL,
-  user_id STRING NOT NULL,
+  record_date INTEGER NOT NULL,
+  server_id INTEGER NOT NULL,
+  user_id INTEGER NOT NULL,
+  channel_id INTEGER NOT NULL,
   points REAL DEFAULT 0,
-  PRIMARY KEY (record_date, server_id, channel_id, user_id))
+  PRIMARY KEY (record_date, server_id, user_id, channel_id))
+WITHOUT ROWID
 '''
 
-CREATE_INDEX_1 = '''
-CREATE INDEX IF NOT EXISTS idx_server_id_record_date_user_id
-ON seniority(server_id, record_date, user_id)
+CREATE_INDEX = '''
+CREATE INDEX IF NOT EXISTS idx_server_id_user_id_record_date
+ON seniority(server_id, user_id, record_date)
 '''
 
-# Why?
-CREATE_INDEX_2 = '''
-CREATE INDEX IF NOT EXISTS idx_record_date_server_id_user_id
-ON seniority(record_date, server_id, user_id)
+# Indexes from schema version 0, where dates were stored as text
+LEGACY_INDEXES = [
+    'idx_server_id_record_date_user_id',
+    'idx_record_date_server_id_user_id',
+    'idx_record_date_server_id_channel_id_user_id',
+    'idx_server_id_user_id_record_date',
+]
+
+MIGRATE_LEGACY_QUERY = '''
+INSERT INTO seniority(record_date, server_id, user_id, channel_id, points)
+SELECT CAST(replace(record_date, '-', '') AS INTEGER), server_id, user_id, channel_id, points
+FROM seniority_v0
 '''
 
-# Why? record date should never come first
-CREATE_INDEX_3 = '''
-CREATE INDEX IF NOT EXISTS idx_record_date_server_id_channel_id_user_id
-ON seniority(record_date, server_id, channel_id, user_id)
+# Each user's total points per day across all channels, kept up to date as points are
+# written, so lookback sums don't have to re-aggregate every channel's rows.
+CREATE_DAILY_TABLE = '''
+CREATE TABLE IF NOT EXISTS seniority_daily(
+  server_id INTEGER NOT NULL,
+  record_date INTEGER NOT NULL,
+  user_id INTEGER NOT NULL,
+  points REAL DEFAULT 0,
+  PRIMARY KEY (server_id, record_date, user_id))
+WITHOUT ROWID
 '''
 
-CREATE_INDEX_4 = '''
-CREATE INDEX IF NOT EXISTS idx_server_id_user_id_record_date
-ON seniority(server_id, user_id, record_date)
+BACKFILL_DAILY_QUERY = '''
+INSERT OR REPLACE INTO seniority_daily(server_id, record_date, user_id, points)
+SELECT server_id, record_date, user_id, SUM(points)
+FROM seniority
+GROUP BY 1, 2, 3
+'''
+
+UPDATE_DAILY_POINTS_QUERY = '''
+INSERT OR REPLACE INTO seniority_daily(server_id, record_date, user_id, points)
+SELECT server_id, record_date, user_id, SUM(points)
+FROM seniority
+WHERE record_date = ?
+  AND server_id = ?
+  AND user_id = ?
+GROUP BY 1, 2, 3
+'''
+
+GET_DAILY_RANGE_POINTS_QUERY = '''
+SELECT CAST(user_id AS TEXT) as user_id, SUM(points) as points
+FROM seniority_daily
+WHERE server_id = ?
+  AND record_date >= ?
+  AND record_date <= ?
+GROUP BY 1
+'''
+
+DELETE_DAILY_DAY_QUERY = '''
+DELETE FROM seniority_daily
+WHERE record_date = ?
+  AND server_id = ?
 '''
 
 GET_USER_POINTS_QUERY = '''
-SELECT record_date, round(sum(points), 2) as points
+SELECT printf('%d-%02d-%02d', record_date / 10000, record_date / 100 % 100, record_date % 100) as record_date,
+  round(sum(points), 2) as points
 FROM seniority INDEXED BY idx_server_id_user_id_record_date
 WHERE server_id = ?
   AND user_id = ?
-GROUP BY 1
-ORDER BY 1 DESC
+GROUP BY seniority.record_date
+ORDER BY seniority.record_date DESC
 LIMIT ?
 '''
 
 GET_LOOKBACK_POINTS_QUERY = '''
-SELECT user_id, sum(points) as points
-FROM seniority INDEXED BY idx_server_id_user_id_record_date
+SELECT CAST(user_id AS TEXT) as user_id, sum(points) as points
+FROM seniority_daily
 WHERE server_id = ?
   AND record_date >= ?
 GROUP BY 1
@@ -74,32 +123,23 @@ GROUP BY 1
 
 GET_DATE_POINTS_QUERY = '''
 SELECT channel_id, points
-FROM seniority INDEXED BY idx_server_id_record_date_user_id
+FROM seniority
 WHERE record_date = ?
   AND server_id = ?
   AND user_id = ?
 '''
 
-GET_NEWMESSAGE_POINTS_QUERY = '''
-SELECT SUM(points) as points
-FROM seniority INDEXED BY idx_record_date_server_id_channel_id_user_id
+GET_DAY_POINTS_QUERY = '''
+SELECT CAST(server_id AS TEXT), CAST(channel_id AS TEXT), CAST(user_id AS TEXT), points
+FROM seniority
 WHERE record_date = ?
-  AND server_id = ?
-  AND channel_id = ?
-  AND user_id = ?
-'''
-
-GET_NEWMESSAGE_SERVER_POINTS_QUERY = '''
-SELECT SUM(points) as points
-FROM seniority INDEXED BY idx_record_date_server_id_user_id
-WHERE record_date = ?
-  AND server_id = ?
-  AND user_id = ?
 '''
 
-REPLACE_POINTS_QUERY = '''
-REPLACE INTO seniority(record_date, server_id, channel_id, user_id, points)
+# Only the points change on conflict, so unlike REPLACE the index is left alone
+UPSERT_POINTS_QUERY = '''
+INSERT INTO seniority(record_date, server_id, channel_id, user_id, points)
 VALUES(?, ?, ?, ?, ?)
+ON CONFLICT(record_date, server_id, user_id, channel_id) DO UPDATE SET points = excluded.points
 '''
 
 DELETE_DAY_QUERY = '''
@@ -108,6 +148,219 @@ WHERE record_date = ?
   AND server_id = ?
 '''
 
+# Points earned are accumulated in memory and written out every FLUSH_INTERVAL_SECS.
+FLUSH_INTERVAL_SECS = 5
+
+ROOM_CODE_PATTERN = re.compile(r'\d{4}\s?\d{4}')
+EMOJI_PATTERN = r'<:[0-9a-z_]+:\d{18}>'
+MENTION_PATTERN = r'<@\d{18}>'
+
+# Days recomputed at once by backfill, each on its own thread.
+BACKFILL_WORKERS = 4
+
+# Compiled statements kept per connection; more than the handful of queries used here,
+# so that rawquery doesn't push them out.
+STATEMENT_CACHE_SIZE = 64
+
+
+class SeniorityStorage(object):
+    """The seniority table, accessed with sqlite3 on a dedicated thread.
+
+    The connection is only ever used from the one worker thread, so statements are
+    serialized without any locking, and each query's compiled statement is reused
+    from the connection's cache. The database runs in WAL mode.
+    """
+
+    def __init__(self, db_path: str, loop):
+        self.db_path = db_path
+        self.loop = loop
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.con = None
+
+    async def run(self, fn, *args):
+        return await self.loop.run_in_executor(self.executor, fn, *args)
+
+    async def open(self):
+        await self.run(self._open)
+
+    def _open(self):
+        con = lite.connect(self.db_path, check_same_thread=False,
+                           cached_statements=STATEMENT_CACHE_SIZE)
+        con.execute('PRAGMA journal_mode = WAL')
+        con.execute('PRAGMA synchronous = NORMAL')
+        with con:
+            con.execute('BEGIN')
+            if con.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+                migrate_legacy_schema(con)
+            create_schema(con)
+        self.con = con
+
+    async def close(self):
+        if self.con is not None:
+            await self.run(self.con.close)
+        self.executor.shutdown(wait=True)
+
+    async def day_points(self, now_date_str: str):
+        """(server_id, channel_id, user_id, points) for every row on a day."""
+        return await self.run(self._fetchall, GET_DAY_POINTS_QUERY, (date_to_int(now_date_str),))
+
+    async def lookback_points(self, server_id: str, lookback_date_str: str):
+        """(user_id, points) summed since lookback_date_str."""
+        return await self.run(self._fetchall, GET_LOOKBACK_POINTS_QUERY,
+                              (server_id, date_to_int(lookback_date_str)))
+
+    async def daily_points(self, server_id: str, start_date_str: str, end_date_str: str):
+        """(user_id, points) summed over the daily totals from start to end date inclusive."""
+        return await self.run(self._fetchall, GET_DAILY_RANGE_POINTS_QUERY,
+                              (server_id, date_to_int(start_date_str), date_to_int(end_date_str)))
+
+    async def replace_points(self, rows):
+        """Writes (record_date, server_id, channel_id, user_id, points) rows in one transaction.
+
+        The daily totals of every user written to are updated in the same transaction.
+        """
+        await self.run(self._replace_points, rows)
+
+    async def delete_day(self, now_date_str: str, server_id: str):
+        await self.run(self._delete_day, now_date_str, server_id)
+
+    async def replace_days(self, server_id: str, date_strs, rows):
+        """Swaps a server's points on each of date_strs for rows, in one transaction."""
+        await self.run(self._replace_days, server_id, date_strs, rows)
+
+    def _replace_points(self, rows):
+        with self.con:
+            self._write_points(rows)
+
+    def _delete_day(self, now_date_str, server_id):
+        with self.con:
+            self._delete_points(now_date_str, server_id)
+
+    def _replace_days(self, server_id, date_strs, rows):
+        with self.con:
+            for date_str in date_strs:
+                self._delete_points(date_str, server_id)
+            self._write_points(rows)
+
+    def _write_points(self, rows):
+        rows = [(date_to_int(r[0]),) + tuple(r[1:]) for r in rows]
+        daily_keys = {(r[0], r[1], r[3]) for r in rows}
+        self.con.executemany(UPSERT_POINTS_QUERY, rows)
+        self.con.executemany(UPDATE_DAILY_POINTS_QUERY, daily_keys)
+
+    def _delete_points(self, now_date_str, server_id):
+        record_date = date_to_int(now_date_str)
+        self.con.execute(DELETE_DAY_QUERY, (record_date, server_id))
+        self.con.execute(DELETE_DAILY_DAY_QUERY, (record_date, server_id))
+
+    async def query(self, query: str, values):
+        """Runs arbitrary SQL, returning (rows, column names)."""
+        return await self.run(self._query, query, values)
+
+    def _fetchall(self, query, values):
+        return self.con.execute(query, values).fetchall()
+
+    def _query(self, query, values):
+        with self.con:
+            cursor = self.con.execute(query, values)
+            return cursor.fetchall(), [x[0] for x in cursor.description or []]
+
+
+def date_to_int(date_str: str):
+    """Converts an ISO date like 2018-01-31 to the 20180131 form it is stored in."""
+    return int(date_str.replace('-', ''))
+
+
+def table_exists(con, name: str):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                       (name,)).fetchone() is not None
+
+
+def create_schema(con):
+    con.execute(CREATE_TABLE)
+    con.execute(CREATE_INDEX)
+    daily_exists = table_exists(con, 'seniority_daily')
+    con.execute(CREATE_DAILY_TABLE)
+    if not daily_exists:
+        print('Seniority: backfilling daily totals')
+        con.execute(BACKFILL_DAILY_QUERY)
+    con.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+
+
+def migrate_legacy_schema(con):
+    """Moves points from the version 0 table into the current layout.
+
+    The daily totals are dropped as well, and rebuilt from the migrated points by
+    create_schema.
+    """
+    if not table_exists(con, 'seniority'):
+        return
+    print('Seniority: migrating points table')
+    for index in LEGACY_INDEXES:
+        con.execute('DROP INDEX IF EXISTS {}'.format(index))
+    con.execute('ALTER TABLE seniority RENAME TO seniority_v0')
+    con.execute(CREATE_TABLE)
+    con.execute(MIGRATE_LEGACY_QUERY)
+    con.execute('DROP TABLE seniority_v0')
+    con.execute('DROP TABLE IF EXISTS seniority_daily')
+
+
+def backfill_day(sqllog_cog, server_id: str, channel_caps, server_point_cap, member_ids,
+                 is_acceptable, now_date_str: str):
+    """Recomputes a server's points for one day from the activity log, on a worker thread.
+
+    channel_caps is a list of (channel_id, max_points, incremental_points), in the order
+    the channels are processed in. Messages are streamed from the log and scored with
+    the same caps as Seniority.process_message. Returns rows for replace_points.
+    """
+    channel_points = {}
+    server_points = defaultdict(float)
+    con = sqllog_cog.open_reader()
+    try:
+        for channel_id, max_points, incremental_points in channel_caps:
+            msgs = sqllog_cog.iter_server_channel_date_msgs(server_id, channel_id, now_date_str, con)
+            for user_id, msg_content in msgs:
+                if user_id not in member_ids:
+                    continue
+                key = (channel_id, user_id)
+                current_points = channel_points.get(key, 0)
+                if current_points >= max_points:
+                    continue
+                if server_points[user_id] >= server_point_cap:
+                    continue
+                # The caps are cheaper to check, and skip most messages on busy days
+                if not is_acceptable(msg_content):
+                    continue
+                new_points = min(current_points + incremental_points, max_points)
+                channel_points[key] = new_points
+                server_points[user_id] += new_points - current_points
+    finally:
+        con.close()
+
+    return [(now_date_str, server_id, channel_id, user_id, points)
+            for (channel_id, user_id), points in channel_points.items()]
+
+
+class LookbackWindow(object):
+    """Each user's point total over the finished days of a lookback period.
+
+    Covers start_date through end_date inclusive. Moving to a later period adds the
+    daily totals of the days entering it and subtracts those of the days leaving it.
+    """
+
+    def __init__(self, start_date, end_date, rows):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.totals = dict(rows)
+
+    def add(self, rows, sign):
+        for user_id, points in rows:
+            total = self.totals.get(user_id, 0) + sign * points
+            if abs(total) < 1e-6:
+                self.totals.pop(user_id, None)
+            else:
+                self.totals[user_id] = total
+
 
 class Seniority(object):
     """Automatically promote people based on activity."""
@@ -116,34 +369,46 @@ class Seniority(object):
         self.bot = bot
         self.settings = SenioritySettings("seniority")
         self.db_path = self.settings.folder + '/log.db'
+        self.storage = SeniorityStorage(self.db_path, self.bot.loop)
         self.lock = True
         self.insert_timing = deque(maxlen=1000)
+
+        # Points for each day that has been loaded from the database, keyed by
+        # (record_date, server_id, channel_id, user_id), plus the per-server totals
+        # keyed by (record_date, server_id, user_id). Keys in dirty_points have
+        # changed since the last flush.
+        self.points = {}
+        self.server_points = defaultdict(float)
+        self.loaded_dates = set()
+        self.dirty_points = set()
+        self.points_lock = asyncio.Lock()
+
+        # LookbackWindows keyed by (server_id, lookback_days)
+        self.lookback_windows = {}
+        self.window_lock = asyncio.Lock()
         print('Seniority: init complete')
 
     def __unload(self):
         print('Seniority: unloading')
         self.lock = True
-        self.pool.close()
+        self.bot.loop.create_task(self.close())
         print('Seniority: unloading complete')
 
+    async def close(self):
+        try:
+            await self.flush_points()
+        except Exception as ex:
+            print('Seniority: failed to flush on unload: ' + str(ex))
+        await self.storage.close()
+
     async def init(self):
         print('Seniority: init')
         if not self.lock:
             print('Seniority: bailing on unlock')
             return
 
-        if os.name != 'nt' and sys.platform != 'win32':
-            dsn = 'Driver=SQLite3;Database=' + self.db_path
-        else:
-            dsn = 'Driver=SQLite3 ODBC Driver;Database=' + self.db_path
-        self.pool = await aioodbc.create_pool(dsn=dsn, autocommit=True)
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(CREATE_TABLE)
-                await cur.execute(CREATE_INDEX_1)
-                await cur.execute(CREATE_INDEX_2)
-                await cur.execute(CREATE_INDEX_3)
-                await cur.execute(CREATE_INDEX_4)
+        await self.storage.open()
+        await self.load_points(now_date())
         self.lock = False
 
         print('Seniority: init complete')
@@ -162,46 +427,80 @@ class Seniority(object):
 
     @seniority.command(pass_context=True, no_pm=True)
     @checks.is_owner()
-    async def backfill(self, ctx, *, now_date_str: str):
+    async def backfill(self, ctx, start_date_str: str, end_date_str: str=None):
+        """Recompute points from the activity log for a day, or a range of days (YYYY-MM-DD)."""
         sqllog_cog = self.bot.get_cog('SqlActivityLogger')
+        if sqllog_cog is None:
+            raise rpadutils.ReportableError('SqlActivityLogger is not loaded')
         server = ctx.message.server
 
-        await self.bot.say(inline('Deleting any existing points on ' + now_date_str))
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(DELETE_DAY_QUERY, now_date_str, server.id)
-        await self.bot.say(inline('Done deleting existing points'))
+        try:
+            start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
+            end_date = datetime.strptime(end_date_str or start_date_str, '%Y-%m-%d').date()
+        except ValueError:
+            raise rpadutils.ReportableError('Dates must be formatted like 2018-01-31')
+        day_count = (end_date - start_date).days + 1
+        if day_count < 1:
+            raise rpadutils.ReportableError('The end date is before the start date')
+        date_strs = [(start_date + timedelta(days=i)).isoformat() for i in range(day_count)]
 
-        for channel_id in self.settings.channels(server.id).keys():
-            channel = self.bot.get_channel(channel_id)
-            if channel is None:
+        message_cap = self.settings.message_cap(server.id)
+        server_point_cap = self.settings.server_point_cap(server.id)
+        channel_caps = []
+        for channel_id, config in self.settings.channels(server.id).items():
+            if self.bot.get_channel(channel_id) is None:
                 continue
-            await self.bot.say(inline('About to process channel: ' + channel.name))
-            channel_msgs = sqllog_cog.get_server_channel_date_msgs(
-                server.id, channel.id, now_date_str)
-            await self.bot.say(inline('Retrieved {} messages'.format(len(channel_msgs))))
-
-            points = 0
-            for user_msg in channel_msgs:
-                member = server.get_member(user_msg[0])
-                if member is None:
-                    continue
-                msg_content = user_msg[1]
-                new_points = await self.process_message(
-                    server, channel, member, now_date_str, msg_content)
-                points += new_points or 0
-            await self.bot.say(inline('{} points were earned'.format(points)))
+            max_points = config['max_ppd']
+            channel_caps.append((channel_id, max_points, max_points / message_cap))
+        member_ids = {m.id for m in server.members}
+
+        rules = self.settings.acceptability_rules(server.id)
+
+        def is_acceptable(text):
+            return rules.check(self.bot, server, text)[0]
+
+        await self.bot.say(inline('Backfilling {} days over {} channels'.format(day_count, len(channel_caps))))
+        before_time = timeit.default_timer()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(BACKFILL_WORKERS, day_count))
+        try:
+            day_rows = await asyncio.gather(*[
+                self.bot.loop.run_in_executor(executor, backfill_day, sqllog_cog, server.id, channel_caps,
+                                              server_point_cap, member_ids, is_acceptable, date_str)
+                for date_str in date_strs])
+        finally:
+            executor.shutdown(wait=False)
+        rows = [r for day in day_rows for r in day]
+
+        async with self.points_lock:
+            await self.storage.replace_days(server.id, date_strs, rows)
+            # Swap in the new points for any day already in memory
+            for date_str in date_strs:
+                self.clear_points(date_str, server.id)
+            for now_date_str, server_id, channel_id, user_id, points in rows:
+                if now_date_str in self.loaded_dates:
+                    self.points[(now_date_str, server_id, channel_id, user_id)] = points
+                    self.server_points[(now_date_str, server_id, user_id)] += points
+            self.clear_windows(server.id)
+        execution_time = timeit.default_timer() - before_time
 
-        await self.bot.say(inline('Finished with backfill'))
+        await self.bot.say(inline('Finished with backfill: {} points for {} users in {}s'.format(
+            round(sum(r[4] for r in rows), 2), len({r[3] for r in rows}), round(execution_time, 2))))
 
     @seniority.command(pass_context=True)
     @checks.is_owner()
     async def inserttiming(self, ctx):
-        size = len(self.insert_timing)
-        avg_time = round(sum(self.insert_timing) / size, 4)
-        max_time = round(max(self.insert_timing), 4)
-        min_time = round(min(self.insert_timing), 4)
-        await self.bot.say(inline('{} inserts, min={} max={} avg={}'.format(size, min_time, max_time, avg_time)))
+        msg = 'pending={} loaded_days={}'.format(len(self.dirty_points), len(self.loaded_dates))
+        timings = list(self.insert_timing)
+        if timings:
+            size = len(timings)
+            row_count = sum(t[1] for t in timings)
+            flush_times = [t[0] for t in timings]
+            avg_time = round(sum(flush_times) / size, 4)
+            max_time = round(max(flush_times), 4)
+            min_time = round(min(flush_times), 4)
+            msg = '{} flushes ({} rows), min={} max={} avg={}, {}'.format(
+                size, row_count, min_time, max_time, avg_time, msg)
+        await self.bot.say(inline(msg))
 
     @seniority.command(pass_context=True)
     @checks.is_owner()
@@ -306,17 +605,9 @@ class Seniority(object):
             grant_users, ignored_users = await self.get_grant_ignore_users(
                 server, role, amount, lookback_days, True)
             grant_users = [server.get_member(x[0]) for x in grant_users]
-
-            cs = 5
-            user_chunks = [grant_users[i:i + cs] for i in range(0, len(grant_users), cs)]
-            for chunk in user_chunks:
-                msg = 'Granting to users: ' + ','.join([m.name for m in chunk])
-                await self.bot.say(inline(msg))
-                for member in chunk:
-                    try:
-                        await self.bot.add_roles(member, role)
-                    except Exception as ex:
-                        raise rpadutils.ReportableError(str(ex))
+            grant_users = [m for m in grant_users if m is not None]
+            await self.update_members(ctx, 'Granting to', grant_users,
+                                      lambda member: self.bot.add_roles(member, role))
 
     @grant.command(pass_context=True, no_pm=True)
     async def removenow(self, ctx):
@@ -333,17 +624,25 @@ class Seniority(object):
             grant_users, ignored_users = await self.get_grant_ignore_users(
                 server, role, amount, lookback_days, False)
             grant_users = [server.get_member(x[0]) for x in grant_users]
+            grant_users = [m for m in grant_users if m is not None]
+            await self.update_members(ctx, 'Removing from', grant_users,
+                                      lambda member: self.bot.remove_roles(member, role))
+
+    async def update_members(self, ctx, verb, members, update_fn):
+        if not members:
+            return
+        channel = ctx.message.channel
+        for page in pagify(verb + ' users: ' + ', '.join(m.name for m in members), delims=[',']):
+            await self.bot.send_message(channel, inline(page))
 
-            cs = 5
-            user_chunks = [grant_users[i:i + cs] for i in range(0, len(grant_users), cs)]
-            for chunk in user_chunks:
-                msg = 'Removing from users: ' + ','.join([m.name for m in chunk])
-                await self.bot.say(inline(msg))
-                for member in chunk:
-                    try:
-                        await self.bot.remove_roles(member, role)
-                    except Exception as ex:
-                        raise rpadutils.ReportableError(str(ex))
+        async def report_progress(update):
+            await self.bot.send_message(channel, inline(update.status()))
+
+        update = rpadutils.BulkMemberUpdate(members, update_fn, progress_fn=report_progress)
+        await update.run()
+        if update.errors:
+            raise rpadutils.ReportableError(
+                'Failed to update {} of {} users'.format(update.errors, update.total))
 
     async def do_print_overages(self,
                                 server: discord.Server,
@@ -410,14 +709,50 @@ class Seniority(object):
         return grant_users, ignored_users
 
     async def get_lookback_points(self, server: discord.Server, lookback_days: int):
-        lookback_date = datetime.now(rpadutils.NA_TZ_OBJ) - timedelta(days=lookback_days)
-        lookback_date_str = lookback_date.date().isoformat()
-
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(GET_LOOKBACK_POINTS_QUERY, server.id, lookback_date_str)
-                rows = await cur.fetchall()
-        return rows
+        """(user_id, points) earned from lookback_days ago through today."""
+        today = datetime.now(rpadutils.NA_TZ_OBJ).date()
+        today_str = today.isoformat()
+
+        # Earlier days are read from the window; today's points are still changing,
+        # so they come from memory
+        await self.load_points(today_str)
+        await self.flush_points()
+        window = await self.get_lookback_window(server.id, lookback_days, today)
+
+        totals = dict(window.totals)
+        for (date_str, server_id, user_id), points in self.server_points.items():
+            if date_str == today_str and server_id == server.id:
+                totals[user_id] = totals.get(user_id, 0) + points
+        return list(totals.items())
+
+    async def get_lookback_window(self, server_id: str, lookback_days: int, today):
+        """The LookbackWindow for the days before today, slid forward to today if needed."""
+        start_date = today - timedelta(days=lookback_days)
+        end_date = today - timedelta(days=1)
+        key = (server_id, lookback_days)
+
+        async with self.window_lock:
+            window = self.lookback_windows.get(key)
+            if window is None or (end_date - window.end_date).days > lookback_days:
+                # Nothing to slide from, or sliding would touch more days than a rebuild
+                rows = await self.storage.daily_points(server_id, start_date.isoformat(), end_date.isoformat())
+                window = LookbackWindow(start_date, end_date, rows)
+                self.lookback_windows[key] = window
+                return window
+
+            while window.end_date < end_date:
+                day_str = (window.end_date + timedelta(days=1)).isoformat()
+                window.add(await self.storage.daily_points(server_id, day_str, day_str), 1)
+                window.end_date += timedelta(days=1)
+            while window.start_date < start_date:
+                day_str = window.start_date.isoformat()
+                window.add(await self.storage.daily_points(server_id, day_str, day_str), -1)
+                window.start_date += timedelta(days=1)
+            return window
+
+    def clear_windows(self, server_id: str):
+        for key in [k for k in self.lookback_windows if k[0] == server_id]:
+            del self.lookback_windows[key]
 
     def check_users_for_role(self,
                              users_and_points,
@@ -459,7 +794,7 @@ class Seniority(object):
     async def usercurrent(self, ctx, user: discord.User):
         """Print the current day's points for a user."""
         server = ctx.message.server
-        args = [now_date(), server.id, user.id]
+        args = [date_to_int(now_date()), server.id, user.id]
         await self.queryAndPrint(server, GET_DATE_POINTS_QUERY, args)
 
     @seniority.command(pass_context=True, no_pm=True)
@@ -649,31 +984,7 @@ class Seniority(object):
         await self.bot.say(inline('Min word count set to {}.'.format(words)))
 
     def check_acceptable(self, server: discord.Server, text: str):
-        server_id = server.id
-        # Disabled
-        # self.settings.ignore_impolite(server_id)
-
-        if self.settings.ignore_commands(server_id):
-            if rpadutils.get_prefix(self.bot, server, text):
-                return False, text, 'Ignored command'
-
-        if self.settings.ignore_room_codes(server_id):
-            if re.match(r'.*\d{4}\s?\d{4}.*', text):
-                return False, text, 'Ignored room code'
-
-        if self.settings.ignore_emoji(server_id):
-            text = re.sub(r'<:[0-9a-z_]+:\d{18}>', '', text, re.IGNORECASE)
-
-        if self.settings.ignore_mentions(server_id):
-            text = re.sub(r'<@\d{18}>', '', text, re.IGNORECASE)
-
-        if len(text) < self.settings.min_length(server_id):
-            return False, text, 'Min length'
-
-        if len(text.split()) < self.settings.min_words(server_id):
-            return False, text, 'Min words'
-
-        return True, text, 'Passed!'
+        return self.settings.acceptability_rules(server.id).check(self.bot, server, text)
 
     async def on_message(self, message: discord.Message):
         if message.server is None:
@@ -701,16 +1012,19 @@ class Seniority(object):
         if not acceptable:
             return
 
+        if now_date_str not in self.loaded_dates:
+            await self.load_points(now_date_str)
+
         max_points = channel_config['max_ppd']
-        current_points = await self.get_current_channel_points(now_date_str, server, channel, user)
-        current_points = current_points or 0
+        key = (now_date_str, server.id, channel.id, user.id)
+        current_points = self.points.get(key, 0)
 
         if current_points >= max_points:
             return
 
         server_point_cap = self.settings.server_point_cap(server.id)
-        current_server_points = await self.get_current_server_points(now_date_str, server, user)
-        current_server_points = current_server_points or 0
+        server_key = (now_date_str, server.id, user.id)
+        current_server_points = self.server_points.get(server_key, 0)
 
         if current_server_points >= server_point_cap:
             return
@@ -720,39 +1034,82 @@ class Seniority(object):
         new_points = current_points + incremental_points
         new_points = min(new_points, max_points)
 
-        before_time = timeit.default_timer()
-        await self.save_current_points(now_date_str, server, channel, user, new_points)
-        execution_time = timeit.default_timer() - before_time
-        self.insert_timing.append(execution_time)
+        self.points[key] = new_points
+        self.server_points[server_key] += new_points - current_points
+        self.dirty_points.add(key)
 
         return incremental_points
 
-    async def get_current_channel_points(self, now_date_str: str, server: discord.Server, channel: discord.Channel, user: discord.User):
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(GET_NEWMESSAGE_POINTS_QUERY, now_date_str, server.id, channel.id, user.id)
-                results = await cur.fetchone()
-                return results.points if results else 0
-
-    async def get_current_server_points(self, now_date_str: str, server: discord.Server, user: discord.User):
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(GET_NEWMESSAGE_SERVER_POINTS_QUERY, now_date_str, server.id, user.id)
-                results = await cur.fetchone()
-                return results.points if results else 0
-
-    async def save_current_points(self, now_date_str: str, server: discord.Server, channel: discord.Channel, user: discord.User, new_points: int):
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(REPLACE_POINTS_QUERY, now_date_str, server.id, channel.id, user.id, new_points)
+    async def load_points(self, now_date_str: str):
+        """Reads the points already stored for a day into memory, if not loaded yet."""
+        async with self.points_lock:
+            if now_date_str in self.loaded_dates:
+                return
+            rows = await self.storage.day_points(now_date_str)
+            for server_id, channel_id, user_id, points in rows:
+                key = (now_date_str, server_id, channel_id, user_id)
+                if key in self.points:
+                    # Earned since the load started
+                    continue
+                self.points[key] = points
+                self.server_points[(now_date_str, server_id, user_id)] += points
+            self.loaded_dates.add(now_date_str)
+
+    def clear_points(self, now_date_str: str, server_id: str):
+        for key in [k for k in self.points if k[0] == now_date_str and k[1] == server_id]:
+            del self.points[key]
+            self.dirty_points.discard(key)
+        for key in [k for k in self.server_points if k[0] == now_date_str and k[1] == server_id]:
+            del self.server_points[key]
+
+    def evict_points(self, keep_date_str: str):
+        """Drops fully flushed days other than keep_date_str from memory."""
+        dirty_dates = {k[0] for k in self.dirty_points}
+        for date_str in self.loaded_dates - dirty_dates - {keep_date_str}:
+            self.loaded_dates.discard(date_str)
+            for key in [k for k in self.points if k[0] == date_str]:
+                del self.points[key]
+            for key in [k for k in self.server_points if k[0] == date_str]:
+                del self.server_points[key]
+
+    async def flush_points(self):
+        """Writes every changed point total in one transaction."""
+        async with self.points_lock:
+            if not self.dirty_points:
+                return
+            keys = self.dirty_points
+            self.dirty_points = set()
+            rows = [key + (self.points[key],) for key in keys if key in self.points]
+
+            before_time = timeit.default_timer()
+            try:
+                await self.storage.replace_points(rows)
+            except:
+                # Retried on the next flush
+                self.dirty_points.update(k for k in keys if k in self.points)
+                raise
+            execution_time = timeit.default_timer() - before_time
+            self.insert_timing.append((execution_time, len(rows)))
+
+    async def flush_loop(self):
+        while self == self.bot.get_cog('Seniority'):
+            await asyncio.sleep(FLUSH_INTERVAL_SECS)
+            if self.lock:
+                continue
+            try:
+                await self.flush_points()
+                now_date_str = now_date()
+                self.evict_points(now_date_str)
+                # Load the new day ahead of its first message
+                await self.load_points(now_date_str)
+            except Exception as ex:
+                print('Seniority flush loop caught exception ' + str(ex))
+                traceback.print_exc()
 
     async def queryAndPrint(self, server, query, values, max_rows=100, reverse=False, total=False):
+        await self.flush_points()
         before_time = timeit.default_timer()
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(query, *values)
-                rows = await cur.fetchall()
-                columns = [x[0] for x in cur.description]
+        rows, columns = await self.storage.query(query, values)
         execution_time = timeit.default_timer() - before_time
 
         if reverse:
@@ -804,6 +1161,47 @@ class Seniority(object):
             await self.bot.say(box(p))
 
 
+class AcceptabilityRules(object):
+    """A server's acceptability settings, with the patterns they need compiled."""
+
+    def __init__(self, settings, server_id: str):
+        # ignore_impolite is disabled
+        self.ignore_commands = settings.ignore_commands(server_id)
+        self.ignore_room_codes = settings.ignore_room_codes(server_id)
+        self.min_length = settings.min_length(server_id)
+        self.min_words = settings.min_words(server_id)
+
+        # Emoji and mentions are stripped together
+        strip_patterns = []
+        if settings.ignore_emoji(server_id):
+            strip_patterns.append(EMOJI_PATTERN)
+        if settings.ignore_mentions(server_id):
+            strip_patterns.append(MENTION_PATTERN)
+        self.strip_pattern = None
+        if strip_patterns:
+            self.strip_pattern = re.compile('|'.join(strip_patterns), re.IGNORECASE)
+
+    def check(self, bot, server: discord.Server, text: str):
+        """Returns (acceptable, text with emoji/mentions stripped, reason)."""
+        if self.ignore_commands and rpadutils.get_prefix(bot, server, text):
+            return False, text, 'Ignored command'
+
+        if self.strip_pattern:
+            text = self.strip_pattern.sub('', text)
+
+        # After stripping, so the ids in emoji and mentions don't look like room codes
+        if self.ignore_room_codes and ROOM_CODE_PATTERN.search(text):
+            return False, text, 'Ignored room code'
+
+        if len(text) < self.min_length:
+            return False, text, 'Min length'
+
+        if self.min_words and len(text.split()) < self.min_words:
+            return False, text, 'Min words'
+
+        return True, text, 'Passed!'
+
+
 def ensure_map(item, key, default_value):
     if key not in item:
         item[key] = default_value
@@ -814,7 +1212,16 @@ def now_date():
     return datetime.now(rpadutils.NA_TZ_OBJ).date().isoformat()
 
 
-class SenioritySettings(CogSettings):
+class SenioritySettings(SqliteCogSettings):
+    def __init__(self, *args, **kwargs):
+        # AcceptabilityRules by server id, rebuilt after any settings change
+        self.rules_cache = {}
+        super(SenioritySettings, self).__init__(*args, **kwargs)
+
+    def save_settings(self):
+        self.rules_cache = {}
+        super(SenioritySettings, self).save_settings()
+
     def make_default_settings(self):
         config = {
             'servers': {}
@@ -937,6 +1344,13 @@ class SenioritySettings(CogSettings):
     def min_words(self, server_id: str):
         return self.utterances(server_id)['min_words']
 
+    def acceptability_rules(self, server_id: str):
+        rules = self.rules_cache.get(server_id)
+        if rules is None:
+            rules = AcceptabilityRules(self, server_id)
+            self.rules_cache[server_id] = rules
+        return rules
+
     def set_ignore_impolite(self, server_id: str, ignore: bool):
         self.utterances(server_id)['ignore_impolite'] = ignore
         self.save_settings()
@@ -1005,6 +1419,7 @@ def setup(bot):
     n = Seniority(bot)
     bot.add_cog(n)
     bot.loop.create_task(n.init())
+    bot.loop.create_task(n.flush_loop())
 
 
 def force_number(s):
@@ -1,8 +1,16 @@
-from collections import deque
+import asyncio
+from collections import defaultdict, deque
+import concurrent.futures
 from datetime import datetime, timedelta
+import io
+import json
 import os
+import re
 import textwrap
 import timeit
+import traceback
+from urllib.request import pathname2url
+import zlib
 
 import discord
 from discord.ext import commands
@@ -34,8 +42,15 @@ ALL_COLUMNS = [
     ('clean_content', 'Message'),
 ]
 
+# Messages are stored in monthly partition tables named messages_YYYY_MM (by UTC
+# timestamp). The original unpartitioned messages table is kept as the oldest
+# partition. All of the statements below are templates over {table}.
+LEGACY_TABLE = 'messages'
+PARTITION_FORMAT = 'messages_%Y_%m'
+PARTITION_GLOB = 'messages_[0-9][0-9][0-9][0-9]_[0-9][0-9]'
+
 CREATE_TABLE = '''
-CREATE TABLE IF NOT EXISTS messages(
+CREATE TABLE IF NOT EXISTS {table}(
   rowid INTEGER PRIMARY KEY ASC AUTOINCREMENT,
   timestamp TIMESTAMP NOT NULL,
   server_id STRING NOT NULL,
@@ -43,40 +58,137 @@ CREATE TABLE IF NOT EXISTS messages(
   user_id STRING NOT NULL,
   msg_type STRING NOT NULL,
   content STRING NOT NULL,
-  clean_content STRING NOT NULL)
+  clean_content STRING NOT NULL,
+  attachments STRING,
+  embeds STRING)
 '''
 
+# content is stored as '' when it is the same as clean_content. attachments is a JSON list
+# of urls and embeds is the JSON embed list, both NULL if the message had none. Rows
+# logged before these columns existed have both appended to content/clean_content.
+ADDED_COLUMNS = [
+    ('attachments', 'STRING'),
+    ('embeds', 'STRING'),
+]
+
+# Columns rendered as part of clean_content rather than on their own
+HIDDEN_COLUMNS = ('attachments', 'embeds')
+
 CREATE_INDEX_1 = '''
-CREATE INDEX IF NOT EXISTS idx_messages_server_id_channel_id_user_id_timestamp
-ON messages(server_id, channel_id, user_id, timestamp)
+CREATE INDEX IF NOT EXISTS idx_{table}_server_id_channel_id_user_id_timestamp
+ON {table}(server_id, channel_id, user_id, timestamp)
 '''
 
 CREATE_INDEX_2 = '''
-CREATE INDEX IF NOT EXISTS idx_messages_server_id_user_id_timestamp
-ON messages(server_id, user_id, timestamp)
+CREATE INDEX IF NOT EXISTS idx_{table}_server_id_user_id_timestamp
+ON {table}(server_id, user_id, timestamp)
 '''
 
 CREATE_INDEX_3 = '''
-CREATE INDEX IF NOT EXISTS idx_messages_server_id_clean_content
-ON messages(server_id, clean_content)
+CREATE INDEX IF NOT EXISTS idx_{table}_server_id_clean_content
+ON {table}(server_id, clean_content)
 '''
 
 CREATE_INDEX_4 = '''
-CREATE INDEX IF NOT EXISTS idx_messages_server_id_timestamp
-ON messages(server_id, timestamp)
+CREATE INDEX IF NOT EXISTS idx_{table}_server_id_timestamp
+ON {table}(server_id, timestamp)
 '''
 
 CREATE_INDEX_5 = '''
-CREATE INDEX IF NOT EXISTS idx_messages_server_id_channel_id_timestamp
-ON messages(server_id, channel_id, timestamp)
+CREATE INDEX IF NOT EXISTS idx_{table}_server_id_channel_id_timestamp
+ON {table}(server_id, channel_id, timestamp)
+'''
+
+LEGACY_INDEXES = [CREATE_INDEX_1, CREATE_INDEX_2, CREATE_INDEX_3, CREATE_INDEX_4, CREATE_INDEX_5]
+
+# Content search goes through the FTS index and reports through daily_activity, so
+# partitions only need the indexes the per-user/per-channel lookups use.
+PARTITION_INDEXES = [CREATE_INDEX_1, CREATE_INDEX_2, CREATE_INDEX_5]
+
+# Trigram full-text index over clean_content, backing exlog query/whosays. The
+# trigram tokenizer lets LIKE patterns use the index as long as they contain a
+# run of at least 3 literal characters. Kept in sync with {table} by triggers.
+CREATE_FTS_TABLE = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts
+USING fts5(clean_content, content='{table}', content_rowid='rowid', tokenize='trigram')
+'''
+
+CREATE_FTS_INSERT_TRIGGER = '''
+CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+  INSERT INTO {table}_fts(rowid, clean_content) VALUES (new.rowid, new.clean_content);
+END
 '''
 
+CREATE_FTS_DELETE_TRIGGER = '''
+CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+  INSERT INTO {table}_fts({table}_fts, rowid, clean_content) VALUES ('delete', old.rowid, old.clean_content);
+END
+'''
+
+FTS_STATEMENTS = [CREATE_FTS_TABLE, CREATE_FTS_INSERT_TRIGGER, CREATE_FTS_DELETE_TRIGGER]
+
+# Stored in PRAGMA user_version once the legacy messages_fts has been backfilled
+FTS_SCHEMA_VERSION = 1
+
 MAX_LOGS = 500
 
+# exlog queries run on their own thread and are interrupted after READ_TIMEOUT_SECS.
+# The progress handler that enforces this is checked every READ_PROGRESS_OPS VM ops.
+READ_TIMEOUT_SECS = 20
+READ_PROGRESS_OPS = 10000
+
+# exlog results are fetched FETCH_ROWS at a time and formatted into pages of at most
+# PAGE_CHARS as they arrive. Up to MAX_INLINE_PAGES pages are sent as messages, paced
+# SEND_INTERVAL_SECS apart after the first SEND_BURST; anything longer is uploaded as a
+# single text file instead.
+FETCH_ROWS = 50
+PAGE_CHARS = 1900
+MAX_INLINE_PAGES = 5
+SEND_BURST = 3
+SEND_INTERVAL_SECS = 1.0
+
+# Log events are queued and written in batches; a batch is written once it has
+# WRITE_BATCH_ROWS rows or WRITE_INTERVAL_SECS have passed, whichever is first.
+# Events arriving while WRITE_QUEUE_SIZE rows are already waiting are dropped.
+WRITE_BATCH_ROWS = 500
+WRITE_INTERVAL_SECS = 0.25
+WRITE_QUEUE_SIZE = 50000
+
+# One-off migrations over the legacy table (the full-text and daily activity backfills)
+# work through it MIGRATION_BATCH_ROWS at a time, writing queued events in between.
+MIGRATION_BATCH_ROWS = 50000
+
+# Both connections get a 64MB page cache and a 256MB mmap window. The writer
+# checkpoints the WAL back into the database every CHECKPOINT_INTERVAL_SECS.
+CACHE_SIZE_KB = 64 * 1024
+MMAP_SIZE_BYTES = 256 * 1024 * 1024
+CHECKPOINT_INTERVAL_SECS = 5 * 60
+
+# How often expired messages are deleted, per the retention settings, and cold partitions compressed
+RETENTION_INTERVAL_SECS = 6 * 60 * 60
+
+# Partitions that ended more than COMPRESS_AFTER_DAYS ago are compressed: their text
+# columns are zlib compressed (values shorter than COMPRESS_MIN_BYTES are left alone)
+# and their FTS index dropped. Queries read them through the decompress() SQL function.
+COMPRESS_AFTER_DAYS = 30
+COMPRESS_MIN_BYTES = 64
+
+CREATE_COMPRESSED_PARTITIONS_TABLE = '''
+CREATE TABLE IF NOT EXISTS compressed_partitions(
+  name STRING PRIMARY KEY)
+'''
+ARCHIVE_PATH = os.path.join(*PATH_LIST, 'archive')
+
+INSERT_MESSAGE = '''
+INSERT INTO {table}(timestamp, server_id, channel_id, user_id, msg_type, content, clean_content,
+                    attachments, embeds)
+VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
 USER_QUERY = '''
 SELECT * FROM (
-    SELECT timestamp, channel_id, msg_type, clean_content
-    FROM messages INDEXED BY idx_messages_server_id_user_id_timestamp
+    SELECT timestamp, channel_id, msg_type, clean_content, attachments, embeds
+    FROM {table} INDEXED BY idx_{table}_server_id_user_id_timestamp
     WHERE server_id = :server_id
       AND user_id = :user_id
     ORDER BY timestamp DESC
@@ -87,8 +199,8 @@ ORDER BY timestamp ASC
 
 CHANNEL_QUERY = '''
 SELECT * FROM (
-    SELECT timestamp, user_id, msg_type, clean_content
-    FROM messages INDEXED BY idx_messages_server_id_channel_id_timestamp
+    SELECT timestamp, user_id, msg_type, clean_content, attachments, embeds
+    FROM {table} INDEXED BY idx_{table}_server_id_channel_id_timestamp
     WHERE server_id = :server_id
       AND channel_id = :channel_id
       AND user_id <> :bot_id
@@ -100,8 +212,8 @@ ORDER BY timestamp ASC
 
 USER_CHANNEL_QUERY = '''
 SELECT * FROM (
-    SELECT timestamp, msg_type, clean_content
-    FROM messages INDEXED BY idx_messages_server_id_channel_id_user_id_timestamp
+    SELECT timestamp, msg_type, clean_content, attachments, embeds
+    FROM {table} INDEXED BY idx_{table}_server_id_channel_id_user_id_timestamp
     WHERE server_id = :server_id
       AND user_id = :user_id
       AND channel_id = :channel_id
@@ -113,10 +225,10 @@ ORDER BY timestamp ASC
 
 CONTENT_QUERY = '''
 SELECT * FROM (
-    SELECT timestamp, channel_id, user_id, msg_type, clean_content
-    FROM messages INDEXED BY idx_messages_server_id_clean_content
+    SELECT timestamp, channel_id, user_id, msg_type, clean_content, attachments, embeds
+    FROM {table}
     WHERE server_id = :server_id
-      AND lower(clean_content) LIKE lower(:content_query)
+      AND lower({clean_content}) LIKE lower(:content_query)
       AND user_id <> :bot_id
     ORDER BY timestamp DESC
     LIMIT :row_count
@@ -124,100 +236,1017 @@ SELECT * FROM (
 ORDER BY timestamp ASC
 '''
 
+CONTENT_QUERY_FTS = '''
+SELECT * FROM (
+    SELECT m.timestamp, m.channel_id, m.user_id, m.msg_type, m.clean_content, m.attachments, m.embeds
+    FROM {table}_fts
+    JOIN {table} AS m ON m.rowid = {table}_fts.rowid
+    WHERE {table}_fts.clean_content LIKE :content_query
+      AND m.server_id = :server_id
+      AND m.user_id <> :bot_id
+    ORDER BY m.timestamp DESC
+    LIMIT :row_count
+)
+ORDER BY timestamp ASC
+'''
+
 WHOSAYS_QUERY = '''
 SELECT user_id, count(*)
-FROM messages INDEXED BY idx_messages_server_id_clean_content
-WHERE server_id = :server_id
-  AND lower(clean_content) LIKE lower(:content_query)
-  AND user_id <> :bot_id
-  AND msg_type = 'NEW'
+FROM ({union})
 GROUP BY 1
 ORDER BY 2 DESC
 LIMIT :row_count
 '''
 
+WHOSAYS_PARTITION = '''
+SELECT user_id
+FROM {table}
+WHERE server_id = :server_id
+  AND lower({clean_content}) LIKE lower(:content_query)
+  AND user_id <> :bot_id
+  AND msg_type = 'NEW'
+'''
+
+WHOSAYS_PARTITION_FTS = '''
+SELECT m.user_id
+FROM {table}_fts
+JOIN {table} AS m ON m.rowid = {table}_fts.rowid
+WHERE {table}_fts.clean_content LIKE :content_query
+  AND m.server_id = :server_id
+  AND m.user_id <> :bot_id
+  AND m.msg_type = 'NEW'
+'''
+
+# Message counts per server/channel/user/day (UTC), for the report commands. Every logged
+# event (new, edit, delete) counts, same as the raw messages table. Maintained by the
+# batch writer; backfill_daily_activity rebuilds it from the message partitions.
+CREATE_DAILY_ACTIVITY_TABLE = '''
+CREATE {temp}TABLE IF NOT EXISTS {table}(
+  server_id STRING NOT NULL,
+  date STRING NOT NULL,
+  channel_id STRING NOT NULL,
+  user_id STRING NOT NULL,
+  msg_count INTEGER NOT NULL,
+  PRIMARY KEY (server_id, date, channel_id, user_id)) WITHOUT ROWID
+'''
+
+CREATE_DAILY_ACTIVITY_INDEX_1 = '''
+CREATE INDEX IF NOT EXISTS idx_daily_activity_server_id_channel_id_date
+ON daily_activity(server_id, channel_id, date)
+'''
+
+CREATE_DAILY_ACTIVITY_INDEX_2 = '''
+CREATE INDEX IF NOT EXISTS idx_daily_activity_server_id_user_id_date
+ON daily_activity(server_id, user_id, date)
+'''
+
+UPSERT_DAILY_ACTIVITY = '''
+INSERT INTO daily_activity(server_id, date, channel_id, user_id, msg_count)
+VALUES(?, ?, ?, ?, ?)
+ON CONFLICT(server_id, date, channel_id, user_id) DO UPDATE SET msg_count = msg_count + excluded.msg_count
+'''
+
+# Backfills count into scratch copies of daily_activity on the writer connection
+BACKFILL_TABLE = 'temp.backfill_activity'
+LEGACY_BACKFILL_TABLE = 'temp.legacy_activity'
+
+BACKFILL_DAILY_ACTIVITY = '''
+INSERT INTO {target}(server_id, date, channel_id, user_id, msg_count)
+SELECT server_id, DATE(timestamp), channel_id, user_id, count(*)
+FROM {table}
+WHERE {where}
+GROUP BY 1, 2, 3, 4
+ON CONFLICT(server_id, date, channel_id, user_id) DO UPDATE SET msg_count = msg_count + excluded.msg_count
+'''
+
+# The days being rebuilt are deleted first; on a server's oldest surviving day some of its
+# messages may have expired already, so that day's counts only ever go up
+MERGE_DAILY_ACTIVITY = '''
+INSERT INTO daily_activity(server_id, date, channel_id, user_id, msg_count)
+SELECT server_id, date, channel_id, user_id, msg_count
+FROM {source}
+WHERE true
+ON CONFLICT(server_id, date, channel_id, user_id) DO UPDATE SET msg_count = MAX(msg_count, excluded.msg_count)
+'''
+
 DAILY_REPORT_QUERY = '''
-SELECT DATE(timestamp) AS date, COUNT(DISTINCT user_id) AS distinct_users, count(*) AS total_messages
-FROM messages INDEXED BY idx_messages_server_id_timestamp
+SELECT date, COUNT(DISTINCT user_id) AS distinct_users, SUM(msg_count) AS total_messages
+FROM daily_activity
 WHERE server_id = :server_id
-  AND timestamp > :start_timestamp
+  AND date > :start_date
 GROUP BY date
 ORDER BY date DESC
 LIMIT :row_count
 '''
 
 PERIOD_REPORT_QUERY = '''
-SELECT COUNT(DISTINCT user_id) AS distinct_users, count(*) AS total_messages
-FROM messages INDEXED BY idx_messages_server_id_timestamp
+SELECT COUNT(DISTINCT user_id) AS distinct_users, SUM(msg_count) AS total_messages
+FROM daily_activity
 WHERE server_id = :server_id
-  AND timestamp between :start_timestamp and :end_timestamp
+  AND date >= :start_date AND date < :end_date
 '''
 
 CHANNEL_REPORT_QUERY = '''
-SELECT user_id, count(*) AS total_messages
-FROM messages INDEXED BY idx_messages_server_id_channel_id_timestamp
+SELECT user_id, SUM(msg_count) AS total_messages
+FROM daily_activity INDEXED BY idx_daily_activity_server_id_channel_id_date
 WHERE server_id = :server_id
   AND channel_id = :channel_id
-  AND timestamp between :start_timestamp and :end_timestamp
+  AND date >= :start_date AND date < :end_date
 GROUP BY 1
 ORDER BY 2 DESC
 LIMIT :row_count
 '''
 
 USER_REPORT_QUERY = '''
-SELECT channel_id, count(*) AS total_messages
-FROM messages INDEXED BY idx_messages_server_id_user_id_timestamp
+SELECT channel_id, SUM(msg_count) AS total_messages
+FROM daily_activity INDEXED BY idx_daily_activity_server_id_user_id_date
 WHERE server_id = :server_id
   AND user_id = :user_id
-  AND timestamp between :start_timestamp and :end_timestamp
+  AND date >= :start_date AND date < :end_date
 GROUP BY 1
 ORDER BY 2 DESC
 LIMIT :row_count
 '''
 
 SENIORITY_BACKFILL_QUERY = '''
-SELECT user_id, content
-FROM messages INDEXED BY idx_messages_server_id_channel_id_timestamp
+SELECT user_id, content, clean_content
+FROM {table} INDEXED BY idx_{table}_server_id_channel_id_timestamp
 WHERE server_id = :server_id
   AND channel_id = :channel_id
   AND timestamp between :start_timestamp and :end_timestamp
 '''
 
 
+class QueryTimeout(rpadutils.ReportableError):
+    def __init__(self):
+        super(QueryTimeout, self).__init__('Query took too long, try narrowing it down')
+
+
+def cap_rows(query, max_rows):
+    """Wraps a SELECT so that SQLite stops after max_rows rows.
+
+    Other statements (e.g. PRAGMA via rawquery) are returned unchanged.
+    """
+    query = query.strip().rstrip(';')
+    if not query.upper().startswith(('SELECT', 'WITH')):
+        return query
+    return 'SELECT * FROM (\n{}\n) LIMIT {}'.format(query, int(max_rows))
+
+
+class RowSource(object):
+    """The rows of an exlog query, handed out a chunk at a time by fetchmany.
+
+    Wraps either an open cursor or rows that had to be collected up front.
+    """
+
+    def __init__(self, columns, cursor=None, rows=None):
+        self.columns = columns
+        self.cursor = cursor
+        self.rows = deque(rows or [])
+
+    def fetchmany(self, count):
+        if self.cursor is not None:
+            return self.cursor.fetchmany(count)
+        return [self.rows.popleft() for _ in range(min(count, len(self.rows)))]
+
+    def close(self):
+        if self.cursor is not None:
+            self.cursor.close()
+        self.rows.clear()
+
+
+class TablePager(object):
+    """Formats rows into prettytable pages as they arrive, each fitting in one message.
+
+    The page size is estimated from column widths rather than re-rendering the table
+    for every row; pages that still come out too long get split by pagify when sent.
+    """
+
+    def __init__(self, headers, max_chars=PAGE_CHARS):
+        self.headers = headers
+        self.max_chars = max_chars
+        self.page_count = 0
+        self.tbl = None
+        self.start_page()
+
+    def start_page(self):
+        self.tbl = prettytable.PrettyTable(self.headers)
+        self.tbl.hrules = prettytable.HEADER
+        self.tbl.vrules = prettytable.NONE
+        self.tbl.align = 'l'
+        self.widths = [len(h) for h in self.headers]
+        self.line_count = 2  # Header and its rule
+
+    def estimate(self, widths, line_count):
+        # Each column is padded by a space on both sides and separated by one more
+        return (sum(w + 3 for w in widths) + 2) * line_count
+
+    def add_row(self, row):
+        """Adds row, returning the finished previous page if row didn't fit on it."""
+        cell_lines = [str(v).split('\n') for v in row]
+        widths = [max(w, *(len(l) for l in lines)) for w, lines in zip(self.widths, cell_lines)]
+        line_count = self.line_count + max(len(lines) for lines in cell_lines)
+
+        page = None
+        if self.tbl.rowcount and self.estimate(widths, line_count) > self.max_chars:
+            page = self.tbl.get_string()
+            self.page_count += 1
+            self.start_page()
+            widths = [max(w, *(len(l) for l in lines)) for w, lines in zip(self.widths, cell_lines)]
+            line_count = self.line_count + max(len(lines) for lines in cell_lines)
+
+        self.tbl.add_row(row)
+        self.widths = widths
+        self.line_count = line_count
+        return page
+
+    def finish(self):
+        """Returns the last page; an empty result still gets a page with just headers."""
+        if self.tbl.rowcount or not self.page_count:
+            self.page_count += 1
+            return self.tbl.get_string()
+        return None
+
+
+class PageOutput(object):
+    """Collects finished pages, switching to a file once there are too many to send."""
+
+    def __init__(self, max_pages=MAX_INLINE_PAGES):
+        self.max_pages = max_pages
+        self.pages = []
+        self.upload = None
+
+    def add(self, page):
+        if page is None:
+            return
+        if self.upload is None and len(self.pages) < self.max_pages:
+            self.pages.append(page)
+            return
+        if self.upload is None:
+            self.upload = io.StringIO()
+            for p in self.pages:
+                self.upload.write(p + '\n')
+            self.pages = []
+        self.upload.write(page + '\n')
+
+
+def compress(value):
+    if not isinstance(value, str) or len(value) < COMPRESS_MIN_BYTES:
+        return value
+    encoded = value.encode('utf-8')
+    data = zlib.compress(encoded)
+    return data if len(data) < len(encoded) else value
+
+
+def decompress(value):
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode('utf-8')
+    return value
+
+
+def fts_can_serve(pattern):
+    """Whether the trigram index can narrow a LIKE pattern; it needs 3+ literal characters in a row."""
+    return any(len(part) >= 3 for part in re.split('[%_]', pattern))
+
+
+def _tune_connection(con):
+    con.create_function('decompress', 1, decompress)
+    con.create_function('compress', 1, compress)
+    con.execute('PRAGMA cache_size = -{}'.format(CACHE_SIZE_KB))
+    con.execute('PRAGMA mmap_size = {}'.format(MMAP_SIZE_BYTES))
+
+
+def connect_writer(db_path):
+    """Opens the read-write connection, creating the schema if needed.
+
+    The database is switched to WAL mode so readers and the writer don't block each other.
+    """
+    con = lite.connect(db_path, detect_types=lite.PARSE_DECLTYPES, check_same_thread=False)
+    con.execute('PRAGMA journal_mode = WAL')
+    con.execute('PRAGMA synchronous = NORMAL')
+    _tune_connection(con)
+    create_schema(con)
+    return con
+
+
+def create_schema(con):
+    with con:
+        con.execute(CREATE_TABLE.format(table=LEGACY_TABLE))
+        for stmt in LEGACY_INDEXES:
+            con.execute(stmt.format(table=LEGACY_TABLE))
+        con.execute(CREATE_COMPRESSED_PARTITIONS_TABLE)
+        for table in list_partitions(con):
+            add_missing_columns(con, table)
+
+
+def add_missing_columns(con, table):
+    existing = [r[1] for r in con.execute('PRAGMA table_info({})'.format(table))]
+    for name, col_type in ADDED_COLUMNS:
+        if name not in existing:
+            con.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, name, col_type))
+
+
+def partition_for(timestamp):
+    return timestamp.strftime(PARTITION_FORMAT)
+
+
+def partition_range(table):
+    """The [start, end) timestamps a table can hold; the legacy table holds anything."""
+    if table == LEGACY_TABLE:
+        return datetime.min, datetime.max
+    start = datetime.strptime(table, PARTITION_FORMAT)
+    end = (start + timedelta(days=32)).replace(day=1)
+    return start, end
+
+
+def compressed_partitions(con):
+    return set(r[0] for r in con.execute('SELECT name FROM compressed_partitions'))
+
+
+def compress_cold_partitions(con, now=None, cancelled=None):
+    """Compresses partitions that ended more than COMPRESS_AFTER_DAYS ago; returns their names.
+
+    The legacy table is never compressed. If cancelled is given, it's checked before
+    each partition, and compression stops early once it returns True.
+    """
+    now = now or datetime.utcnow()
+    already_compressed = compressed_partitions(con)
+    compressed = []
+    for table in list_partitions(con):
+        if cancelled and cancelled():
+            break
+        if table == LEGACY_TABLE or table in already_compressed:
+            continue
+        _, table_end = partition_range(table)
+        if table_end > now - timedelta(days=COMPRESS_AFTER_DAYS):
+            continue
+        with con:
+            # The FTS triggers reference the index, so they have to go first
+            con.execute('DROP TRIGGER IF EXISTS {}_fts_insert'.format(table))
+            con.execute('DROP TRIGGER IF EXISTS {}_fts_delete'.format(table))
+            con.execute('DROP TABLE IF EXISTS {}_fts'.format(table))
+            con.execute('''UPDATE {} SET content = compress(content),
+                                         clean_content = compress(clean_content),
+                                         embeds = compress(embeds)'''.format(table))
+            con.execute('INSERT INTO compressed_partitions(name) VALUES (?)', (table,))
+        compressed.append(table)
+    return compressed
+
+
+def list_partitions(con):
+    """Every message table, newest first, ending with the legacy table."""
+    rows = con.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB ?",
+                       (PARTITION_GLOB,)).fetchall()
+    return sorted([r[0] for r in rows], reverse=True) + [LEGACY_TABLE]
+
+
+def partitions_between(tables, start, end):
+    """Filters tables to those which could hold timestamps in [start, end)."""
+    result = []
+    for table in tables:
+        table_start, table_end = partition_range(table)
+        if table_start < end and start < table_end:
+            result.append(table)
+    return result
+
+
+def create_partition(con, table, fts):
+    con.execute(CREATE_TABLE.format(table=table))
+    for stmt in PARTITION_INDEXES:
+        con.execute(stmt.format(table=table))
+    if fts:
+        for stmt in FTS_STATEMENTS:
+            con.execute(stmt.format(table=table))
+
+
+def write_messages(con, rows, known_partitions, fts):
+    """Inserts INSERT_MESSAGE rows into their partitions and updates daily_activity.
+
+    Creates partitions as needed; known_partitions is the set of partitions already created.
+    """
+    rows_by_table = defaultdict(list)
+    for row in rows:
+        rows_by_table[partition_for(row[0])].append(row)
+
+    created = []
+    with con:
+        for table, table_rows in rows_by_table.items():
+            if table not in known_partitions:
+                create_partition(con, table, fts)
+                created.append(table)
+            con.executemany(INSERT_MESSAGE.format(table=table), table_rows)
+        con.executemany(UPSERT_DAILY_ACTIVITY, count_daily_activity(rows))
+    known_partitions.update(created)
+
+
+def expire_messages(con, retention_days, default_retention_days, archive_path=None, now=None,
+                    cancelled=None):
+    """Deletes messages older than their server's retention period.
+
+    retention_days maps server_id to days; servers not listed use default_retention_days.
+    0 or None means keep forever. A partition that is entirely expired for every server
+    is dropped outright, after being copied to archive_path if set; partitions left
+    empty by deletions are dropped as well. cancelled works as in compress_cold_partitions.
+
+    Returns a tuple of (deleted row count, dropped table names).
+    """
+    now = now or datetime.utcnow()
+    current_partition = partition_for(now)
+    deleted = 0
+    dropped = []
+
+    def cutoff(days):
+        return now - timedelta(days=days) if days else None
+
+    default_cutoff = cutoff(default_retention_days)
+    server_cutoffs = {server_id: cutoff(days) for server_id, days in retention_days.items()}
+
+    # Only if no server keeps messages forever can whole partitions expire at once
+    all_cutoffs = list(server_cutoffs.values()) + [default_cutoff]
+    oldest_cutoff = None if None in all_cutoffs else min(all_cutoffs)
+
+    for table in list_partitions(con):
+        if cancelled and cancelled():
+            break
+        table_start, table_end = partition_range(table)
+        droppable = table not in (LEGACY_TABLE, current_partition)
+        if droppable and oldest_cutoff and table_end <= oldest_cutoff:
+            if archive_path:
+                archive_partition(con, table, archive_path)
+            drop_partition(con, table)
+            dropped.append(table)
+            continue
+
+        with con:
+            for server_id, server_cutoff in server_cutoffs.items():
+                if server_cutoff and table_start < server_cutoff:
+                    deleted += con.execute(
+                        'DELETE FROM {} WHERE server_id = ? AND timestamp < ?'.format(table),
+                        (server_id, server_cutoff)).rowcount
+            if default_cutoff and table_start < default_cutoff:
+                excluded = list(server_cutoffs.keys())
+                deleted += con.execute(
+                    'DELETE FROM {} WHERE timestamp < ? AND server_id NOT IN ({})'.format(
+                        table, ','.join('?' * len(excluded))),
+                    [default_cutoff] + excluded).rowcount
+
+        if droppable and con.execute('SELECT 1 FROM {} LIMIT 1'.format(table)).fetchone() is None:
+            drop_partition(con, table)
+            dropped.append(table)
+
+    return deleted, dropped
+
+
+def archive_partition(con, table, archive_path):
+    """Copies a partition into its own database file under archive_path."""
+    if not os.path.exists(archive_path):
+        os.makedirs(archive_path)
+    con.execute('ATTACH DATABASE ? AS archive', (os.path.join(archive_path, table + '.db'),))
+    try:
+        with con:
+            con.execute('CREATE TABLE IF NOT EXISTS archive.{0} AS SELECT * FROM main.{0}'.format(table))
+    finally:
+        con.execute('DETACH DATABASE archive')
+
+
+def drop_partition(con, table):
+    with con:
+        con.execute('DROP TABLE IF EXISTS {}_fts'.format(table))
+        con.execute('DROP TABLE {}'.format(table))
+        con.execute('DELETE FROM compressed_partitions WHERE name = ?', (table,))
+
+
+def create_daily_activity_table(con):
+    """Creates daily_activity if needed; returns True if it was just created (and is empty)."""
+    exists = con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'daily_activity'").fetchone()
+    with con:
+        con.execute(CREATE_DAILY_ACTIVITY_TABLE.format(temp='', table='daily_activity'))
+        con.execute(CREATE_DAILY_ACTIVITY_INDEX_1)
+        con.execute(CREATE_DAILY_ACTIVITY_INDEX_2)
+    return exists is None
+
+
+def backfill_daily_activity(con, batch_rows=MIGRATION_BATCH_ROWS):
+    """Recomputes daily_activity from the message partitions, where they still cover it.
+
+    Retention deletes the oldest messages first, so a server's messages are complete from
+    the day after its oldest surviving one. Counts from then on are replaced; the oldest
+    day only has counts raised, and anything earlier (including servers with no messages
+    left) is kept as is, since the messages behind it are gone.
+
+    This is a generator which works in batches, each in its own transaction, and yields
+    between them so other writes can go in; iterate it to the end to run the backfill.
+    """
+    with con:
+        con.execute('DROP TABLE IF EXISTS {}'.format(LEGACY_BACKFILL_TABLE))
+        con.execute(CREATE_DAILY_ACTIVITY_TABLE.format(temp='TEMP ', table='legacy_activity'))
+    # The legacy table doesn't get new messages, so it can be counted ahead of time
+    for first_rowid, last_rowid in rowid_batches(con, LEGACY_TABLE, batch_rows):
+        with con:
+            con.execute(BACKFILL_DAILY_ACTIVITY.format(target=LEGACY_BACKFILL_TABLE, table=LEGACY_TABLE,
+                                                       where='rowid BETWEEN ? AND ?'),
+                        (first_rowid, last_rowid))
+        yield
+
+    seen_servers = set()
+    for month in backfill_months(con):
+        backfill_daily_activity_month(con, month, seen_servers)
+        yield
+
+    with con:
+        con.execute('DROP TABLE {}'.format(LEGACY_BACKFILL_TABLE))
+
+
+def rowid_batches(con, table, batch_rows):
+    """Yields (first, last) rowid ranges covering table, each holding up to batch_rows rows.
+
+    Each range is looked up when the previous one is done with.
+    """
+    last_rowid = -1
+    while True:
+        first_rowid, last_rowid = con.execute(
+            '''SELECT MIN(rowid), MAX(rowid) FROM (
+                 SELECT rowid FROM {} WHERE rowid > ? ORDER BY rowid LIMIT ?)'''.format(table),
+            (last_rowid, batch_rows)).fetchone()
+        if first_rowid is None:
+            return
+        yield first_rowid, last_rowid
+
+
+def backfill_months(con):
+    """The first day of every month that has messages to backfill from, oldest first."""
+    months = set(partition_range(table)[0] for table in list_partitions(con) if table != LEGACY_TABLE)
+    for r in con.execute('SELECT DISTINCT SUBSTR(date, 1, 7) FROM {}'.format(LEGACY_BACKFILL_TABLE)):
+        months.add(datetime.strptime(r[0], '%Y-%m'))
+    return sorted(months)
+
+
+def backfill_daily_activity_month(con, month, seen_servers):
+    """Recomputes daily_activity for the month starting at month; see backfill_daily_activity.
+
+    Months must be done oldest first, once the legacy table has been counted into
+    LEGACY_BACKFILL_TABLE; seen_servers collects the servers that had messages in
+    earlier months.
+    """
+    _, month_end = partition_range(partition_for(month))
+    start, end = month.date().isoformat(), month_end.date().isoformat()
+    with con:
+        con.execute('DROP TABLE IF EXISTS {}'.format(BACKFILL_TABLE))
+        con.execute(CREATE_DAILY_ACTIVITY_TABLE.format(temp='TEMP ', table='backfill_activity'))
+        con.execute('INSERT INTO {} SELECT * FROM {} WHERE date >= ? AND date < ?'.format(
+            BACKFILL_TABLE, LEGACY_BACKFILL_TABLE), (start, end))
+        partitions = [t for t in list_partitions(con) if t != LEGACY_TABLE]
+        for table in partitions_between(partitions, month, month_end):
+            con.execute(BACKFILL_DAILY_ACTIVITY.format(target=BACKFILL_TABLE, table=table, where='true'))
+
+        first_dates = con.execute('SELECT server_id, MIN(date) FROM {} GROUP BY server_id'.format(
+            BACKFILL_TABLE)).fetchall()
+        for server_id, first_date in first_dates:
+            # Counts up to and including the server's oldest surviving day are kept
+            keep_through = '' if server_id in seen_servers else first_date
+            con.execute('''DELETE FROM daily_activity
+                           WHERE server_id = ? AND date >= ? AND date < ? AND date > ?''',
+                        (server_id, start, end, keep_through))
+        con.execute(MERGE_DAILY_ACTIVITY.format(source=BACKFILL_TABLE))
+        con.execute('DROP TABLE {}'.format(BACKFILL_TABLE))
+    seen_servers.update(r[0] for r in first_dates)
+
+
+def next_batch(batches):
+    """Runs the next batch of a generator like backfill_daily_activity; False once it's done."""
+    for _ in batches:
+        return True
+    return False
+
+
+def count_daily_activity(rows):
+    """Groups INSERT_MESSAGE rows into UPSERT_DAILY_ACTIVITY rows."""
+    counts = defaultdict(int)
+    for timestamp, server_id, channel_id, user_id, *_ in rows:
+        counts[(server_id, timestamp.date().isoformat(), channel_id, user_id)] += 1
+    return [k + (v,) for k, v in counts.items()]
+
+
+def create_fts_index(con):
+    """Creates the legacy messages_fts and its triggers if this SQLite build supports trigram FTS5.
+
+    Returns a tuple of (available, needs_rebuild); if needs_rebuild is set, existing
+    messages have not been indexed yet and rebuild_fts_index must be run. Partitions get
+    their own index when they are created.
+    """
+    try:
+        with con:
+            for stmt in FTS_STATEMENTS:
+                con.execute(stmt.format(table=LEGACY_TABLE))
+    except lite.OperationalError as ex:
+        print('sqlactivitylog full-text index unavailable: ' + str(ex))
+        return False, False
+
+    user_version = con.execute('PRAGMA user_version').fetchone()[0]
+    return True, user_version < FTS_SCHEMA_VERSION
+
+
+def rebuild_fts_index(con, batch_rows=MIGRATION_BATCH_ROWS):
+    """Indexes every existing legacy message; new messages are indexed by the triggers.
+
+    Like backfill_daily_activity, this is a generator that yields between batches.
+    """
+    with con:
+        # Clears out anything indexed by an earlier rebuild that didn't finish
+        con.execute("INSERT INTO messages_fts(messages_fts) VALUES ('delete-all')")
+    for first_rowid, last_rowid in rowid_batches(con, LEGACY_TABLE, batch_rows):
+        with con:
+            con.execute('''INSERT INTO messages_fts(rowid, clean_content)
+                           SELECT rowid, clean_content FROM messages WHERE rowid BETWEEN ? AND ?''',
+                        (first_rowid, last_rowid))
+        yield
+    with con:
+        con.execute('PRAGMA user_version = {}'.format(FTS_SCHEMA_VERSION))
+
+
+def connect_reader(db_path):
+    """Opens a read-only connection; connect_writer must have been called first."""
+    uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(db_path)))
+    con = lite.connect(uri, uri=True, detect_types=lite.PARSE_DECLTYPES, check_same_thread=False)
+    con.row_factory = lite.Row
+    _tune_connection(con)
+    return con
+
+
+class LatestQuery(object):
+    """Finds the newest row_count matching messages, searching partitions newest first.
+
+    template selects from {table}, returning up to :row_count rows in timestamp order.
+    Compressed partitions use cold_template instead, if given; templates may refer to
+    {clean_content}, which is wrapped in decompress() for compressed partitions.
+    """
+
+    def __init__(self, template, cold_template=None):
+        self.template = template
+        self.cold_template = cold_template or template
+
+    def run(self, con, values, max_rows):
+        values = dict(values)
+        remaining = min(values['row_count'], max_rows)
+        compressed = compressed_partitions(con)
+        chunks = []
+        columns = None
+        for table in list_partitions(con):
+            if remaining <= 0:
+                break
+            values['row_count'] = remaining
+            sql = format_partition_query(self.template, self.cold_template, table, compressed)
+            cursor = con.execute(sql, values)
+            rows = cursor.fetchall()
+            columns = [d[0] for d in cursor.description]
+            chunks.append(rows)
+            remaining -= len(rows)
+        # Each chunk is older than the one before it
+        return [r for chunk in reversed(chunks) for r in chunk], columns
+
+    def open(self, con, values, max_rows):
+        # Rows are only in timestamp order once every partition has been read
+        rows, columns = self.run(con, values, max_rows)
+        return RowSource(columns, rows=rows)
+
+
+class UnionQuery(object):
+    """Runs part_template over every partition, UNION ALLed into {union} of template.
+
+    cold_part_template is used for compressed partitions, as in LatestQuery.
+    """
+
+    def __init__(self, template, part_template, cold_part_template=None):
+        self.template = template
+        self.part_template = part_template
+        self.cold_part_template = cold_part_template or part_template
+
+    def run(self, con, values, max_rows):
+        source = self.open(con, values, max_rows)
+        try:
+            return source.fetchmany(max_rows), source.columns
+        finally:
+            source.close()
+
+    def open(self, con, values, max_rows):
+        compressed = compressed_partitions(con)
+        union = 'UNION ALL'.join(
+            format_partition_query(self.part_template, self.cold_part_template, t, compressed)
+            for t in list_partitions(con))
+        cursor = con.execute(cap_rows(self.template.format(union=union), max_rows), values)
+        return RowSource([d[0] for d in cursor.description], cursor=cursor)
+
+
+def format_partition_query(template, cold_template, table, compressed):
+    if table in compressed:
+        return cold_template.format(table=table, clean_content='decompress(clean_content)')
+    return template.format(table=table, clean_content='clean_content')
+
+
+def format_message(clean_content, attachments, embeds):
+    """Rebuilds the text shown for a message from its stored columns."""
+    text = decompress(clean_content) or ''
+    attachments = decompress(attachments)
+    embeds = decompress(embeds)
+    if attachments:
+        text = (text + '\nattachments: ' + ' '.join(json.loads(attachments))).strip()
+    if embeds:
+        text = (text + '\nembeds: ' + str(len(json.loads(embeds)))).strip()
+    return text
+
+
 class SqlActivityLogger(object):
     """Log activity seen by bot"""
 
     def __init__(self, bot):
         self.bot = bot
         self.settings = dataIO.load_json(JSON)
+        self.settings.setdefault('retention_days', {})
+        self.settings.setdefault('default_retention_days', 0)
+        self.settings.setdefault('archive_expired', False)
         self.lock = False
-        self.con = lite.connect(DB, detect_types=lite.PARSE_DECLTYPES)
-        self.con.row_factory = lite.Row
-        self.con.execute(CREATE_TABLE)
-        self.con.execute(CREATE_INDEX_1)
-        self.con.execute(CREATE_INDEX_2)
-        self.con.execute(CREATE_INDEX_3)
-        self.con.execute(CREATE_INDEX_4)
-        self.con.execute(CREATE_INDEX_5)
+        # Only ever used from write_executor
+        self.write_con = connect_writer(DB)
+        # Used for exlog and other reads
+        self.con = connect_reader(DB)
+        self.fts_available, self.fts_needs_rebuild = create_fts_index(self.write_con)
+        self.daily_activity_needs_backfill = create_daily_activity_table(self.write_con)
+        self.known_partitions = set(list_partitions(self.write_con))
+        self.write_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # self.con is only used for queries from read_executor
+        self.read_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.write_queue = deque()
+        self.batch_ready = asyncio.Event()
+        # Held by migrations, retention and backfills, which shouldn't interleave
+        self.maintenance_lock = asyncio.Lock()
+        self.dropped_count = 0
+        self.written_count = 0
+        self.last_checkpoint = timeit.default_timer()
+        self.closed = False
+
         self.insert_timing = deque(maxlen=1000)
 
     def __unload(self):
         self.lock = True
-        self.con.close()
+        # Long jobs on the writer check this between partitions or batches and stop early
+        self.closed = True
+        # Neither executor is waited on; the connections are closed once their threads
+        # finish what they're doing. Reads are only for commands, so they're cut short.
+        self.con.interrupt()
+        self.read_executor.submit(self.con.close)
+        self.read_executor.shutdown(wait=False)
+        self.write_executor.submit(self.close_writer)
+        self.write_executor.shutdown(wait=False)
+
+    def close_writer(self):
+        """Writes whatever is still queued, then closes write_con; runs last on write_executor."""
+        try:
+            self.write_rows(self.drain_queue(len(self.write_queue)))
+        except Exception as ex:
+            print('sqlactivitylog failed to flush on unload: ' + str(ex))
+        self.write_con.close()
+
+    def is_closed(self):
+        return self.closed
+
+    def fts_ready(self):
+        return self.fts_available and not self.fts_needs_rebuild
+
+    async def rebuild_fts(self):
+        print('sqlactivitylog backfilling full-text index')
+        before_time = timeit.default_timer()
+        if not await self.run_migration(rebuild_fts_index(self.write_con)):
+            print('sqlactivitylog full-text backfill stopped by unload')
+            return
+        self.fts_needs_rebuild = False
+        print('sqlactivitylog full-text index done in {}s'.format(
+            round(timeit.default_timer() - before_time, 2)))
+
+    async def backfill_daily_activity(self):
+        """Returns how long the backfill took, or None if it was stopped by unloading."""
+        print('sqlactivitylog backfilling daily activity')
+        before_time = timeit.default_timer()
+        if not await self.run_migration(backfill_daily_activity(self.write_con)):
+            print('sqlactivitylog daily activity backfill stopped by unload, run backfillactivity to finish it')
+            return None
+        self.daily_activity_needs_backfill = False
+        execution_time = timeit.default_timer() - before_time
+        print('sqlactivitylog daily activity done in {}s'.format(round(execution_time, 2)))
+        return execution_time
+
+    async def run_migration(self, batches):
+        """Runs a generator like rebuild_fts_index on write_executor a batch at a time.
+
+        Queued events are written between batches, so the queue keeps draining while a
+        long migration runs. Returns False if the cog was unloaded before it finished.
+        """
+        while not self.closed:
+            if not await self.bot.loop.run_in_executor(self.write_executor, next_batch, batches):
+                return True
+            await self.write_queued()
+        return False
+
+    async def write_loop(self):
+        # Retention waits for these, since it deletes from the tables being migrated
+        async with self.maintenance_lock:
+            if self.fts_needs_rebuild:
+                try:
+                    await self.rebuild_fts()
+                except Exception as ex:
+                    print('sqlactivitylog full-text backfill failed ' + str(ex))
+                    traceback.print_exc()
+
+            if self.daily_activity_needs_backfill and not self.closed:
+                try:
+                    await self.backfill_daily_activity()
+                except Exception as ex:
+                    print('sqlactivitylog daily activity backfill failed ' + str(ex))
+                    traceback.print_exc()
+
+        while self == self.bot.get_cog('SqlActivityLogger'):
+            try:
+                await asyncio.wait_for(self.batch_ready.wait(), WRITE_INTERVAL_SECS)
+            except asyncio.TimeoutError:
+                pass
+            self.batch_ready.clear()
+
+            try:
+                await self.write_queued()
+
+                if timeit.default_timer() - self.last_checkpoint > CHECKPOINT_INTERVAL_SECS and not self.closed:
+                    await self.bot.loop.run_in_executor(self.write_executor, self.checkpoint)
+            except Exception as ex:
+                print('sqlactivitylog write loop caught exception ' + str(ex))
+                traceback.print_exc()
+
+    async def write_queued(self):
+        """Writes the events queued so far; ones that arrive meanwhile wait for the next call."""
+        remaining = len(self.write_queue)
+        while remaining > 0 and not self.closed:
+            rows = self.drain_queue(min(remaining, WRITE_BATCH_ROWS))
+            remaining -= WRITE_BATCH_ROWS
+            await self.bot.loop.run_in_executor(self.write_executor, self.write_rows, rows)
+
+    def drain_queue(self, max_rows):
+        rows = []
+        while self.write_queue and len(rows) < max_rows:
+            rows.append(self.write_queue.popleft())
+        return rows
+
+    def checkpoint(self):
+        self.last_checkpoint = timeit.default_timer()
+        self.write_con.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def write_rows(self, rows):
+        if not rows:
+            return
+        before_time = timeit.default_timer()
+        write_messages(self.write_con, rows, self.known_partitions, self.fts_available)
+        execution_time = timeit.default_timer() - before_time
+        self.insert_timing.append((execution_time, len(rows)))
+        self.written_count += len(rows)
+
+    async def retention_loop(self):
+        await self.bot.wait_until_ready()
+        while self == self.bot.get_cog('SqlActivityLogger'):
+            try:
+                await self.run_retention()
+            except Exception as ex:
+                print('sqlactivitylog retention loop caught exception ' + str(ex))
+                traceback.print_exc()
+
+            await asyncio.sleep(RETENTION_INTERVAL_SECS)
+
+    async def run_retention(self):
+        archive_path = ARCHIVE_PATH if self.settings['archive_expired'] else None
+        async with self.maintenance_lock:
+            deleted, dropped = await self.bot.loop.run_in_executor(
+                self.write_executor, self.expire_messages, archive_path)
+            print('sqlactivitylog retention deleted {} messages and dropped {}'.format(deleted, dropped))
+            if self.closed:
+                return deleted, dropped
+            compressed = await self.bot.loop.run_in_executor(
+                self.write_executor, compress_cold_partitions, self.write_con, None, self.is_closed)
+            print('sqlactivitylog compressed {}'.format(compressed))
+        return deleted, dropped
+
+    def execute_write(self, statement):
+        """Runs an arbitrary statement on write_con; must be called on write_executor."""
+        with self.write_con:
+            cursor = self.write_con.execute(statement)
+            rows = cursor.fetchmany(MAX_LOGS)
+        # The statement may have created or dropped partitions
+        self.known_partitions = set(list_partitions(self.write_con))
+        return cursor.rowcount, rows
+
+    def expire_messages(self, archive_path):
+        deleted, dropped = expire_messages(self.write_con,
+                                           self.settings['retention_days'],
+                                           self.settings['default_retention_days'],
+                                           archive_path,
+                                           cancelled=self.is_closed)
+        self.known_partitions.difference_update(dropped)
+        return deleted, dropped
 
     @commands.command(pass_context=True)
     @checks.is_owner()
     async def rawquery(self, ctx, *, query: str):
+        """Runs a read-only SQL query against the log and prints the results.
+
+        This uses the read-only connection, with the same timeout as exlog; statements
+        that write (DELETE, VACUUM, PRAGMA assignments, etc) fail here, use rawexec.
+        """
         await self.queryAndPrint(ctx.message.server, query, {}, {})
 
+    @commands.command(pass_context=True)
+    @checks.is_owner()
+    async def rawexec(self, ctx, *, statement: str):
+        """Runs a single SQL statement that writes to the log, like DELETE or VACUUM.
+
+        The statement runs on the writer thread, queued behind message writes, with no
+        timeout. Any rows it returns (e.g. from a PRAGMA) are printed.
+        """
+        before_time = timeit.default_timer()
+        changed, rows = await self.bot.loop.run_in_executor(self.write_executor, self.execute_write, statement)
+        execution_time = timeit.default_timer() - before_time
+        msg = '{} rows changed in {}s'.format(max(changed, 0), round(execution_time, 2))
+        if rows:
+            msg += '\n' + '\n'.join(str(tuple(r)) for r in rows)
+        for page in pagify(msg):
+            await self.bot.say(box(page))
+
     @commands.command(pass_context=True)
     @checks.is_owner()
     async def inserttiming(self, ctx):
-        size = len(self.insert_timing)
-        avg_time = round(sum(self.insert_timing) / size, 4)
-        max_time = round(max(self.insert_timing), 4)
-        min_time = round(min(self.insert_timing), 4)
-        await self.bot.say(inline('{} inserts, min={} max={} avg={}'.format(size, min_time, max_time, avg_time)))
+        msg = 'queued={}/{} written={} dropped={}'.format(
+            len(self.write_queue), WRITE_QUEUE_SIZE, self.written_count, self.dropped_count)
+        timings = list(self.insert_timing)
+        if timings:
+            size = len(timings)
+            row_count = sum(t[1] for t in timings)
+            batch_times = [t[0] for t in timings]
+            avg_time = round(sum(batch_times) / size, 4)
+            max_time = round(max(batch_times), 4)
+            min_time = round(min(batch_times), 4)
+            msg = '{} batches ({} rows), min={} max={} avg={}, {}'.format(
+                size, row_count, min_time, max_time, avg_time, msg)
+        await self.bot.say(inline(msg))
+
+    @commands.command(pass_context=True)
+    @checks.is_owner()
+    async def backfillactivity(self, ctx):
+        """Rebuilds the daily activity counts used by the exlog reports.
+
+        Only days the message log still fully covers are rebuilt; counts from before
+        retention expired the messages behind them are kept.
+        """
+        await self.bot.say(inline('Rebuilding daily activity from the message log'))
+        async with self.maintenance_lock:
+            execution_time = await self.backfill_daily_activity()
+        if execution_time is None:
+            return
+        await self.bot.say(inline('Done in {}s'.format(round(execution_time, 2))))
+
+    @commands.command(pass_context=True, no_pm=True)
+    @checks.is_owner()
+    async def logretention(self, ctx, days: int=None):
+        """Sets how many days of messages are kept for this server.
+
+        0 keeps messages forever, even if there is a default retention.
+        Leave days off to clear the server setting and use the default.
+        """
+        server_id = ctx.message.server.id
+        if days is None:
+            self.settings['retention_days'].pop(server_id, None)
+        else:
+            self.settings['retention_days'][server_id] = max(days, 0)
+        self.save_json()
+        await self.bot.say(inline('Retention for this server is now {}, default is {}'.format(
+            self.settings['retention_days'].get(server_id, 'default'),
+            self.settings['default_retention_days'])))
+
+    @commands.command(pass_context=True)
+    @checks.is_owner()
+    async def logretentiondefault(self, ctx, days: int):
+        """Sets how many days of messages are kept for servers without a setting, 0 for forever."""
+        self.settings['default_retention_days'] = max(days, 0)
+        self.save_json()
+        await self.bot.say(inline('Default retention is now {}'.format(days)))
+
+    @commands.command(pass_context=True)
+    @checks.is_owner()
+    async def togglelogarchive(self, ctx):
+        """Toggles copying expired monthly partitions to the archive folder before dropping them."""
+        self.settings['archive_expired'] = not self.settings['archive_expired']
+        self.save_json()
+        await self.bot.say(inline('Archiving is now {}'.format(self.settings['archive_expired'])))
+
+    @commands.command(pass_context=True)
+    @checks.is_owner()
+    async def runlogretention(self, ctx):
+        """Deletes expired messages and compresses cold partitions now, instead of waiting."""
+        deleted, dropped = await self.run_retention()
+        await self.bot.say(inline('Deleted {} messages, dropped {}'.format(deleted, dropped)))
 
     @commands.command(pass_context=True)
     @checks.is_owner()
@@ -257,7 +1286,7 @@ class SqlActivityLogger(object):
             ('clean_content', 'Message'),
         ]
 
-        await self.queryAndPrint(server, USER_QUERY, values, column_data)
+        await self.queryAndPrint(server, LatestQuery(USER_QUERY), values, column_data)
 
     @exlog.command(pass_context=True, no_pm=True)
     async def channel(self, ctx, channel: discord.Channel, count=10):
@@ -282,7 +1311,7 @@ class SqlActivityLogger(object):
             ('clean_content', 'Message'),
         ]
 
-        await self.queryAndPrint(server, CHANNEL_QUERY, values, column_data)
+        await self.queryAndPrint(server, LatestQuery(CHANNEL_QUERY), values, column_data)
 
     @exlog.command(pass_context=True, no_pm=True)
     async def userchannel(self, ctx, user: discord.User, channel: discord.Channel, count=10):
@@ -305,7 +1334,7 @@ class SqlActivityLogger(object):
             ('clean_content', 'Message'),
         ]
 
-        await self.queryAndPrint(server, USER_CHANNEL_QUERY, values, column_data)
+        await self.queryAndPrint(server, LatestQuery(USER_CHANNEL_QUERY), values, column_data)
 
     @exlog.command(pass_context=True, no_pm=True)
     async def query(self, ctx, query, count=10):
@@ -336,7 +1365,8 @@ class SqlActivityLogger(object):
             ('clean_content', 'Message'),
         ]
 
-        await self.queryAndPrint(server, CONTENT_QUERY, values, column_data)
+        sql = CONTENT_QUERY_FTS if self.fts_ready() and fts_can_serve(query) else CONTENT_QUERY
+        await self.queryAndPrint(server, LatestQuery(sql, CONTENT_QUERY), values, column_data)
 
     @exlog.command(pass_context=True, no_pm=True)
     async def whosays(self, ctx, query, count=10):
@@ -363,7 +1393,10 @@ class SqlActivityLogger(object):
             ('user_id', 'User'),
         ]
 
-        await self.queryAndPrint(server, WHOSAYS_QUERY, values, column_data)
+        use_fts = self.fts_ready() and fts_can_serve(query)
+        part_sql = WHOSAYS_PARTITION_FTS if use_fts else WHOSAYS_PARTITION
+        await self.queryAndPrint(server, UnionQuery(WHOSAYS_QUERY, part_sql, WHOSAYS_PARTITION),
+                                 values, column_data)
 
     @exlog.command(pass_context=True, no_pm=True)
     async def dailyreport(self, ctx, count=10):
@@ -377,7 +1410,7 @@ class SqlActivityLogger(object):
         values = {
             'server_id': server.id,
             'row_count': count,
-            'start_timestamp': start_date,
+            'start_date': start_date.date().isoformat(),
         }
         column_data = []
 
@@ -392,17 +1425,14 @@ class SqlActivityLogger(object):
         described above.
         Start date is inclusive, end date is exclusive.
         """
-        start_date = datetime.strptime(start_date, "%Y-%m-%d")
-        end_date = datetime.strptime(end_date, "%Y-%m-%d")
-
-        start_date = start_date.replace(tzinfo=pytz.utc)
-        end_date = end_date.replace(tzinfo=pytz.utc)
+        start_date = datetime.strptime(start_date, "%Y-%m-%d").date()
+        end_date = datetime.strptime(end_date, "%Y-%m-%d").date()
 
         server = ctx.message.server
         values = {
             'server_id': server.id,
-            'start_timestamp': start_date,
-            'end_timestamp': end_date,
+            'start_date': start_date.isoformat(),
+            'end_date': end_date.isoformat(),
         }
         column_data = []
 
@@ -418,18 +1448,15 @@ class SqlActivityLogger(object):
         Start date is inclusive, end date is exclusive.
         """
         count = min(count, 30)
-        start_date = datetime.strptime(start_date, "%Y-%m-%d")
-        end_date = datetime.strptime(end_date, "%Y-%m-%d")
-
-        start_date = start_date.replace(tzinfo=pytz.utc)
-        end_date = end_date.replace(tzinfo=pytz.utc)
+        start_date = datetime.strptime(start_date, "%Y-%m-%d").date()
+        end_date = datetime.strptime(end_date, "%Y-%m-%d").date()
 
         server = ctx.message.server
         values = {
             'server_id': server.id,
             'channel_id': channel.id,
-            'start_timestamp': start_date,
-            'end_timestamp': end_date,
+            'start_date': start_date.isoformat(),
+            'end_date': end_date.isoformat(),
             'row_count': count,
         }
         column_data = []
@@ -446,84 +1473,138 @@ class SqlActivityLogger(object):
         Start date is inclusive, end date is exclusive.
         """
         count = min(count, 30)
-        start_date = datetime.strptime(start_date, "%Y-%m-%d")
-        end_date = datetime.strptime(end_date, "%Y-%m-%d")
-
-        start_date = start_date.replace(tzinfo=pytz.utc)
-        end_date = end_date.replace(tzinfo=pytz.utc)
+        start_date = datetime.strptime(start_date, "%Y-%m-%d").date()
+        end_date = datetime.strptime(end_date, "%Y-%m-%d").date()
 
         server = ctx.message.server
         values = {
             'server_id': server.id,
             'user_id': user.id,
-            'start_timestamp': start_date,
-            'end_timestamp': end_date,
+            'start_date': start_date.isoformat(),
+            'end_date': end_date.isoformat(),
             'row_count': count,
         }
         column_data = []
 
         await self.queryAndPrint(server, USER_REPORT_QUERY, values, column_data)
 
+    def run_read(self, deadline, fn, *args):
+        """Calls fn, interrupting any query it runs past deadline; must be called on read_executor."""
+        self.con.set_progress_handler(lambda: timeit.default_timer() > deadline, READ_PROGRESS_OPS)
+        try:
+            return fn(*args)
+        except lite.OperationalError as ex:
+            if 'interrupted' in str(ex):
+                raise QueryTimeout()
+            raise
+        finally:
+            self.con.set_progress_handler(None, READ_PROGRESS_OPS)
+
+    def open_query(self, query, values, max_rows):
+        """Starts a read query, returning a RowSource; must be called on read_executor.
+
+        query is either SQL or a LatestQuery/UnionQuery over the message partitions.
+        """
+        if isinstance(query, str):
+            cursor = self.con.execute(cap_rows(query, max_rows), values)
+            return RowSource([d[0] for d in cursor.description or []], cursor=cursor)
+        return query.open(self.con, values, max_rows)
+
+    async def read(self, deadline, fn, *args):
+        return await self.bot.loop.run_in_executor(
+            self.read_executor, self.run_read, deadline, fn, *args)
+
     async def queryAndPrint(self, server, query, values, column_data, max_rows=MAX_LOGS * 2):
+        deadline = timeit.default_timer() + READ_TIMEOUT_SECS
         before_time = timeit.default_timer()
-        cursor = self.con.execute(query, values)
-        rows = cursor.fetchall()
+        source = await self.read(deadline, self.open_query, query, values, max_rows)
         execution_time = timeit.default_timer() - before_time
 
-        if len(column_data) == 0:
-            column_data = ALL_COLUMNS
-
-        results_columns = [d[0] for d in cursor.description]
-        column_data = [r for r in column_data if r[0] in results_columns]
-        for missing_col in [col for col in results_columns if col not in [c[0] for c in column_data]]:
-            column_data.append((missing_col, missing_col))
-
-        column_names = [c[0] for c in column_data]
-        column_headers = [c[1] for c in column_data]
-
-        tbl = prettytable.PrettyTable(column_headers)
-        tbl.hrules = prettytable.HEADER
-        tbl.vrules = prettytable.NONE
-        tbl.align = 'l'
-
-        for idx, row in enumerate(rows):
-            if idx > max_rows:
-                break
-
-            table_row = list()
-            for col in column_names:
-                if col not in row.keys():
-                    table_row.append('')
-                    continue
-                raw_value = row[col]
-                value = str(raw_value)
-                if col == 'timestamp':
-                    # Assign a UTC timezone to the datetime
-                    raw_value = raw_value.replace(tzinfo=pytz.utc)
-                    # Change the UTC timezone to PT
-                    raw_value = NA_TZ_OBJ.normalize(raw_value)
-                    value = raw_value.strftime("%F %X")
-                if col == 'channel_id':
-                    channel = server.get_channel(value) if server else None
-                    value = channel.name if channel else value
-                if col == 'user_id':
-                    member = server.get_member(value) if server else None
-                    value = member.name if member else value
-                if col == 'server_id':
-                    server_obj = self.bot.get_server(value)
-                    value = server_obj.name if server_obj else value
-                if col == 'clean_content':
-                    value = value.replace('```', '~~~')
-                    value = value.replace('`', '\`')
-                    value = '\n'.join(textwrap.wrap(value, 60))
-                table_row.append(value)
-
-            tbl.add_row(table_row)
-
-        result_text = "{} results fetched in {}s\n{}".format(
-            len(rows), round(execution_time, 2), tbl.get_string())
-        for p in pagify(result_text):
-            await self.bot.say(box(p))
+        try:
+            results_columns = source.columns
+            if len(column_data) == 0:
+                column_data = ALL_COLUMNS
+
+            column_data = [r for r in column_data if r[0] in results_columns]
+            for missing_col in [col for col in results_columns if col not in [c[0] for c in column_data]]:
+                if missing_col not in HIDDEN_COLUMNS:
+                    column_data.append((missing_col, missing_col))
+
+            column_names = [c[0] for c in column_data]
+            column_headers = [c[1] for c in column_data]
+
+            # Pages are held until it's clear whether they fit inline; past that they
+            # go straight into the file that gets uploaded instead
+            pager = TablePager(column_headers)
+            output = PageOutput()
+            row_count = 0
+            while True:
+                before_time = timeit.default_timer()
+                rows = await self.read(deadline, source.fetchmany, FETCH_ROWS)
+                execution_time += timeit.default_timer() - before_time
+                if not rows:
+                    break
+                row_count += len(rows)
+                for row in rows:
+                    output.add(pager.add_row(self.format_row(server, row, column_names)))
+        finally:
+            await self.bot.loop.run_in_executor(self.read_executor, source.close)
+        output.add(pager.finish())
+
+        summary = "{} results fetched in {}s".format(row_count, round(execution_time, 2))
+        if output.upload is not None:
+            data = io.BytesIO(output.upload.getvalue().encode('utf-8'))
+            await self.bot.upload(data, filename='exlog.txt',
+                                  content=inline('{} ({} pages)'.format(summary, pager.page_count)))
+        else:
+            pages = output.pages
+            pages[0] = '{}\n{}'.format(summary, pages[0])
+            await self.send_pages(pages)
+
+    def format_row(self, server, row, column_names):
+        table_row = list()
+        for col in column_names:
+            if col not in row.keys():
+                table_row.append('')
+                continue
+            raw_value = decompress(row[col])
+            if col == 'clean_content':
+                raw_value = format_message(
+                    raw_value,
+                    row['attachments'] if 'attachments' in row.keys() else None,
+                    row['embeds'] if 'embeds' in row.keys() else None)
+            value = str(raw_value)
+            if col == 'timestamp':
+                # Assign a UTC timezone to the datetime
+                raw_value = raw_value.replace(tzinfo=pytz.utc)
+                # Change the UTC timezone to PT
+                raw_value = NA_TZ_OBJ.normalize(raw_value)
+                value = raw_value.strftime("%F %X")
+            if col == 'channel_id':
+                channel = server.get_channel(value) if server else None
+                value = channel.name if channel else value
+            if col == 'user_id':
+                member = server.get_member(value) if server else None
+                value = member.name if member else value
+            if col == 'server_id':
+                server_obj = self.bot.get_server(value)
+                value = server_obj.name if server_obj else value
+            if col == 'clean_content':
+                value = value.replace('```', '~~~')
+                value = value.replace('`', '\`')
+                value = '\n'.join(textwrap.wrap(value, 60))
+            table_row.append(value)
+        return table_row
+
+    async def send_pages(self, pages):
+        """Sends each page boxed, pacing messages once past the channel's burst allowance."""
+        sent = 0
+        for page in pages:
+            for p in pagify(page):
+                if sent >= SEND_BURST:
+                    await asyncio.sleep(SEND_INTERVAL_SECS)
+                await self.bot.say(box(p))
+                sent += 1
 
     def save_json(self):
         dataIO.save_json(JSON, self.settings)
@@ -544,43 +1625,41 @@ class SqlActivityLogger(object):
         if message.author.id == self.bot.user.id:
             return
 
-        stmt = '''
-          INSERT INTO messages(timestamp, server_id, channel_id, user_id, msg_type, content, clean_content)
-          VALUES(:timestamp, :server_id, :channel_id, :user_id, :msg_type, :content, :clean_content)
-        '''
+        if len(self.write_queue) >= WRITE_QUEUE_SIZE:
+            self.dropped_count += 1
+            return
+
         timestamp = timestamp or datetime.utcnow()
         server_id = message.server.id if message.server else -1
         channel_id = message.channel.id if message.channel else -1
 
-        msg_content = message.content
         msg_clean_content = message.clean_content
+        # Usually the same, in which case there's no need to store it twice
+        msg_content = '' if message.content == msg_clean_content else message.content
+
+        attachments = None
         if message.attachments:
-            extra_txt = '\nattachments: ' + str(message.attachments)
-            msg_content = (msg_content + extra_txt).strip()
-            msg_clean_content = (msg_clean_content + extra_txt).strip()
+            attachments = json.dumps([a.get('url') for a in message.attachments], separators=(',', ':'))
 
+        embeds = None
         if message.embeds:
-            extra_txt = '\nembeds: ' + str(message.embeds)
-            msg_content = (msg_content + extra_txt).strip()
-            msg_clean_content = (msg_clean_content + extra_txt).strip()
+            embeds = json.dumps(message.embeds, separators=(',', ':'))
 
-        values = {
-            'timestamp': timestamp,
-            'server_id': server_id,
-            'channel_id': channel_id,
-            'user_id': message.author.id,
-            'msg_type': msg_type,
-            'content': msg_content,
-            'clean_content': msg_clean_content,
-        }
-
-        before_time = timeit.default_timer()
-        self.con.execute(stmt, values)
-        self.con.commit()
-        execution_time = timeit.default_timer() - before_time
-        self.insert_timing.append(execution_time)
+        self.write_queue.append((timestamp, server_id, channel_id, message.author.id,
+                                 msg_type, msg_content, msg_clean_content, attachments, embeds))
+        if len(self.write_queue) >= WRITE_BATCH_ROWS:
+            self.batch_ready.set()
 
     def get_server_channel_date_msgs(self, server_id, channel_id, start_date_str):
+        return list(self.iter_server_channel_date_msgs(server_id, channel_id, start_date_str))
+
+    def iter_server_channel_date_msgs(self, server_id, channel_id, start_date_str, con=None):
+        """Yields (user_id, content) for a channel's messages on a day, as they're read.
+
+        con defaults to the cog's read connection; threads other than read_executor
+        should pass their own, from open_reader.
+        """
+        con = con or self.con
         start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
         start_date = start_date.replace(tzinfo=rpadutils.NA_TZ_OBJ)
         end_date = start_date + timedelta(days=1)
@@ -592,9 +1671,17 @@ class SqlActivityLogger(object):
             'end_timestamp': end_date,
         }
 
-        cursor = self.con.execute(SENIORITY_BACKFILL_QUERY, values)
-        rows = cursor.fetchall()
-        return [(str(r['user_id']), str(r['content'])) for r in rows]
+        # Pad the range by a day either side; the bounds have a non-UTC timezone
+        tables = partitions_between(list_partitions(con),
+                                    start_date.replace(tzinfo=None) - timedelta(days=1),
+                                    end_date.replace(tzinfo=None) + timedelta(days=1))
+        for table in tables:
+            for r in con.execute(SENIORITY_BACKFILL_QUERY.format(table=table), values):
+                yield str(r['user_id']), str(decompress(r['content']) or decompress(r['clean_content']))
+
+    def open_reader(self):
+        """A new read-only connection to the log, for use on another thread."""
+        return connect_reader(DB)
 
 
 def check_folders():
@@ -613,3 +1700,5 @@ def setup(bot):
     check_files()
     n = SqlActivityLogger(bot)
     bot.add_cog(n)
+    bot.loop.create_task(n.write_loop())
+    bot.loop.create_task(n.retention_loop())
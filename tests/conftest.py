@@ -0,0 +1,47 @@
+"""
+Shared fixtures for the cog tests.
+
+The cogs are imported the same way the benchmarks import them, so the tests need the
+cogs' normal dependencies installed and RED_DIR pointing at a Red-DiscordBot checkout
+(for cogs.utils). Without those, the tests are skipped.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'benchmarks'))
+
+from cog_loader import load_cogs
+
+# Every cog under test is imported in a single load_cogs call, since they all need to
+# live in the same cogs package
+COGS_UNDER_TEST = ('rpadutils', 'sqlactivitylog', 'dadguide')
+
+
+@pytest.fixture(scope='session')
+def cogs():
+    red_dir = os.environ.get('RED_DIR')
+    if not red_dir:
+        pytest.skip('RED_DIR is not set')
+    try:
+        modules = load_cogs(os.path.abspath(red_dir), *COGS_UNDER_TEST)
+    except ImportError as ex:
+        pytest.skip('Cog dependencies are not installed: {}'.format(ex))
+    return dict(zip(COGS_UNDER_TEST, modules))
+
+
+@pytest.fixture
+def rpadutils(cogs):
+    return cogs['rpadutils']
+
+
+@pytest.fixture
+def sqlactivitylog(cogs):
+    return cogs['sqlactivitylog']
+
+
+@pytest.fixture
+def dadguide(cogs):
+    return cogs['dadguide']
@@ -0,0 +1,35 @@
+import os
+import sqlite3
+
+
+def make_dump(path):
+    """A DadGuide dump with just the columns EvolutionTables reads."""
+    con = sqlite3.connect(path)
+    with con:
+        con.execute('CREATE TABLE monsters(monster_id INTEGER, rem_egg INTEGER, pal_egg INTEGER, buy_mp INTEGER)')
+        con.execute('CREATE TABLE evolutions(from_id INTEGER, to_id INTEGER)')
+        con.execute('CREATE TABLE drops(monster_id INTEGER)')
+        con.executemany('INSERT INTO monsters VALUES (?, ?, ?, ?)',
+                        [(1, 1, 0, None), (2, 0, 0, None), (3, 0, 1, 3000)])
+        con.execute('INSERT INTO evolutions VALUES (1, 2)')
+        con.execute('INSERT INTO drops VALUES (3)')
+    con.close()
+
+
+def test_evolution_lookups_work_after_close(dadguide, tmpdir, monkeypatch):
+    monkeypatch.setattr(dadguide, 'DB_DUMP_FILE', os.path.join(str(tmpdir), 'dadguide.sqlite'))
+    monkeypatch.setattr(dadguide, 'DB_DUMP_WORKING_FILE', os.path.join(str(tmpdir), 'dadguide_working.sqlite'))
+    make_dump(dadguide.DB_DUMP_FILE)
+
+    database = dadguide.load_database(None)
+    # A reload closes the old database while searches may still be filtering its monsters
+    dadguide.load_database(database).close()
+
+    assert not database.has_database()
+    assert database.monster_is_farmable(3)
+    assert not database.monster_is_farmable(1)
+    assert database.monster_in_rem(1)
+    assert database.monster_in_pem(3)
+    assert database.monster_in_mp_shop(3)
+    assert database.get_base_monster_id(2) == 1
+    assert database.get_evolution_tree_ids(1) == [1, 2]
@@ -0,0 +1,47 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+
+class FakeResponse(object):
+    """The parts of an aiohttp response that retry_after_secs looks at."""
+
+    def __init__(self, status, body, headers):
+        self.status = status
+        self.body = body
+        self.headers = headers
+
+    async def text(self, encoding=None):
+        return self.body
+
+
+def retry_after(rpadutils, response):
+    ex = SimpleNamespace(response=response)
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(rpadutils.retry_after_secs(ex))
+    finally:
+        loop.close()
+
+
+def test_retry_after_reads_json_body(rpadutils):
+    # What Discord sends for a 429 on API v6; retry_after is in milliseconds
+    body = json.dumps({'message': 'You are being rate limited.', 'retry_after': 6457, 'global': False})
+    headers = {'Content-Type': 'application/json', 'Retry-After': '6457',
+               'X-RateLimit-Limit': '10', 'X-RateLimit-Remaining': '0'}
+    assert retry_after(rpadutils, FakeResponse(429, body, headers)) == 6.457
+
+
+def test_retry_after_prefers_body_over_header(rpadutils):
+    body = json.dumps({'message': 'You are being rate limited.', 'retry_after': 1500, 'global': True})
+    assert retry_after(rpadutils, FakeResponse(429, body, {'Retry-After': '9000'})) == 1.5
+
+
+def test_retry_after_falls_back_to_header(rpadutils):
+    response = FakeResponse(429, '<html>Too Many Requests</html>', {'Retry-After': '2000'})
+    assert retry_after(rpadutils, response) == 2
+
+
+def test_retry_after_default(rpadutils):
+    response = FakeResponse(429, '', {})
+    assert retry_after(rpadutils, response) == rpadutils.BulkMemberUpdate.DEFAULT_RETRY_AFTER_SECS
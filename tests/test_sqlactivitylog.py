@@ -0,0 +1,108 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def con(sqlactivitylog, tmpdir):
+    con = sqlactivitylog.connect_writer(os.path.join(str(tmpdir), 'log.db'))
+    sqlactivitylog.create_daily_activity_table(con)
+    yield con
+    con.close()
+
+
+def message(timestamp, server_id='s1', channel_id='c1', user_id='u1', clean_content='hello'):
+    """An INSERT_MESSAGE row."""
+    return (timestamp, server_id, channel_id, user_id, 'NEW', '', clean_content, None, None)
+
+
+def write(sqlactivitylog, con, rows):
+    sqlactivitylog.write_messages(con, rows, set(sqlactivitylog.list_partitions(con)), False)
+
+
+def backfill(sqlactivitylog, con):
+    # Small batches, to make sure counts carry across them
+    for _ in sqlactivitylog.backfill_daily_activity(con, batch_rows=2):
+        pass
+
+
+def daily_counts(con, server_id='s1'):
+    rows = con.execute('SELECT date, SUM(msg_count) FROM daily_activity WHERE server_id = ? GROUP BY date',
+                       (server_id,))
+    return dict(rows.fetchall())
+
+
+def test_backfill_keeps_counts_for_expired_partitions(sqlactivitylog, con):
+    write(sqlactivitylog, con, [message(datetime(2024, 1, 10, 12)), message(datetime(2024, 1, 10, 13)),
+                                message(datetime(2024, 2, 5, 12)), message(datetime(2024, 3, 5, 12))])
+    deleted, dropped = sqlactivitylog.expire_messages(con, {}, 45, now=datetime(2024, 3, 20))
+    assert dropped == ['messages_2024_01']
+
+    # Break a count the remaining messages do cover, to check it gets fixed
+    con.execute("UPDATE daily_activity SET msg_count = 7 WHERE date = '2024-03-05'")
+    con.commit()
+
+    backfill(sqlactivitylog, con)
+
+    assert daily_counts(con) == {'2024-01-10': 2, '2024-02-05': 1, '2024-03-05': 1}
+
+
+def test_backfill_only_raises_partially_expired_day(sqlactivitylog, con):
+    write(sqlactivitylog, con, [message(datetime(2024, 3, 1, h)) for h in range(6)] +
+                               [message(datetime(2024, 3, 2, 12)), message(datetime(2024, 3, 2, 12), 's2')])
+    # Expires the first three messages on 3/1 for s1, leaving the rest of the day behind
+    deleted, _ = sqlactivitylog.expire_messages(con, {'s1': 10}, 0, now=datetime(2024, 3, 11, 2, 30))
+    assert deleted == 3
+
+    backfill(sqlactivitylog, con)
+
+    assert daily_counts(con) == {'2024-03-01': 6, '2024-03-02': 1}
+    assert daily_counts(con, 's2') == {'2024-03-02': 1}
+
+
+def test_backfill_legacy_table(sqlactivitylog, con):
+    with con:
+        con.executemany(sqlactivitylog.INSERT_MESSAGE.format(table=sqlactivitylog.LEGACY_TABLE),
+                        [message(datetime(2023, 12, 31, 23)), message(datetime(2024, 1, 1, 0)),
+                         message(datetime(2024, 1, 1, 1))])
+    write(sqlactivitylog, con, [message(datetime(2024, 1, 1, 2))])
+    con.execute('DELETE FROM daily_activity')
+    con.commit()
+
+    backfill(sqlactivitylog, con)
+
+    assert daily_counts(con) == {'2023-12-31': 1, '2024-01-01': 3}
+
+
+def test_rebuild_fts_index_in_batches(sqlactivitylog, con):
+    with con:
+        con.executemany(sqlactivitylog.INSERT_MESSAGE.format(table=sqlactivitylog.LEGACY_TABLE),
+                        [message(datetime(2023, 12, 1), user_id=str(i)) for i in range(5)])
+    available, needs_rebuild = sqlactivitylog.create_fts_index(con)
+    if not available:
+        pytest.skip('SQLite was built without trigram FTS5')
+    assert needs_rebuild
+
+    # Leftovers from a rebuild that didn't finish shouldn't end up indexed twice
+    with con:
+        con.execute("INSERT INTO messages_fts(rowid, clean_content) VALUES (1, 'hello')")
+    batches = sqlactivitylog.rebuild_fts_index(con, batch_rows=2)
+    assert sum(1 for _ in batches) == 3
+
+    assert con.execute("SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH 'hello'").fetchone()[0] == 5
+    assert con.execute('PRAGMA user_version').fetchone()[0] == sqlactivitylog.FTS_SCHEMA_VERSION
+    con.execute("INSERT INTO messages_fts(messages_fts, rank) VALUES ('integrity-check', 1)")
+
+
+def test_expire_and_compress_stop_when_cancelled(sqlactivitylog, con):
+    write(sqlactivitylog, con, [message(datetime(2024, 1, 10)), message(datetime(2024, 2, 10))])
+    now = datetime(2024, 6, 1)
+
+    cancel_after = iter([False, True])
+    deleted, dropped = sqlactivitylog.expire_messages(con, {}, 100, now=now, cancelled=lambda: next(cancel_after))
+    assert dropped == ['messages_2024_02']
+    assert sqlactivitylog.compress_cold_partitions(con, now=now, cancelled=lambda: True) == []
+
+    deleted, dropped = sqlactivitylog.expire_messages(con, {}, 100, now=now)
+    assert dropped == ['messages_2024_01']
@@ -549,7 +549,7 @@ class TrUtils:
             await self.bot.add_roles(m, role)
 
         await self.bot.say(inline("About to ensure that all {} members in the server have role: {}".format(len(members), role.name)))
-        await self._do_all_members(members, ignore_role_fn, change_role_fn)
+        await self._do_all_members(ctx, members, ignore_role_fn, change_role_fn)
         await self.bot.say("done")
 
     @commands.command(pass_context=True, no_pm=True)
@@ -567,7 +567,7 @@ class TrUtils:
             await self.bot.remove_roles(m, role)
 
         await self.bot.say(inline("About to ensure that all {} members in the server do not have role: {}".format(len(members), role.name)))
-        await self._do_all_members(members, ignore_role_fn, change_role_fn)
+        await self._do_all_members(ctx, members, ignore_role_fn, change_role_fn)
         await self.bot.say("done")
 
     @commands.command(pass_context=True, no_pm=True)
@@ -586,23 +586,18 @@ class TrUtils:
             await self.bot.add_roles(m, newrole)
 
         await self.bot.say(inline("About to ensure that all members in the server with role {} have role: {}".format(srcrole.name, newrole.name)))
-        await self._do_all_members(members, ignore_role_fn, change_role_fn)
+        await self._do_all_members(ctx, members, ignore_role_fn, change_role_fn)
         await self.bot.say("done")
 
-    async def _do_all_members(self, members, ignore_role_fn, per_member_asyncfn):
-        changed, ignored, errors = 0, 0, 0
-        for m in members:
-            if ignore_role_fn(m):
-                ignored += 1
-            else:
-                try:
-                    await per_member_asyncfn(m)
-                    await asyncio.sleep(1)
-                    changed += 1
-                except:
-                    errors += 1
-            if (changed + ignored + errors) % 10 == 0:
-                await self.bot.say(inline('Status: changed={} ignored={} errors={}'.format(changed, ignored, errors)))
+    async def _do_all_members(self, ctx, members, ignore_role_fn, per_member_asyncfn):
+        channel = ctx.message.channel
+
+        async def report_progress(update):
+            await self.bot.send_message(channel, inline('Status: ' + update.status()))
+
+        update = BulkMemberUpdate(members, per_member_asyncfn, skip_fn=ignore_role_fn,
+                                  progress_fn=report_progress)
+        await update.run()
 
     @commands.command(pass_context=True)
     @checks.is_owner()